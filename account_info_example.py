@@ -8,6 +8,8 @@ GOOGLE = {
 
 GOOGLE_INFO = {
     'old_filename': 'google_calendar.list',
+    # sync tokens used by the incremental mode (-i)
+    'sync_tokens_filename': 'google_calendar.tokens',
     # TODO MUST CHANGE TO ACTUAL VALUES
     # google calendars that WILL be synced
     'calendar_ids': ['fasdfadfafdsa@group.calendar.google.com'],  # calendar id,
@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the sync. They do not need any account information.
+Usage: python benchmark.py <benchmark>
+"""
+
+import statistics
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timedelta
+from typing import List
+
+
+def get_timezone_name_scan(d: datetime):
+    """Previous implementation: builds every timezone on each call"""
+    import pytz
+    return {tz.zone for tz in map(pytz.timezone, pytz.all_timezones_set) if
+            d.astimezone(tz).utcoffset() == d.utcoffset()}.pop()
+
+
+def bench_timezone(args):
+    import pytz
+    from timezones import TimezoneResolver
+
+    zones = ['Europe/Madrid', 'America/New_York', 'Asia/Tokyo', 'UTC', 'Australia/Sydney']
+    start = datetime(2024, 1, 1, 9)
+    dates = [pytz.timezone(zones[k % len(zones)]).localize(start + timedelta(days=k * 7)) for k in range(args.n)]
+
+    scan = timeit.timeit(lambda: [get_timezone_name_scan(d) for d in dates], number=1)
+    resolver = TimezoneResolver()
+    first = timeit.timeit(lambda: [resolver.resolve(d) for d in dates], number=1)
+    warm = timeit.timeit(lambda: [resolver.resolve(d) for d in dates], number=1)
+    preferred = timeit.timeit(lambda: [resolver.resolve(d, d.tzinfo.zone) for d in dates], number=1)
+
+    print(f"get_timezone_name for {args.n} datetimes")
+    print(f"{'scan (previous)':<25}{scan:>10.4f}s")
+    print(f"{'resolver (first)':<25}{first:>10.4f}s")
+    print(f"{'resolver (warm)':<25}{warm:>10.4f}s")
+    print(f"{'resolver (preferred)':<25}{preferred:>10.4f}s")
+
+
+def load_script() -> dict:
+    """Globals of ticktick-gcalendar.py, using account_info_example as the account information"""
+    import runpy
+    import account_info_example
+    from os import path
+    sys.modules.setdefault('account_info', account_info_example)
+    return runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'ticktick-gcalendar.py'))
+
+
+class LegacyTask(dict):
+    """Previous diff: tasks compared by id or by simplified dict depending on a class-global toggle"""
+    UPDATE_COMPARE = True
+    PROPERTIES = ['id', 'summary', 'description', 'start', 'end']
+
+    @property
+    def simplified(self):
+        return {k: self.get(k, None) for k in self.PROPERTIES}
+
+    def __hash__(self):
+        return hash(self['id'])
+
+    def __eq__(self, other):
+        return self.simplified == other.simplified if LegacyTask.UPDATE_COMPARE else hash(self) == hash(other)
+
+
+def legacy_diff(tasks: dict, old: dict):
+    old = set(old.values())
+    tasks = set(tasks.values())
+    LegacyTask.UPDATE_COMPARE = False
+    added = tasks - old
+    deleted = old - tasks
+    LegacyTask.UPDATE_COMPARE = True
+    updated = tasks - old - added
+    return added, updated, deleted
+
+
+def synthetic_events(n: int, churn: float, seed: int = 0):
+    """
+    Builds n old events and the current events after changing a churn fraction of them
+    (a third of the changed events are updated, a third deleted and a third added)
+    """
+    import random
+    rng = random.Random(seed)
+    old = {}
+    for k in range(n):
+        day = f"2024-{1 + k % 12:02d}-{1 + k % 28:02d}"
+        old[f"event{k}"] = {'id': f"event{k}", 'summary': f"Event {k}", 'description': "x" * rng.randint(0, 200),
+                            'start': {'date': day}, 'end': {'date': day}, 'etag': f'"{rng.random()}"'}
+    current = {k: dict(v) for k, v in old.items()}
+    changed = rng.sample(sorted(old.keys()), int(n * churn))
+    for k, event_id in enumerate(changed):
+        if k % 3 == 0:
+            current[event_id]['summary'] += " (updated)"
+        elif k % 3 == 1:
+            del current[event_id]
+        else:
+            current[f"new{k}"] = {'id': f"new{k}", 'summary': f"New {k}", 'start': {'date': '2024-01-01'},
+                                  'end': {'date': '2024-01-01'}}
+    return current, old
+
+
+def bench_diff(args):
+    import pickle
+    from plan import make_plan
+    task_class = load_script()['GCalendarApi'].Task
+
+    # each diff loads the old tasks as saved by the file state store: full tasks for the legacy diff, snapshots
+    # (with their fingerprints) for the plan
+    print(f"Diff with {args.churn:.0%} churn, loading the saved old tasks")
+    print(f"{'tasks':>10}{'legacy sets':>15}{'plan':>15}{'plan (saved)':>15}{'bytes/task':>15}")
+    for n in (args.n, 10_000, 100_000):
+        current, old = synthetic_events(n, args.churn)
+        saved = pickle.dumps({k: LegacyTask(v) for k, v in old.items()})
+        snapshots = pickle.dumps({k: task_class(v).snapshot(['id']) for k, v in old.items()})
+        legacy = timeit.timeit(lambda: legacy_diff({k: LegacyTask(v) for k, v in current.items()},
+                                                   pickle.loads(saved)), number=1)
+        # full old tasks (as saved before the snapshots) are compared without hashing them
+        plan = timeit.timeit(lambda: make_plan({k: task_class(v) for k, v in current.items()},
+                                               {k: task_class(v) for k, v in pickle.loads(saved).items()}), number=1)
+        plan_saved = timeit.timeit(lambda: make_plan(
+            {k: task_class(v) for k, v in current.items()},
+            {k: task_class.from_snapshot(v) for k, v in pickle.loads(snapshots).items()}), number=1)
+        sizes = f"{len(saved) // n} / {len(snapshots) // n}"
+        print(f"{n:>10}{legacy:>14.3f}s{plan:>14.3f}s{plan_saved:>14.3f}s{sizes:>15}")
+
+
+def synthetic_accounts(n: int, seed: int = 0, throttle: int = 0, history: int = 0, recurring: int = 0,
+                       latency: float = 0, normalize: bool = False, projects: int = 1):
+    """
+    Fake Google Calendar service with n events in two calendars and fake TickTick client with n tasks,
+    spread over next year and the history previous years
+    :param recurring: if given, one of every recurring events and tasks repeats weekly for a year
+    :param normalize: if set, TickTick changes the tasks written as it stores them (see FakeTickTickClient)
+    :param projects: TickTick projects the tasks are spread over
+    """
+    import random
+    from fakes import FakeCalendarService, FakeTickTickClient, ticktick_date
+
+    rng = random.Random(seed)
+    year = datetime.now().year + 1
+    calendars = {'cal1': [], 'cal2': []}
+    tasks = []
+    for k in range(n):
+        start = datetime(year - k % (history + 1), 1 + k % 12, 1 + k % 28, 8 + k % 10)
+        time_zone = ['Europe/Madrid', 'America/New_York', 'UTC'][k % 3]
+        if k % 5 == 0:
+            day = start.date().isoformat()
+            times = {'start': {'date': day}, 'end': {'date': day}}
+        else:
+            times = {'start': {'dateTime': start.isoformat() + 'Z', 'timeZone': time_zone},
+                     'end': {'dateTime': (start + timedelta(hours=1)).isoformat() + 'Z', 'timeZone': time_zone}}
+        repeat = {}
+        if recurring and k % recurring == 0:
+            times['recurrence'] = ['RRULE:FREQ=WEEKLY;COUNT=52']
+            repeat = {'repeatFlag': 'RRULE:FREQ=WEEKLY;INTERVAL=1;COUNT=52'}
+        calendars['cal1' if k % 2 else 'cal2'].append({
+            'id': f"event{k}", 'summary': f"Event {k}", 'description': "x" * rng.randint(0, 200),
+            'etag': f'"{rng.random()}"', 'status': 'confirmed', **times})
+        project_id = 'work' if k % projects == 0 else f"work{k % projects}"
+        tasks.append({'id': f"task{k}", 'projectId': project_id, 'title': f"Task {k}",
+                      'content': "y" * rng.randint(0, 200), 'isAllDay': False,
+                      'startDate': ticktick_date(start), 'dueDate': ticktick_date(start), 'timeZone': time_zone,
+                      'status': 0, 'etag': f"{rng.random()}", **repeat})
+    project_ids = ['work', *(f"work{k}" for k in range(1, projects)), 'from_google']
+    return (FakeCalendarService(calendars, throttle=throttle, latency=latency),
+            FakeTickTickClient(project_ids, tasks, throttle=throttle, latency=latency, normalize=normalize))
+
+
+def churn_accounts(service, client, churn: float, seed: int = 1, calendar_ids: List[str] = None):
+    """
+    Updates, deletes and adds a churn fraction of the events and tasks created by synthetic_accounts
+    :param client: None to only change the events
+    :param calendar_ids: calendars changed, all by default
+    """
+    import random
+    rng = random.Random(seed)
+    for calendar_id, events in service.calendars.items():
+        if calendar_ids is not None and calendar_id not in calendar_ids:
+            continue
+        ids = sorted(k for k, v in events.items() if k.startswith('event') and v.get('status', None) != 'cancelled')
+        for k, event_id in enumerate(rng.sample(ids, int(len(ids) * churn))):
+            if k % 3 == 0:
+                service.changed(calendar_id, {**events[event_id], 'summary': f"Event {event_id} (updated)"})
+            elif k % 3 == 1:
+                service.removed(calendar_id, event_id)
+            else:
+                service.changed(calendar_id, {**events[event_id], 'id': f"{event_id}-new"})
+    if client is None:
+        return
+    ids = sorted(k for k in client.tasks.keys() if k.startswith('task'))
+    for k, task_id in enumerate(rng.sample(ids, int(len(ids) * churn))):
+        if k % 3 == 0:
+            client.tasks[task_id]['title'] += " (updated)"
+        elif k % 3 == 1:
+            del client.tasks[task_id]
+        else:
+            client.tasks[f"{task_id}-new"] = {**client.tasks[task_id], 'id': f"{task_id}-new"}
+
+
+class Phases:
+    """Measures the wall time and peak memory (tracemalloc) of each phase"""
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, name: str):
+        import contextlib
+        import tracemalloc
+
+        @contextlib.contextmanager
+        def phase():
+            tracemalloc.reset_peak()
+            start = timeit.default_timer()
+            yield
+            self.results.append((name, timeit.default_timer() - start, tracemalloc.get_traced_memory()[1]))
+        return phase()
+
+    def print(self):
+        for name, elapsed, peak in self.results:
+            print(f"  {name:<25}{elapsed:>10.3f}s{peak / 2 ** 20:>10.1f} MB peak")
+
+
+class VirtualClock:
+    """Clock whose sleeps only advance the time, so that backoffs do not slow the benchmark down"""
+
+    def __init__(self):
+        self.slept = 0.0
+
+    def __call__(self) -> float:
+        return timeit.default_timer() + self.slept
+
+    def sleep(self, seconds: float):
+        self.slept += seconds
+
+
+def open_apis(script: dict, service, client, store, args, limiters: dict = None, stream: bool = False) -> tuple:
+    """TickTick and Google Calendar apis of the fake accounts, as main() opens them (fetching the tasks)"""
+    google_info = {'calendar_ids': ['cal1', 'cal2', 'from_ticktick'], 'default_project_id': 'from_ticktick'}
+    ticktick_info = {'EXCLUDED_PROJECTS': [], 'default_project_id': 'from_google'}
+    service.calendars.setdefault('from_ticktick', {})
+    window = None
+    if args.window_past is not None or args.window_future is not None:
+        window = script['SyncWindow'](
+            past=timedelta(days=args.window_past if args.window_past is not None else 1),
+            future=timedelta(days=args.window_future) if args.window_future is not None else None)
+    limiters = limiters or {}
+    tick = script['TickTickApi'](info=ticktick_info, store=store, client=client,
+                                 limiter=limiters.get('ticktick', None), window=window, stream=stream)
+    gtasks = script['GCalendarApi'](info=google_info, store=store, service=service, incremental=args.incremental,
+                                    batch=args.batch, limiter=limiters.get('gcalendar', None), window=window,
+                                    stream=stream)
+    return tick, gtasks
+
+
+def run_sync_cycle(script: dict, service, client, store, args, limiters: dict = None, journal=None,
+                   engine=None, echoes: bool = True, stream: bool = False) -> Phases:
+    """
+    Runs a sync like main() does, with the fake apis
+    :param echoes: if False, the own writes of the sync are synced back as before they were told apart
+    :param stream: diff the tasks page by page against the store (see --stream)
+    """
+    phases = Phases()
+    with phases('fetch'):
+        tick, gtasks = open_apis(script, service, client, store, args, limiters, stream)
+        bidict = store.load_bidict()
+        tick.engine = gtasks.engine = engine
+        if not echoes:
+            tick.is_echo = gtasks.is_echo = lambda task: False
+    if journal is not None:
+        with phases('resume'):
+            script['resume'](journal, tick, gtasks, bidict)
+    with phases('google -> ticktick'):
+        script['GCalendarDiff'](gtasks, journal=journal).sync_ticktick(tick, bidict)
+    with phases('ticktick -> google'):
+        script['TickTickDiff'](tick, journal=journal).sync_gcalendar(gtasks, bidict)
+    with phases('save'):
+        script['save_state'](tick, gtasks, bidict, store, journal)
+    return phases
+
+
+def bench_sync(args):
+    import contextlib
+    import os
+    import tempfile
+    import tracemalloc
+    from metrics import metrics
+    from ratelimit import RateLimiter
+    from state import SqliteStateStore
+
+    script = load_script()
+    service, client = synthetic_accounts(args.n, throttle=args.throttle, history=args.history,
+                                         recurring=args.recurring)
+    clock = VirtualClock()
+    limiters = {k: RateLimiter(k, rate=args.rate, sleep=clock.sleep, clock=clock) for k in ('gcalendar', 'ticktick')}
+    print(f"Sync of {args.n} events and {args.n} tasks ({args.churn:.0%} churn between cycles)")
+    if args.throttle or args.rate:
+        print(f"One of every {args.throttle} requests throttled, {args.rate} requests/s per backend "
+              f"(waits are simulated)")
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+        for cycle in ('first sync', 'sync after churn', 'sync without changes'):
+            if cycle == 'sync after churn':
+                churn_accounts(service, client, args.churn)
+            google_calls, google_requests, ticktick_calls = service.calls.copy(), service.requests, client.calls.copy()
+            slept, errors = clock.slept, sum(metrics.counters.get('errors_total', {}).values())
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                phases = run_sync_cycle(script, service, client, store, args, limiters)
+            print(f"{cycle}:")
+            phases.print()
+            print(f"  google: {service.requests - google_requests} requests, {dict(service.calls - google_calls)}")
+            print(f"  ticktick: {dict(client.calls - ticktick_calls)}")
+            state = store.connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            print(f"  state: {state} tasks, {len(store.load_bidict())} synced ids")
+            if args.throttle or args.rate:
+                left = sum(metrics.counters.get('errors_total', {}).values()) - errors
+                print(f"  waited {clock.slept - slept:.1f}s, {left:.0f} errors left for next sync")
+    tracemalloc.stop()
+
+
+def bench_engine(args):
+    """Writes of a sync sent one at a time, in batches and concurrently by the engines, with latency"""
+    import contextlib
+    import os
+    import tempfile
+    from engine import ENGINES
+    from ratelimit import RateLimiter
+    from state import SqliteStateStore
+
+    script = load_script()
+    print(f"Sync of {args.n} events and {args.n} tasks, {args.latency * 1000:.0f}ms per request "
+          f"({args.churn:.0%} churn between cycles)")
+    for mode in ('sequential', 'batch', *ENGINES.keys()):
+        args.batch = mode == 'batch'
+        service, client = synthetic_accounts(args.n, latency=args.latency)
+        limiters = {k: RateLimiter(k, max_in_flight=args.in_flight) for k in ('gcalendar', 'ticktick')}
+        engine = ENGINES[mode](workers=2 * args.in_flight) if mode in ENGINES else None
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+            print(f"{mode}:")
+            for cycle in ('first sync', 'sync after churn'):
+                if cycle == 'sync after churn':
+                    churn_accounts(service, client, args.churn)
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    phases = run_sync_cycle(script, service, client, store, args, limiters, engine=engine)
+                writes = sum(k[1] for k in phases.results if k[0] in ('google -> ticktick', 'ticktick -> google'))
+                print(f"  {cycle:<20}writes {writes:>8.3f}s")
+                if engine is not None:
+                    engine.report()
+            print(f"  google: {service.requests} requests, ticktick: {client.requests} requests, "
+                  f"{len(store.load_bidict())} synced ids")
+        if engine is not None:
+            engine.close()
+
+
+# endpoints of the fakes that write
+WRITES = {'insert', 'update', 'patch', 'delete', 'create', 'complete'}
+
+
+def bench_echo(args):
+    """Syncs after changes with TickTick normalizing the tasks written, with and without echo suppression"""
+    import contextlib
+    import os
+    import tempfile
+    from metrics import metrics
+    from state import SqliteStateStore
+
+    script = load_script()
+    print(f"Sync of {args.n} events and {args.n} tasks ({args.churn:.0%} churn), "
+          f"TickTick normalizing the tasks written")
+    for suppressed in (False, True):
+        service, client = synthetic_accounts(args.n, normalize=True)
+        print(f"{'with echo suppression' if suppressed else 'without echo suppression'}:")
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+            for cycle in ('first sync', 'sync after churn', 'sync without changes', 'sync without changes'):
+                if cycle == 'sync after churn':
+                    churn_accounts(service, client, args.churn)
+                google_calls, ticktick_calls = service.calls.copy(), client.calls.copy()
+                metrics.reset()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    run_sync_cycle(script, service, client, store, args, echoes=suppressed)
+                calls = (service.calls - google_calls) + (client.calls - ticktick_calls)
+                writes = sum(v for k, v in calls.items() if k.split('.')[-1] in WRITES)
+                items = metrics.to_dict().get('items_total', {})
+                echoes = sum(v for k, v in items.items() if 'operation=suppressed' in k)
+                print(f"  {cycle:<24}{writes:>6} writes{echoes:>6} suppressed")
+
+
+def bench_memory(args):
+    """Peak memory of the syncs of a big account, diffing all the tasks in memory and streaming them"""
+    import contextlib
+    import os
+    import tempfile
+    import tracemalloc
+    from state import SqliteStateStore
+
+    script = load_script()
+    script['GCalendarApi'].PAGE_SIZE = args.page_size
+    print(f"Sync of {args.n} events and {args.n} tasks ({args.churn:.0%} churn between cycles), "
+          f"pages of {args.page_size} events and {args.projects} TickTick projects")
+    tracemalloc.start()
+    for stream in (False, True):
+        service, client = synthetic_accounts(args.n, projects=args.projects)
+        print(f"{'stream' if stream else 'full'}:")
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+            for cycle in ('first sync', 'sync after churn', 'sync without changes'):
+                if cycle == 'sync after churn':
+                    churn_accounts(service, client, args.churn)
+                # the fake accounts are not counted
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                start = timeit.default_timer()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    run_sync_cycle(script, service, client, store, args, stream=stream)
+                elapsed = timeit.default_timer() - start
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                print(f"  {cycle:<24}{elapsed:>8.3f}s{peak / 2 ** 20:>10.1f} MB peak")
+            print(f"  state: {store.connection.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]} tasks, "
+                  f"{len(store.load_bidict())} synced ids")
+    tracemalloc.stop()
+
+
+def bench_push(args):
+    """
+    Syncs triggered by the notifications of watch channels (posted to a local receiver by a fake notifier)
+    against polling every calendar, with the renewal of the channels
+    """
+    import contextlib
+    import os
+    import tempfile
+    from fakes import FakeNotifier
+    from push import Push
+    from state import SqliteStateStore
+
+    script = load_script()
+    args.incremental = True
+    clock = VirtualClock()
+    service, client = synthetic_accounts(args.n)
+    service.clock = clock
+    print(f"Sync of {args.n} events and {args.n} tasks, {args.churn:.0%} of the events of cal1 changed, "
+          f"{args.debounce}s debounce")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_sync_cycle(script, service, client, store, args)
+
+        # polling: every calendar and project is fetched
+        churn_accounts(service, None, args.churn, calendar_ids=['cal1'])
+        calls = service.calls.copy(), client.calls.copy()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_sync_cycle(script, service, client, store, args)
+        print(f"  {'polling':<16}google {dict(service.calls - calls[0])}")
+        print(f"  {'':<16}ticktick {dict(client.calls - calls[1])}")
+
+        # push: only the calendar notified is fetched, once for the burst of changes
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            tick, gtasks = open_apis(script, service, client, store, args)
+        bidict = store.load_bidict()
+        service.notifier = notifier = FakeNotifier()
+        push = Push(gtasks, port=0, debounce=args.debounce, ttl=args.ttl, clock=clock)
+        push.start()
+        try:
+            churn_accounts(service, None, args.churn, seed=2, calendar_ids=['cal1'])
+            notified = timeit.default_timer()
+            calendar_ids = push.wait(10 * args.debounce + 10)
+            waited = timeit.default_timer() - notified
+            calls = service.calls.copy(), client.calls.copy()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                plan = script['sync_notified'](tick, gtasks, bidict, calendar_ids)
+                script['save_state'](tick, gtasks, bidict, store)
+            print(f"  {'push':<16}{notifier.states['exists']} notifications, {notifier.statuses[403]} rejected, "
+                  f"synced {calendar_ids} once {waited:.2f}s after the last one ({len(plan)} changes)")
+            print(f"  {'':<16}google {dict(service.calls - calls[0])}")
+            print(f"  {'':<16}ticktick {dict(client.calls - calls[1])}")
+
+            # renewal: the channels are replaced before they expire, and the old ones rejected
+            old = list(service.watches.values())
+            clock.sleep(args.ttl * 0.95)
+            calls = service.calls.copy()
+            push.wait(0)
+            calls = service.calls - calls
+            rejected = [notifier.post(k) for k in old]
+            rejected += [notifier.post(k, token='forged') for k in service.watches.values()]
+            print(f"  {'renewal':<16}{calls['events.watch']} channels opened, {calls['channels.stop']} stopped, "
+                  f"{sum(k == 403 for k in rejected)} of {len(rejected)} old or forged notifications rejected")
+        finally:
+            push.close()
+
+
+def bench_crash(args):
+    """Kills the first sync after some writes and syncs again, with and without the journal"""
+    import contextlib
+    import os
+    import tempfile
+    from collections import Counter
+    from fakes import Killed, KillSwitch
+    from journal import Journal
+    from state import SqliteStateStore
+
+    def duplicates(service, client) -> int:
+        events = Counter(v.get('summary', None) for v in service.calendars['from_ticktick'].values()
+                         if v.get('status', None) != 'cancelled')
+        tasks = Counter(v['title'] for v in client.tasks.values() if v.get('projectId', None) == 'from_google')
+        return sum(v - 1 for v in events.values()) + sum(v - 1 for v in tasks.values())
+
+    script = load_script()
+    kill = args.kill if args.kill is not None else args.n // 2
+    print(f"Sync of {args.n} events and {args.n} tasks killed after {kill} writes, then synced again")
+    for journaled in (False, True):
+        service, client = synthetic_accounts(args.n)
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+            journal_file = os.path.join(tmp, 'journal.log')
+            # writes to both apis are counted together
+            service.kill = client.kill = KillSwitch(kill)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                try:
+                    run_sync_cycle(script, service, client, store, args,
+                                   journal=Journal(journal_file) if journaled else None)
+                except Killed:
+                    pass
+                # the killed run saved nothing
+                store = SqliteStateStore(os.path.join(tmp, 'state.sqlite'))
+                service.kill.writes = None
+                journal = Journal(journal_file) if journaled else None
+                pending = len(journal.replay()) if journaled else 0
+                google_calls, ticktick_calls = service.calls.copy(), client.calls.copy()
+                phases = run_sync_cycle(script, service, client, store, args, journal=journal)
+            print(f"{'with journal' if journaled else 'without journal'}:")
+            phases.print()
+            if journaled:
+                print(f"  {pending} journaled writes replayed")
+            print(f"  google: {dict(service.calls - google_calls)}")
+            print(f"  ticktick: {dict(client.calls - ticktick_calls)}")
+            print(f"  duplicates: {duplicates(service, client)}")
+
+
+def time_python(code: str, repeat: int) -> float:
+    """Median time of running code in a new interpreter"""
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(timeit.default_timer() - start)
+    return statistics.median(times)
+
+
+def bench_startup(args):
+    # account_info_example stands in for the account information
+    load_script = "import sys, runpy, account_info_example; sys.modules['account_info'] = account_info_example; " \
+                  "runpy.run_path('ticktick-gcalendar.py')"
+    eager_imports = "import pytz, googleapiclient.discovery, googleapiclient.errors, google_auth_oauthlib.flow, " \
+                    "google.oauth2.credentials, google.auth.transport.requests, google_auth_httplib2, " \
+                    "ticktick_py.ticktick.api"
+
+    print(f"Startup (median of {args.repeat} runs)")
+    print(f"{'interpreter':<30}{time_python('pass', args.repeat):>10.4f}s")
+    print(f"{'script (lazy imports)':<30}{time_python(load_script, args.repeat):>10.4f}s")
+    try:
+        print(f"{'eager imports (previous)':<30}{time_python(eager_imports, args.repeat):>10.4f}s")
+    except subprocess.CalledProcessError:
+        print(f"{'eager imports (previous)':<30}{'missing packages':>10}")
+
+    try:
+        from googleapiclient.discovery import build
+    except ImportError:
+        print("googleapiclient is not installed: skipping discovery")
+        return
+    for static in (True, False):
+        name = 'build (static discovery)' if static else 'build (network discovery)'
+        try:
+            elapsed = timeit.timeit(lambda: build('calendar', 'v3', developerKey='benchmark', static_discovery=static,
+                                                  cache_discovery=False), number=args.repeat) / args.repeat
+            print(f"{name:<30}{elapsed:>10.4f}s")
+        except Exception as e:
+            print(f"{name:<30} failed: {e}")
+
+
+BENCHMARKS = {
+    'timezone': bench_timezone,
+    'startup': bench_startup,
+    'diff': bench_diff,
+    'sync': bench_sync,
+    'crash': bench_crash,
+    'engine': bench_engine,
+    'echo': bench_echo,
+    'memory': bench_memory,
+    'push': bench_push,
+}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('-n', type=int, default=200, help="Number of items")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Number of repetitions")
+    parser.add_argument('-c', '--churn', type=float, default=0.05, help="Fraction of tasks changed")
+    parser.add_argument('-i', '--incremental', action='store_true', help="Sync Google Calendar incrementally")
+    parser.add_argument('-b', '--batch', action='store_true', help="Send Google Calendar changes in batches")
+    parser.add_argument('-t', '--throttle', type=int, default=0, help="Throttle one of every t requests (sync)")
+    parser.add_argument('--rate', type=float, default=None, help="Requests per second per backend (sync)")
+    parser.add_argument('--history', type=int, default=0, help="Years of past events and tasks (sync)")
+    parser.add_argument('--window_past', type=float, default=None, help="Sync window days before now (sync)")
+    parser.add_argument('--window_future', type=float, default=None, help="Sync window days after now (sync)")
+    parser.add_argument('--kill', type=int, default=None, help="Writes before killing the sync (crash)")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds per request (engine)")
+    parser.add_argument('--in_flight', type=int, default=8, help="Requests in flight per api (engine)")
+    parser.add_argument('--debounce', type=float, default=0.5, help="Seconds of debounce (push)")
+    parser.add_argument('--ttl', type=float, default=3600, help="Seconds of the watch channels (push)")
+    parser.add_argument('--page_size', type=int, default=250, help="Google Calendar events per page (memory)")
+    parser.add_argument('--projects', type=int, default=20, help="TickTick projects of the tasks (memory)")
+    parser.add_argument('--recurring', type=int, default=0,
+                        help="One of every recurring events and tasks repeats weekly (sync)")
+
+    arguments = parser.parse_args()
+    BENCHMARKS[arguments.benchmark](arguments)
@@ -0,0 +1,177 @@
+"""
+Engines for the writes of a sync. The api clients are blocking, so their requests run in a pool of threads
+(each thread keeping its own keep-alive connections, see GCalendarApi.http) while the callbacks of the writes,
+which change the sync state (old tasks and synced ids), run one at a time.
+Writes with the same key (the id of the task written, and so of its synced pair) are sent in the order they
+were submitted; the rest do not wait for each other
+"""
+
+import asyncio
+import math
+import queue
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+Write = Tuple[Optional[Hashable], Callable[[], Any], Callable[[Any], Any], Callable[[Exception], None], str]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile (p in [0, 1]) of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+class Engine(ABC):
+    """Runs the writes submitted concurrently when flushed, measuring the latency of each kind of write"""
+
+    def __init__(self, workers: int = 8):
+        """:param workers: requests sent at the same time (the rate limiters of the apis still apply)"""
+        # the threads (and so their connections) are kept between flushes
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='sync')
+        self.pending: List[Write] = []
+        # seconds of each write by name (waiting for the rate limiter included), and seconds spent flushing
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.elapsed = 0.0
+
+    def submit(self, key: Optional[Hashable], fn: Callable[[], Any], on_done: Callable[[Any], Any],
+               on_error: Callable[[Exception], None], name: str = 'write'):
+        """
+        :param key: writes with the same key are kept in order, None if it does not depend on other writes
+        :param fn: sends the request (called in a thread of the pool)
+        :param on_done: called with the result of fn (one callback at a time)
+        :param on_error: called if fn or on_done fail (one callback at a time)
+        :param name: kind of write (e.g., the endpoint) the latency is reported for
+        """
+        self.pending.append((key, fn, on_done, on_error, name))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def flush(self):
+        """Sends the pending writes, and those submitted by their callbacks, and waits for them"""
+        start = time.perf_counter()
+        try:
+            while self.pending:
+                writes, self.pending = self.pending, []
+                self.run(writes)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    @abstractmethod
+    def run(self, writes: List[Write]):
+        pass
+
+    def timed(self, fn: Callable[[], Any], name: str) -> Any:
+        start = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Writes, writes per second (of the time flushing) and latency percentiles of each kind of write"""
+        stats = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            stats[name] = {'count': len(latencies),
+                           'ops_per_second': len(latencies) / self.elapsed if self.elapsed else 0.0,
+                           'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95),
+                           'p99': percentile(latencies, 0.99), 'max': latencies[-1]}
+        return stats
+
+    def report(self):
+        """Prints the stats of the writes sent since the last report"""
+        for name, k in self.stats().items():
+            print(f"  {name:<20}{k['count']:>6} writes{k['ops_per_second']:>8.1f}/s  p50 {k['p50'] * 1000:.0f}ms  "
+                  f"p95 {k['p95'] * 1000:.0f}ms  p99 {k['p99'] * 1000:.0f}ms  max {k['max'] * 1000:.0f}ms")
+        self.latencies.clear()
+        self.elapsed = 0.0
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class AsyncEngine(Engine):
+    """Schedules the writes in an asyncio loop, which also runs their callbacks"""
+
+    def run(self, writes: List[Write]):
+        asyncio.run(self.send_all(writes))
+
+    async def send_all(self, writes: List[Write]):
+        loop = asyncio.get_running_loop()
+        locks: Dict[Hashable, asyncio.Lock] = {}
+
+        async def send(fn: Callable[[], Any], on_done: Callable[[Any], Any], on_error: Callable[[Exception], None],
+                       name: str, lock: Optional[asyncio.Lock]):
+            if lock is not None:
+                # locks are acquired in order of arrival, which is the order of submission
+                await lock.acquire()
+            try:
+                try:
+                    result = await loop.run_in_executor(self.pool, self.timed, fn, name)
+                except Exception as e:
+                    on_error(e)
+                    return
+                try:
+                    on_done(result)
+                except Exception as e:
+                    on_error(e)
+            finally:
+                if lock is not None:
+                    lock.release()
+
+        await asyncio.gather(*(send(fn, on_done, on_error, name,
+                                    None if key is None else locks.setdefault(key, asyncio.Lock()))
+                               for key, fn, on_done, on_error, name in writes))
+
+
+class ThreadEngine(Engine):
+    """
+    Sends the writes from the pool of threads while the flushing thread runs their callbacks as they finish
+    (so the state, e.g., a SQLite store, is only used from that thread).
+    The next write of a key is only handed to the pool when the previous one finished, so no thread waits
+    """
+
+    def run(self, writes: List[Write]):
+        queues: Dict[Hashable, Deque[Write]] = {}
+        finished: 'queue.SimpleQueue[Tuple[Write, Any, Optional[Exception]]]' = queue.SimpleQueue()
+
+        def send(write: Write):
+            try:
+                finished.put((write, self.timed(write[1], write[4]), None))
+            except Exception as e:
+                finished.put((write, None, e))
+
+        for write in writes:
+            key = write[0]
+            if key is not None:
+                queues.setdefault(key, deque()).append(write)
+                if len(queues[key]) > 1:
+                    continue
+            self.pool.submit(send, write)
+
+        for _ in writes:
+            write, result, error = finished.get()
+            key, _, on_done, on_error, _ = write
+            try:
+                if error is not None:
+                    on_error(error)
+                else:
+                    try:
+                        on_done(result)
+                    except Exception as e:
+                        on_error(e)
+            finally:
+                # as with the async engine, the next write of the key is sent after the callback of the previous
+                if key is not None:
+                    pending = queues[key]
+                    pending.popleft()
+                    if pending:
+                        self.pool.submit(send, pending[0])
+
+
+ENGINES = {'async': AsyncEngine, 'threads': ThreadEngine}
@@ -0,0 +1,513 @@
+"""
+In-memory stand-ins for the Google Calendar service and the TickTick client.
+They implement the part of the apis used by the sync and count the calls made, so that the sync can be
+run and measured without accounts (see benchmark.py)
+"""
+
+import copy
+import itertools
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Callable, Optional, Tuple
+
+from recurrence import Series, recurrence_to_repeat
+
+
+class FakeHttpError(Exception):
+    """Mimics googleapiclient.errors.HttpError"""
+
+    class Response(dict):
+        def __init__(self, status: int, headers: Dict = None):
+            super().__init__(headers or {})
+            self.status = status
+
+    def __init__(self, status: int, reason: str = "", headers: Dict = None):
+        super().__init__(f"<HttpError {status} {reason}>")
+        self.resp = self.Response(status, headers)
+
+
+class FakeResponse:
+    """Mimics the requests.Response of an error"""
+
+    def __init__(self, status: int, reason: str = "", headers: Dict = None):
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers or {}
+        self.ok = status < 400
+
+
+class FakeSession:
+    """Mimics the requests session of the ticktick_py client, which only shows the responses to its hooks"""
+
+    def __init__(self):
+        self.hooks = {'response': []}
+
+    def fail(self, status: int, reason: str = "", headers: Dict = None) -> Exception:
+        """Error of a request answered with status, as ticktick_py raises it: a bare RuntimeError"""
+        response = FakeResponse(status, reason, headers)
+        for hook in self.hooks['response']:
+            hook(response)
+        return RuntimeError("Could Not Complete Request")
+
+
+class Throttle:
+    """
+    Fails one of every `every` requests as throttled, alternating the statuses given (by default, Google's 429
+    with Retry-After and 403 rateLimitExceeded without it)
+    """
+    REASONS = {429: "Too Many Requests", 403: "Rate Limit Exceeded: userRateLimitExceeded", 503: "Service Unavailable"}
+
+    def __init__(self, calls: Counter, every: int = 0, retry_after: float = 0, statuses: Tuple[int, ...] = (429, 403),
+                 error: Callable[[int, str, Dict], Exception] = FakeHttpError):
+        """:param error: builds the error raised from the status, reason and headers of the response"""
+        self.calls = calls
+        self.every = every
+        self.retry_after = retry_after
+        self.statuses = statuses
+        self.error = error
+        self.count = 0
+
+    def check(self):
+        if not self.every:
+            return
+        self.count += 1
+        if self.count % self.every:
+            return
+        self.calls['throttled'] += 1
+        status = self.statuses[(self.count // self.every - 1) % len(self.statuses)]
+        headers = {'retry-after': str(self.retry_after)} if status == 429 else {}
+        raise self.error(status, self.REASONS[status], headers)
+
+
+class Killed(BaseException):
+    """The process was killed (the sync only catches Exception)"""
+
+
+class KillSwitch:
+    """Kills the process once a number of writes are done, before their answers are received"""
+    WRITES = {'events.insert', 'events.update', 'events.patch', 'events.delete',
+              'task.create', 'task.update', 'task.delete', 'task.complete'}
+
+    def __init__(self, writes: Optional[int] = None):
+        """:param writes: writes done before being killed, None to never be killed"""
+        self.writes = writes
+
+    def wrote(self, name: str):
+        if self.writes is None or name not in self.WRITES:
+            return
+        self.writes -= 1
+        if self.writes <= 0:
+            self.writes = None
+            raise Killed()
+
+
+class FakeRequest:
+    def __init__(self, service: 'FakeCalendarService', name: str, fn: Callable[[], Optional[Dict]]):
+        self.service = service
+        self.name = name
+        self.fn = fn
+
+    def execute(self, http=None, num_retries: int = 0):
+        self.service.requests += 1
+        time.sleep(self.service.latency)
+        return self.run()
+
+    def run(self):
+        self.service.throttle.check()
+        self.service.calls[self.name] += 1
+        response = copy.deepcopy(self.fn())
+        self.service.kill.wrote(self.name)
+        return response
+
+
+class FakeBatch:
+    def __init__(self, service: 'FakeCalendarService'):
+        self.service = service
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback: Callable = None, request_id: str = None):
+        self.requests.append((request, callback, request_id or str(len(self.requests))))
+
+    def execute(self, http=None):
+        self.service.requests += 1
+        time.sleep(self.service.latency)
+        self.service.calls['batch'] += 1
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = request.run(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class FakeEvents:
+    def __init__(self, service: 'FakeCalendarService'):
+        self.service = service
+
+    def list(self, calendarId: str, pageToken: str = None, maxResults: int = 250, syncToken: str = None,
+             timeMin: str = None, timeMax: str = None, **kwargs):
+        if syncToken is not None and (timeMin is not None or timeMax is not None):
+            raise FakeHttpError(400, "syncToken cannot be used with timeMin or timeMax")
+        bounds = (parse_time(timeMin), parse_time(timeMax))
+        return FakeRequest(self.service, 'events.list',
+                           lambda: self.service.list(calendarId, pageToken, maxResults, syncToken, bounds))
+
+    def get(self, calendarId: str, eventId: str, **kwargs):
+        return FakeRequest(self.service, 'events.get', lambda: self.service.get(calendarId, eventId, deleted=True))
+
+    def insert(self, calendarId: str, body: Dict, **kwargs):
+        return FakeRequest(self.service, 'events.insert', lambda: self.service.insert(calendarId, body))
+
+    def update(self, calendarId: str, eventId: str, body: Dict, **kwargs):
+        return FakeRequest(self.service, 'events.update', lambda: self.service.update(calendarId, eventId, body))
+
+    def patch(self, calendarId: str, eventId: str, body: Dict, **kwargs):
+        return FakeRequest(self.service, 'events.patch',
+                           lambda: self.service.update(calendarId, eventId, body, patch=True))
+
+    def delete(self, calendarId: str, eventId: str, **kwargs):
+        return FakeRequest(self.service, 'events.delete', lambda: self.service.delete(calendarId, eventId))
+
+    def watch(self, calendarId: str, body: Dict, **kwargs):
+        return FakeRequest(self.service, 'events.watch', lambda: self.service.watch(calendarId, body))
+
+
+class FakeChannels:
+    def __init__(self, service: 'FakeCalendarService'):
+        self.service = service
+
+    def stop(self, body: Dict, **kwargs):
+        return FakeRequest(self.service, 'channels.stop', lambda: self.service.stop_channel(body))
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    """Parses an event time (date or RFC3339 datetime) as an utc aware datetime"""
+    if value is None:
+        return None
+    d = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return d.replace(tzinfo=timezone.utc) if d.tzinfo is None else d
+
+
+def merge_patch(target: Dict, patch: Dict) -> Dict:
+    """Patch merged into target as Google does: nested objects are merged and None removes the property"""
+    merged = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict):
+            merged[key] = merge_patch(merged.get(key, None) if isinstance(merged.get(key, None), dict) else {}, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def overlaps(event: Dict, time_min: Optional[datetime], time_max: Optional[datetime]) -> bool:
+    start = parse_time(event['start'].get('dateTime', event['start'].get('date', None)))
+    end = parse_time(event['end'].get('dateTime', event['end'].get('date', None)))
+    rule, ex_dates = recurrence_to_repeat(event.get('recurrence', None))
+    if rule is not None:
+        # recurring events are listed if any of their occurrences is in the bounds
+        series = Series.create(rule, start, end, event['start'].get('timeZone', None), ex_dates)
+        return series.overlaps(time_min or start, time_max)
+    return (time_min is None or end > time_min) and (time_max is None or start < time_max)
+
+
+class FakeCalendarService:
+    """Google Calendar service keeping the events in memory. Sync tokens are versions of the service"""
+
+    def __init__(self, calendars: Dict[str, List[Dict]] = None, throttle: int = 0, latency: float = 0,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param throttle: if given, one of every throttle requests fails as throttled
+        :param latency: seconds each http round trip takes
+        :param clock: seconds since the epoch, for the expiration of the watch channels
+        """
+        self.latency = latency
+        self.clock = clock
+        self.calls = Counter()
+        self.throttle = Throttle(self.calls, throttle)
+        self.kill = KillSwitch()
+        # http round trips (a batch is a single request)
+        self.requests = 0
+        self.version = itertools.count(1)
+        # version of the last change of any calendar (the sync tokens given now), and of the expired tokens
+        self.last_version = 0
+        self.expired_version = 0
+        self.ids = itertools.count(1)
+        # events and version of their last change by calendar (cancelled events are kept)
+        self.calendars: Dict[str, Dict[str, Dict]] = {}
+        self.versions: Dict[str, Dict[str, int]] = {}
+        # open watch channels by id, and the notifier posting their notifications if any
+        self.watches: Dict[str, Dict] = {}
+        self.notifier: Optional['FakeNotifier'] = None
+        for calendar_id, events in (calendars or {}).items():
+            for event in events:
+                self.put(calendar_id, dict(event))
+
+    def events(self) -> FakeEvents:
+        return FakeEvents(self)
+
+    def channels(self) -> FakeChannels:
+        return FakeChannels(self)
+
+    def new_batch_http_request(self, callback: Callable = None) -> FakeBatch:
+        return FakeBatch(self)
+
+    def put(self, calendar_id: str, event: Dict) -> Dict:
+        self.calendars.setdefault(calendar_id, {})[event['id']] = event
+        self.last_version = next(self.version)
+        self.versions.setdefault(calendar_id, {})[event['id']] = self.last_version
+        self.notify(calendar_id, 'exists')
+        return event
+
+    def watch(self, calendar_id: str, body: Dict) -> Dict:
+        ttl = float(body.get('params', {}).get('ttl', 7 * 24 * 3600))
+        channel = {'id': body['id'], 'resourceId': f"resource-{calendar_id}", 'calendarId': calendar_id,
+                   'address': body['address'], 'token': body.get('token', None),
+                   'expiration': str(int((self.clock() + ttl) * 1000))}
+        self.watches[channel['id']] = channel
+        if self.notifier is not None:
+            self.notifier.post(channel, 'sync')
+        return {'kind': 'api#channel', 'id': channel['id'], 'resourceId': channel['resourceId'],
+                'resourceUri': f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events",
+                'expiration': channel['expiration']}
+
+    def stop_channel(self, body: Dict):
+        channel = self.watches.get(body['id'], None)
+        if channel is None or channel['resourceId'] != body['resourceId']:
+            raise FakeHttpError(404, "Channel not found")
+        del self.watches[body['id']]
+        return ''
+
+    def notify(self, calendar_id: str, state: str):
+        """Posts a notification to the channels watching the calendar"""
+        if self.notifier is None:
+            return
+        for channel in [k for k in self.watches.values() if k['calendarId'] == calendar_id]:
+            self.notifier.post(channel, state)
+
+    def get(self, calendar_id: str, event_id: str, deleted: bool = False) -> Dict:
+        """:param deleted: return deleted events (as cancelled) instead of failing"""
+        event = self.calendars.get(calendar_id, {}).get(event_id, None)
+        if event is None or (event.get('status', None) == 'cancelled' and not deleted):
+            raise FakeHttpError(404, "Not Found")
+        return event
+
+    def list(self, calendar_id: str, page_token: Optional[str], max_results: int, sync_token: Optional[str],
+             bounds: Tuple[Optional[datetime], Optional[datetime]] = (None, None)):
+        """:param bounds: only events ending after the first and starting before the second are listed"""
+        versions = self.versions.get(calendar_id, {})
+        if sync_token is not None and int(sync_token) <= self.expired_version:
+            raise FakeHttpError(410, "Sync token is no longer valid, a full sync is required.")
+        if sync_token is None:
+            ids = [k for k, v in self.calendars.get(calendar_id, {}).items()
+                   if v.get('status', None) != 'cancelled' and overlaps(v, *bounds)]
+        else:
+            ids = [k for k, v in versions.items() if v > int(sync_token)]
+        start = int(page_token) if page_token is not None else 0
+        result = {'items': [self.calendars[calendar_id][k] for k in ids[start:start + max_results]]}
+        if start + max_results < len(ids):
+            result['nextPageToken'] = str(start + max_results)
+        else:
+            result['nextSyncToken'] = str(self.last_version)
+        return result
+
+    def insert(self, calendar_id: str, body: Dict) -> Dict:
+        event = merge_patch({}, body)
+        if 'id' in event:
+            # ids of deleted events cannot be reused either
+            if event['id'] in self.calendars.get(calendar_id, {}):
+                raise FakeHttpError(409, "The requested identifier already exists.")
+        else:
+            event['id'] = f"fake{next(self.ids)}"
+        return self.put(calendar_id, event)
+
+    def update(self, calendar_id: str, event_id: str, body: Dict, patch: bool = False) -> Dict:
+        event = merge_patch(self.get(calendar_id, event_id) if patch else {}, body)
+        event['id'] = event_id
+        return self.put(calendar_id, event)
+
+    def delete(self, calendar_id: str, event_id: str):
+        self.get(calendar_id, event_id)
+        self.put(calendar_id, {'id': event_id, 'status': 'cancelled'})
+        return ''
+
+    def expire_sync_tokens(self):
+        """Expires the sync tokens given so far, as Google does after some time"""
+        self.expired_version = self.last_version
+
+    def changed(self, calendar_id: str, event: Dict):
+        """Changes (or adds) an event as a user would"""
+        self.put(calendar_id, dict(event))
+
+    def removed(self, calendar_id: str, event_id: str):
+        """Deletes an event as a user would"""
+        self.put(calendar_id, {'id': event_id, 'status': 'cancelled'})
+
+
+class FakeNotifier:
+    """
+    Stand-in for Google posting the notifications of the watch channels: posts them as Google does (headers
+    without body) to the address of the channel, e.g., a local push.NotificationReceiver
+    """
+
+    def __init__(self):
+        # notifications posted by state, and their answers by http status
+        self.states = Counter()
+        self.statuses = Counter()
+        self.messages = itertools.count(1)
+
+    def post(self, channel: Dict, state: str = 'exists', token: str = None) -> int:
+        """
+        :param state: sync for the first message of a channel, exists or not_exists for changes
+        :param token: token sent instead of the one of the channel (a forged notification)
+        :return: http status of the answer
+        """
+        from urllib import error, request
+
+        headers = {'X-Goog-Channel-ID': channel['id'],
+                   'X-Goog-Channel-Token': token if token is not None else channel.get('token', None) or '',
+                   'X-Goog-Channel-Expiration': channel.get('expiration', ''),
+                   'X-Goog-Resource-ID': channel['resourceId'],
+                   'X-Goog-Resource-State': state,
+                   'X-Goog-Message-Number': str(next(self.messages))}
+        # the receiver is local, so any proxy of the environment is skipped
+        opener = request.build_opener(request.ProxyHandler({}))
+        try:
+            with opener.open(request.Request(channel['address'], data=b'', headers=headers, method='POST'),
+                             timeout=10) as response:
+                status = response.status
+        except error.HTTPError as e:
+            status = e.code
+        self.states[state] += 1
+        self.statuses[status] += 1
+        return status
+
+
+def ticktick_date(d: datetime) -> str:
+    """Date in the TickTick format (utc)"""
+    if d.tzinfo is not None:
+        d = d.astimezone(timezone.utc)
+    return d.strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+class FakeTaskManager:
+    def __init__(self, client: 'FakeTickTickClient'):
+        self.client = client
+
+    def get_from_project(self, project_id: str) -> List[Dict]:
+        self.client.throttle.check()
+        time.sleep(self.client.latency)
+        self.client.calls['task.get_from_project'] += 1
+        return [copy.deepcopy(k) for k in self.client.tasks.values() if k.get('projectId', None) == project_id]
+
+    def create(self, task: Dict) -> Dict:
+        self.client.throttle.check()
+        time.sleep(self.client.latency)
+        self.client.calls['task.create'] += 1
+        task = dict(task)
+        task['id'] = f"fake{next(self.client.ids)}"
+        task.setdefault('status', 0)
+        self.client.tasks[task['id']] = self.client.stored(task)
+        self.client.kill.wrote('task.create')
+        return copy.deepcopy(task)
+
+    def update(self, task: Dict) -> Dict:
+        self.client.throttle.check()
+        time.sleep(self.client.latency)
+        self.client.calls['task.update'] += 1
+        # the properties not sent are kept
+        task = {**self.client.get(task['id']), **task}
+        self.client.tasks[task['id']] = self.client.stored(task)
+        self.client.kill.wrote('task.update')
+        return copy.deepcopy(task)
+
+    def delete(self, task: Dict) -> Dict:
+        self.client.throttle.check()
+        time.sleep(self.client.latency)
+        self.client.calls['task.delete'] += 1
+        deleted = self.client.tasks.pop(self.client.get(task['id'])['id'])
+        self.client.kill.wrote('task.delete')
+        return deleted
+
+    def complete(self, task: Dict) -> Dict:
+        self.client.throttle.check()
+        time.sleep(self.client.latency)
+        self.client.calls['task.complete'] += 1
+        completed = self.client.tasks.pop(self.client.get(task['id'])['id'])
+        completed['status'] = 2
+        self.client.kill.wrote('task.complete')
+        return completed
+
+    def dates(self, start: datetime, due: datetime = None, tz: str = None) -> Dict:
+        dates = {'startDate': ticktick_date(start)}
+        if due is not None:
+            dates['dueDate'] = ticktick_date(due)
+        return dates
+
+    def builder(self, title: str = '', projectId: str = None, content: str = None, allDay: bool = None,
+                startDate: datetime = None, dueDate: datetime = None, timeZone: str = None, **kwargs) -> Dict:
+        task = {'title': title}
+        if projectId is not None:
+            task['projectId'] = projectId
+        if content is not None:
+            task['content'] = content
+        if allDay is not None:
+            task['isAllDay'] = allDay
+        if startDate is not None:
+            task.update(self.dates(startDate, dueDate, timeZone))
+        if timeZone is not None:
+            task['timeZone'] = timeZone
+        return task
+
+
+class FakeTickTickClient:
+    """TickTick client keeping the tasks in memory"""
+
+    def __init__(self, projects: List[str], tasks: List[Dict] = None, throttle: int = 0, latency: float = 0,
+                 normalize: bool = False):
+        """
+        :param throttle: if given, one of every throttle requests fails as throttled (429 or 503, raised as
+            ticktick_py does)
+        :param latency: seconds each request takes
+        :param normalize: if set, the tasks written are stored as TickTick does (dates with milliseconds and a
+            modifiedTime), which the responses do not show
+        """
+        self.latency = latency
+        self.normalize = normalize
+        self.calls = Counter()
+        self._session = FakeSession()
+        self.throttle = Throttle(self.calls, throttle, statuses=(429, 503), error=self._session.fail)
+        self.kill = KillSwitch()
+        self.ids = itertools.count(1)
+        self.state = {'projects': [{'id': k, 'name': k} for k in projects]}
+        self.tasks = {k['id']: dict(k) for k in tasks or []}
+        self.task = FakeTaskManager(self)
+
+    def stored(self, task: Dict) -> Dict:
+        """Task as stored when written"""
+        task = dict(task)
+        if self.normalize:
+            for key in ('startDate', 'dueDate'):
+                if isinstance(task.get(key, None), str) and '.' not in task[key]:
+                    task[key] = task[key].replace('+', '.000+')
+            task['modifiedTime'] = ticktick_date(datetime.now(timezone.utc)).replace('+', '.000+')
+        return task
+
+    def get(self, task_id: str) -> Dict:
+        if task_id not in self.tasks:
+            raise Exception(f"TickTick task {task_id} not found")
+        return self.tasks[task_id]
+
+    def get_by_id(self, obj_id: str, search: str = None) -> Dict:
+        self.calls['get_by_id'] += 1
+        return copy.deepcopy(self.get(obj_id))
+
+    def sync(self):
+        self.calls['sync'] += 1
+
+    @property
+    def requests(self) -> int:
+        return sum(self.calls.values())
@@ -1,7 +1,12 @@
+import os
 import pickle
+import time
 from ast import literal_eval
 from os import path
-from typing import List
+from typing import List, Callable, Iterable, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
 
 
 def load_dict_from_file(file_name: str):
@@ -17,8 +22,34 @@ def load_dict_from_file(file_name: str):
 def save_dict_to_file(file_name: str, obj: dict):
     # with open(file_name, 'w') as tasks_file:
     #     tasks_file.write(str(obj))
-    with open(file_name, 'wb') as tasks_file:
+    # written to a temporary file first so that a crash does not corrupt the file
+    with open(f"{file_name}.tmp", 'wb') as tasks_file:
         pickle.dump(obj, tasks_file)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+def run_concurrently(fn: Callable[[T], R], items: Iterable[T], max_workers: int, name: str = None) -> List[R]:
+    """
+    Runs fn for each item using a thread pool of up to max_workers threads
+    :return: the results in the same order as the items
+    :param name: if given, prints the time taken compared to running sequentially
+    """
+    # imported here, so that commands that fetch nothing (e.g., --remove_tick) start fast
+    from concurrent.futures import ThreadPoolExecutor
+
+    def timed(item):
+        start_item = time.perf_counter()
+        return fn(item), time.perf_counter() - start_item
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(timed, items))
+    elapsed = time.perf_counter() - start
+    if name is not None and results:
+        sequential = sum(k[1] for k in results)
+        print(f"Fetched {len(results)} {name} in {elapsed:.2f}s "
+              f"(sequential {sequential:.2f}s, speedup x{sequential / max(elapsed, 1e-9):.1f})")
+    return [k[0] for k in results]
 
 
 class BiDict(dict):
@@ -27,12 +58,15 @@ class BiDict(dict):
         self.inverse = {}
         for key, value in self.items():
             self.inverse.setdefault(value, []).append(key)
+        # keys changed since loaded
+        self.changed = set()
 
     def __setitem__(self, key, value):
         if key in self:
             self.inverse[self[key]].remove(key)
         super(BiDict, self).__setitem__(key, value)
         self.inverse.setdefault(value, []).append(key)
+        self.changed.add(key)
 
     def __delitem__(self, key):
         value = self[key]
@@ -40,13 +74,22 @@ class BiDict(dict):
         if value in self.inverse and not self.inverse[value]:
             del self.inverse[value]
         super(BiDict, self).__delitem__(key)
+        self.changed.add(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(BiDict, self).pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
 
     def get_inverse(self, value) -> List:
         return self.inverse[value]
 
     def save(self, file_name: str):
-        with open(file_name, 'w') as tasks_file:
+        with open(f"{file_name}.tmp", 'w') as tasks_file:
             tasks_file.write(str(self))
+        os.replace(f"{file_name}.tmp", file_name)
         # with open(file_name, 'wb') as tasks_file:
         #     pickle.dump(dict(self), tasks_file)
 
@@ -0,0 +1,124 @@
+"""
+Write-ahead journal of the remote writes of a sync. Each insert or delete is appended (and flushed to disk)
+before it is sent and marked as done, with the id of the written task, once the api answers.
+The entries are dropped once the state that includes them is saved, so the entries found on start are
+the writes of an interrupted run
+"""
+
+import json
+import os
+import uuid
+from typing import Dict, List
+
+INSERT = 'insert'
+DELETE = 'delete'
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def new_id() -> str:
+    """Id for a new task or event chosen before writing it (valid as a Google Calendar event id)"""
+    return uuid.uuid4().hex
+
+
+class Journal:
+    """
+    Entries are json lines: the intent ({seq, op, kind, source, target, match, fingerprint}) and later its outcome
+    ({seq, status, target}). Intents are synced to disk before the write is sent; outcomes are only flushed,
+    since a lost outcome is found again when the entry is replayed
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.entries: Dict[int, Dict] = {}
+        if os.path.isfile(file_name):
+            self.entries = self.load(file_name)
+        self.seq = max(self.entries.keys(), default=0)
+        # entries of the interrupted run, resolved when replayed
+        self.interrupted: List[int] = sorted(k for k, v in self.entries.items() if v['status'] != FAILED)
+        self.file = open(file_name, 'a')
+
+    @staticmethod
+    def load(file_name: str) -> Dict[int, Dict]:
+        entries = {}
+        with open(file_name, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be partially written if the process was killed while appending
+                    continue
+                entry = entries.setdefault(record['seq'], {'status': PENDING})
+                entry.update({k: v for k, v in record.items() if v is not None})
+        return entries
+
+    def append(self, record: Dict, sync: bool):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def intend(self, op: str, kind: str, source: str, target: str = None, match: Dict = None,
+               fingerprint: str = None) -> int:
+        """
+        Records a write before sending it
+        :param kind: api written
+        :param source: id of the task of the other api being synced
+        :param target: id of the task written, if known before writing (e.g., chosen with new_id)
+        :param match: properties that identify an inserted task whose id is not known before writing
+        :param fingerprint: fingerprint of the source task written, to know if it changed since
+        :return: sequence number of the entry
+        """
+        self.seq += 1
+        entry = {'seq': self.seq, 'op': op, 'kind': kind, 'source': source, 'target': target, 'match': match,
+                 'fingerprint': fingerprint}
+        self.entries[self.seq] = {**entry, 'status': PENDING}
+        self.append(entry, sync=True)
+        return self.seq
+
+    def done(self, seq: int, target: str = None):
+        entry = self.entries[seq]
+        entry['status'] = DONE
+        if target is not None:
+            entry['target'] = target
+        self.append({'seq': seq, 'status': DONE, 'target': target}, sync=False)
+
+    def failed(self, seq: int):
+        """The api answered with an error, so nothing was written"""
+        self.entries[seq]['status'] = FAILED
+        self.append({'seq': seq, 'status': FAILED}, sync=False)
+
+    def replay(self) -> List[Dict]:
+        """Entries of the interrupted run that wrote something (or may have), oldest first"""
+        return [self.entries[k] for k in list(self.interrupted)]
+
+    def resolve(self, seq: int, written: bool):
+        """The write of the interrupted run was applied to the state (or found not written)"""
+        self.entries[seq]['status'] = DONE if written else FAILED
+        self.interrupted.remove(seq)
+
+    def checkpoint(self):
+        """
+        Drops the entries included in the saved state. Writes still pending (e.g., sent without an answer)
+        are kept to be replayed before the next sync
+        """
+        keep = [v for k, v in sorted(self.entries.items())
+                if v['status'] == PENDING or k in self.interrupted]
+        self.file.close()
+        with open(f"{self.file_name}.tmp", 'w') as journal_file:
+            for entry in keep:
+                journal_file.write(json.dumps(entry) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(f"{self.file_name}.tmp", self.file_name)
+        self.entries = {v['seq']: v for v in keep}
+        self.interrupted = [v['seq'] for v in keep]
+        self.file = open(self.file_name, 'a')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,173 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Tuple, Iterator, Optional
+
+PREFIX = 'ticktick_gcalendar'
+# upper bounds in seconds, from a timezone lookup to a full fetch
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+HELP = {
+    'phase_duration_seconds': ('histogram', "Duration of the phases of a sync"),
+    'api_request_duration_seconds': ('histogram', "Duration of the requests to TickTick and Google Calendar"),
+    'api_requests_total': ('counter', "Requests to TickTick and Google Calendar by endpoint and status"),
+    'items_total': ('counter', "Tasks and events processed by kind and operation"),
+    'api_retries_total': ('counter', "Throttled requests retried after backing off"),
+    'errors_total': ('counter', "Errors caught and skipped during the sync"),
+    'last_run_timestamp_seconds': ('gauge', "Time the last run finished"),
+    'last_run_success': ('gauge', "Whether the last run finished without errors"),
+}
+
+
+class Timer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+
+class Metrics:
+    """
+    Collects latency histograms and counters of a run. Values are cumulative (e.g., over the syncs of the daemon)
+    and can be exported as a Prometheus textfile collector file and as json
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # name -> labels -> [count of each bucket, count, sum]
+        self.histograms: Dict[str, Dict[Labels, list]] = {}
+        # name -> labels -> value
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    @staticmethod
+    def labels(**kwargs) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        key = self.labels(**labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self.labels(**labels)
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[self.labels(**labels)] = value
+
+    @contextlib.contextmanager
+    def time(self, phase: str) -> Iterator[Timer]:
+        """Times a phase of the sync (the elapsed time is set in the yielded timer on exit)"""
+        timer = Timer()
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.perf_counter() - timer.start
+            self.observe('phase_duration_seconds', timer.elapsed, phase=phase)
+
+    @contextlib.contextmanager
+    def call(self, backend: str, endpoint: str) -> Iterator[Timer]:
+        """Times a request and counts it by its status (ok or the name of the exception raised)"""
+        timer = Timer()
+        status = 'ok'
+        try:
+            yield timer
+        except Exception as e:
+            status = type(e).__name__
+            raise e
+        finally:
+            timer.elapsed = time.perf_counter() - timer.start
+            self.observe('api_request_duration_seconds', timer.elapsed, backend=backend, endpoint=endpoint)
+            self.inc('api_requests_total', backend=backend, endpoint=endpoint, status=status)
+
+    def count(self, backend: str, endpoint: str, error: Optional[Exception] = None):
+        """Counts a request that is not timed on its own (e.g., a request of a batch)"""
+        self.inc('api_requests_total', backend=backend, endpoint=endpoint,
+                 status='ok' if error is None else type(error).__name__)
+
+    def items(self, kind: str, operation: str, value: int = 1):
+        if value:
+            self.inc('items_total', value, kind=kind, operation=operation)
+
+    def error(self, e: Exception):
+        self.inc('errors_total', type=type(e).__name__)
+
+    def finish(self, success: bool):
+        self.set('last_run_timestamp_seconds', time.time())
+        self.set('last_run_success', int(success))
+
+    def to_prometheus(self) -> str:
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+        lines = []
+        with self.lock:
+            for name in HELP:
+                kind, description = HELP[name]
+                series = (self.histograms if kind == 'histogram' else
+                          self.counters if kind == 'counter' else self.gauges).get(name, {})
+                if not series:
+                    continue
+                full_name = f"{PREFIX}_{name}"
+                lines.append(f"# HELP {full_name} {description}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for labels, value in sorted(series.items()):
+                    if kind != 'histogram':
+                        lines.append(f"{full_name}{fmt(labels)} {value}")
+                        continue
+                    buckets, count, total = value
+                    for bound, bucket in zip(self.buckets, buckets):
+                        lines.append(f"{full_name}_bucket{fmt(labels, (('le', str(bound)),))} {bucket}")
+                    lines.append(f"{full_name}_bucket{fmt(labels, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{full_name}_sum{fmt(labels)} {total}")
+                    lines.append(f"{full_name}_count{fmt(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict:
+        """Summary of the metrics: count, total and mean time of each histogram and the value of the rest"""
+        def key(labels: Labels) -> str:
+            return ','.join(f"{k}={v}" for k, v in labels)
+
+        with self.lock:
+            summary = {name: {key(labels): {'count': count, 'sum': total, 'mean': total / count if count else 0}
+                              for labels, (_, count, total) in sorted(series.items())}
+                       for name, series in self.histograms.items()}
+            for values in (self.counters, self.gauges):
+                summary.update({name: {key(labels): value for labels, value in sorted(series.items())}
+                                for name, series in values.items()})
+        return summary
+
+    def export(self, prometheus_file: str = None, json_file: str = None):
+        """Writes the metrics files (atomically, so that collectors never read a partial file)"""
+        for file_name, content in ((prometheus_file, self.to_prometheus),
+                                   (json_file, lambda: json.dumps(self.to_dict(), indent=2))):
+            if file_name is None:
+                continue
+            with open(f"{file_name}.tmp", 'w') as metrics_file:
+                metrics_file.write(content())
+            os.replace(f"{file_name}.tmp", file_name)
+
+
+metrics = Metrics()
@@ -0,0 +1,71 @@
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Mapping
+
+
+@dataclass
+class Update:
+    id: str
+    # properties that changed, None if unknown (e.g., the old task was saved without field fingerprints)
+    fields: Optional[List[str]] = None
+
+
+@dataclass
+class ChangePlan:
+    """Changes of the tasks of an api since the last sync, by task id"""
+    added: List[str] = field(default_factory=list)
+    updated: List[Update] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.added) + len(self.updated) + len(self.deleted)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(d: Dict) -> 'ChangePlan':
+        return ChangePlan(added=list(d['added']), updated=[Update(**k) for k in d['updated']],
+                          deleted=list(d['deleted']))
+
+
+def make_plan(tasks: Mapping, old: Mapping, changes: Optional[Mapping] = None) -> ChangePlan:
+    """
+    Diffs the current tasks against the old ones (see Api.Task.differs), in one pass over each map
+    :param changes: if given, only these tasks are diffed (None values for deleted tasks)
+    """
+    plan = ChangePlan()
+    if changes is None:
+        changes = tasks
+        for k in old:
+            if k not in tasks:
+                plan.deleted.append(k)
+
+    for k, task in changes.items():
+        old_task = old.get(k, None)
+        if task is None:
+            if old_task is not None:
+                plan.deleted.append(k)
+        elif old_task is None:
+            plan.added.append(k)
+        elif task.differs(old_task):
+            plan.updated.append(Update(k, task.changed_fields(old_task)))
+    return plan
+
+
+class Planner:
+    """Records the writes of a sync instead of sending them, answering them as the apis would"""
+
+    def __init__(self):
+        self.operations: List[Dict] = []
+
+    def record(self, kind: str, operation: str, task_id: str = None, body: Dict = None) -> Optional[Dict]:
+        """
+        :param operation: insert, update, delete or complete
+        :return: the simulated response (the body with an id for inserts and updates)
+        """
+        self.operations.append({'kind': kind, 'operation': operation, 'id': task_id, 'body': body})
+        if body is None:
+            return None
+        response = dict(body)
+        response.setdefault('id', task_id if task_id is not None else f"planned-{len(self.operations)}")
+        return response
@@ -0,0 +1,275 @@
+"""
+Push mode: instead of polling every calendar, Google Calendar notifies the changes of each watched calendar
+to a webhook (https://developers.google.com/calendar/api/guides/push).
+The notifications (headers without body) are received by a local http server, which the webhook address
+forwards to, and debounced, so that a burst of changes of a calendar is synced at once
+"""
+
+import hmac
+import http.server
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+from journal import new_id
+from metrics import metrics
+
+
+@dataclass
+class Channel:
+    """Watch channel of a calendar"""
+    id: str
+    calendar_id: str
+    resource_id: str
+    # sent back with each notification of the channel, so that forged ones are rejected
+    token: str
+    # seconds since the epoch
+    created: float
+    expiration: float
+    # failed renewals, retried with backoff (the channel keeps notifying until it expires)
+    failures: int = 0
+    retry_at: float = 0.0
+
+    @property
+    def renew_at(self) -> float:
+        """Channels are renewed when 90% of their time has passed"""
+        return max(self.expiration - (self.expiration - self.created) / 10, self.retry_at)
+
+
+class Watcher:
+    """Keeps a watch channel open on each calendar, renewing them before they expire"""
+
+    def __init__(self, api, address: str, ttl: float = 7 * 24 * 3600, clock: Callable[[], float] = time.time,
+                 retry_delay: float = 60.0, max_retry_delay: float = 3600.0):
+        """
+        :param api: Google Calendar api opening and closing the channels (see GCalendarApi.watch)
+        :param address: url Google posts the notifications to
+        :param ttl: seconds requested for the channels (Google may give them less)
+        :param clock: seconds since the epoch, as the expiration of the channels
+        :param retry_delay: seconds before retrying a failed renewal, doubled after each failure up to max_retry_delay
+        """
+        self.api = api
+        self.address = address
+        self.ttl = ttl
+        self.clock = clock
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # open channels by id (read by the threads of the receiver)
+        self.channels: Dict[str, Channel] = {}
+
+    def watch(self, calendar_id: str) -> Channel:
+        now = self.clock()
+        channel = Channel(new_id(), calendar_id, '', new_id(), now, now + self.ttl)
+        # the first message of the channel may arrive before the answer
+        self.channels[channel.id] = channel
+        try:
+            response = self.api.watch(calendar_id, channel.id, self.address, channel.token, self.ttl)
+        except Exception as e:
+            del self.channels[channel.id]
+            raise e
+        channel.resource_id = response['resourceId']
+        if response.get('expiration', None) is not None:
+            channel.expiration = int(response['expiration']) / 1000
+        metrics.items('push', 'watched')
+        return channel
+
+    def start(self, calendar_ids: List[str]):
+        for calendar_id in calendar_ids:
+            self.watch(calendar_id)
+
+    def renew_in(self) -> float:
+        """Seconds until the next channel has to be renewed"""
+        if not self.channels:
+            return math.inf
+        return min(k.renew_at for k in self.channels.values()) - self.clock()
+
+    def renew(self) -> int:
+        """
+        Replaces the channels about to expire. The new channel is opened before the old one is closed,
+        so that no change is missed (changes notified by both are debounced together).
+        If a channel cannot be opened, the old one is kept and its renewal retried later
+        :return: channels renewed
+        """
+        now = self.clock()
+        expiring = [k for k in self.channels.values() if k.renew_at <= now]
+        renewed = 0
+        for channel in expiring:
+            try:
+                self.watch(channel.calendar_id)
+            except Exception as e:
+                channel.failures += 1
+                channel.retry_at = now + min(self.retry_delay * 2 ** (channel.failures - 1), self.max_retry_delay)
+                metrics.error(e)
+                print(f"Channel of {channel.calendar_id} not renewed, retrying in {channel.retry_at - now:.0f}s: {e}")
+                continue
+            self.close(channel)
+            renewed += 1
+        metrics.items('push', 'renewed', renewed)
+        return renewed
+
+    def close(self, channel: Channel):
+        # its notifications are rejected from now on
+        del self.channels[channel.id]
+        try:
+            self.api.stop_watch(channel.id, channel.resource_id)
+        except Exception as e:
+            # it expires anyway
+            print(f"Channel {channel.id} of {channel.calendar_id} not stopped: {e}")
+
+    def stop(self):
+        for channel in list(self.channels.values()):
+            self.close(channel)
+
+    def calendar_of(self, channel_id: Optional[str], token: Optional[str]) -> Optional[str]:
+        """Calendar of an open channel, None if the channel is unknown or the token does not match"""
+        channel = self.channels.get(channel_id, None)
+        if channel is None or token is None or not hmac.compare_digest(channel.token, token):
+            return None
+        return channel.calendar_id
+
+
+class Debouncer:
+    """
+    Keys notified, due once they are not notified for delay seconds (or max_delay after the first notification,
+    so that a key notified non stop is still synced)
+    """
+
+    def __init__(self, delay: float = 5.0, max_delay: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.notified = threading.Event()
+        # first and last notification of each pending key
+        self.pending: Dict[str, Tuple[float, float]] = {}
+
+    def notify(self, key: str):
+        """Called from any thread"""
+        with self.lock:
+            now = self.clock()
+            first, _ = self.pending.get(key, (now, now))
+            self.pending[key] = (first, now)
+        self.notified.set()
+
+    def due_at(self, key: str) -> float:
+        first, last = self.pending[key]
+        return min(last + self.delay, first + self.max_delay)
+
+    def due(self) -> List[str]:
+        """Pops the keys due"""
+        with self.lock:
+            now = self.clock()
+            due = sorted(k for k in self.pending if self.due_at(k) <= now)
+            for k in due:
+                del self.pending[k]
+        return due
+
+    def wait(self, timeout: float) -> List[str]:
+        """Waits until some keys are due or the timeout passes, :return: the keys due"""
+        deadline = self.clock() + timeout
+        while True:
+            # cleared before checking, so that a notification arriving meanwhile is not missed
+            self.notified.clear()
+            due = self.due()
+            now = self.clock()
+            if due or now >= deadline:
+                return due
+            with self.lock:
+                wake = min([deadline] + [self.due_at(k) for k in self.pending])
+            self.notified.wait(max(0.0, wake - now))
+
+
+class NotificationReceiver:
+    """Http server receiving the notifications of the channels, each one in a thread of its own"""
+
+    def __init__(self, host: str, port: int, on_notification: Callable[[Mapping[str, str]], bool]):
+        """
+        :param port: 0 for any free port
+        :param on_notification: called with the headers of each notification, whether it is accepted
+            (otherwise it is answered with 403)
+        """
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', None) or 0)
+                if length:
+                    self.rfile.read(length)
+                try:
+                    accepted = on_notification(self.headers)
+                except Exception as e:
+                    print(f"Notification failed: {e}")
+                    accepted = False
+                self.send_response(200 if accepted else 403)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='notifications', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Push:
+    """Watch channels of the calendars of an api, with the receiver of their notifications and their debouncer"""
+
+    def __init__(self, api, address: str = None, host: str = '127.0.0.1', port: int = 8080, debounce: float = 5.0,
+                 ttl: float = 7 * 24 * 3600, clock: Callable[[], float] = time.time):
+        """
+        :param api: Google Calendar api (see Watcher)
+        :param address: url Google posts the notifications to, forwarded to host and port (Google only posts to
+            https urls of verified domains). By default, the url of the receiver
+        :param debounce: seconds without notifications of a calendar before syncing it
+        """
+        self.api = api
+        self.debouncer = Debouncer(debounce, max_delay=max(60.0, 10 * debounce))
+        self.receiver = NotificationReceiver(host, port, self.notified)
+        self.watcher = Watcher(api, address if address is not None else self.receiver.url, ttl, clock)
+
+    def notified(self, headers: Mapping[str, str]) -> bool:
+        calendar_id = self.watcher.calendar_of(headers.get('X-Goog-Channel-ID', None),
+                                               headers.get('X-Goog-Channel-Token', None))
+        if calendar_id is None:
+            metrics.items('push', 'rejected')
+            return False
+        # the first message of a channel only confirms it was opened
+        if headers.get('X-Goog-Resource-State', None) != 'sync':
+            self.debouncer.notify(calendar_id)
+            metrics.items('push', 'notified')
+        return True
+
+    def start(self):
+        self.receiver.start()
+        self.watcher.start(self.api.calendar_ids)
+
+    def wait(self, timeout: float) -> List[str]:
+        """
+        Waits until some calendars are notified (and debounced) or the timeout passes, renewing the channels
+        :return: the calendars notified
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.watcher.renew()
+            remaining = deadline - time.monotonic()
+            calendar_ids = self.debouncer.wait(max(0.0, min(remaining, self.watcher.renew_in())))
+            if calendar_ids or time.monotonic() >= deadline:
+                return calendar_ids
+
+    def close(self):
+        self.watcher.stop()
+        self.receiver.close()
@@ -0,0 +1,145 @@
+import contextlib
+import random
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+from metrics import metrics
+
+T = TypeVar('T')
+
+# statuses worth retrying: throttled or temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def error_status(e: Exception) -> Optional[int]:
+    """Http status of an error raised by googleapiclient (HttpError) or with a requests response (HTTPError)"""
+    resp = getattr(e, 'resp', None)
+    if resp is not None:
+        return getattr(resp, 'status', None)
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+
+def is_throttled(e: Exception) -> bool:
+    """Whether the request was refused for exceeding a rate limit, i.e., it was not processed"""
+    status = error_status(e)
+    # google answers 403 both for forbidden requests and for (user) rate limits exceeded
+    return status == 429 or (status == 403 and 'ateLimitExceeded' in f"{getattr(e, 'content', '')}{e}")
+
+
+def is_retryable(e: Exception) -> bool:
+    return error_status(e) in RETRY_STATUSES or is_throttled(e)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header of the error response, if any"""
+    headers = getattr(e, 'resp', None)
+    if headers is None:
+        headers = getattr(getattr(e, 'response', None), 'headers', None)
+    value = headers.get('retry-after', None) if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # only needed for the dates in Retry-After, imported here so that it does not slow down the start
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst requests"""
+
+    def __init__(self, rate: Optional[float], burst: float = None, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        """:param rate: requests per second, None for no limit"""
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost: float = 1):
+        """Waits until cost tokens are available (costs above the burst wait for a full bucket)"""
+        if not self.rate:
+            return
+        cost = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class RateLimiter:
+    """
+    Budget of requests of a backend: a token bucket, a cap on the requests in flight and retries with jittered
+    exponential backoff of the throttled requests (honouring Retry-After)
+    """
+
+    def __init__(self, name: str, rate: float = None, burst: float = None, max_in_flight: int = 8, retries: int = 5,
+                 base_delay: float = 1, max_delay: float = 60, sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic, rng: Callable[[], float] = random.random,
+                 shared=None):
+        """
+        :param name: backend name used in the metrics
+        :param rate: requests per second, None for no limit
+        :param shared: semaphore also limiting the requests in flight, shared with other limiters (e.g., of
+            other processes)
+        """
+        self.name = name
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.shared = shared if shared is not None else contextlib.nullcontext()
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.rng = rng
+
+    def should_retry(self, e: Exception, attempt: int, idempotent: bool = True) -> bool:
+        """
+        :param attempt: number of retries already made
+        :param idempotent: if not (e.g., creates), only throttled requests are retried, since a request that
+            failed otherwise may have been done anyway (retrying it would do it twice)
+        """
+        return attempt < self.retries and (is_retryable(e) if idempotent else is_throttled(e))
+
+    def backoff(self, attempt: int, e: Exception) -> float:
+        """Seconds to wait before the next retry (full jitter unless the server says how long)"""
+        metrics.inc('api_retries_total', backend=self.name, status=error_status(e))
+        delay = retry_after(e)
+        if delay is None:
+            delay = self.rng() * min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay
+
+    def call(self, fn: Callable[[], T], cost: float = 1, idempotent: bool = True) -> T:
+        """
+        Calls fn within the budget, retrying it while it is throttled
+        :param cost: number of requests fn makes (e.g., the requests of a batch)
+        :param idempotent: whether fn can be retried after any temporary error (see should_retry)
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            with self.in_flight, self.shared:
+                try:
+                    return fn()
+                except Exception as e:
+                    if not self.should_retry(e, attempt, idempotent):
+                        raise e
+                    error = e
+            self.sleep(self.backoff(attempt, error))
+            attempt += 1
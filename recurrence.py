@@ -0,0 +1,180 @@
+"""
+Recurrence of events and tasks: translation between Google Calendar recurrences (RRULE and EXDATE lines) and
+TickTick repeat rules (repeatFlag and exDate), and cached expansion of the series
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, Optional, Tuple, Iterable
+
+RRULE = 'RRULE:'
+EXDATE = 'EXDATE'
+# format of the excluded dates kept for the series (utc)
+DATE_FORMAT = '%Y%m%dT%H%M%SZ'
+# series expansions cached (a series is expanded once per sync window)
+CACHE_SIZE = 4096
+
+
+def format_date(d: datetime) -> str:
+    return d.astimezone(timezone.utc).strftime(DATE_FORMAT)
+
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def parse_exdate(line: str) -> List[datetime]:
+    """Dates of an EXDATE line (e.g., EXDATE;TZID=Europe/Madrid:20240102T090000), as utc datetimes"""
+    import pytz
+
+    params, _, values = line.partition(':')
+    tz = pytz.UTC
+    for param in params.split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key == 'TZID':
+            tz = pytz.timezone(value)
+    dates = []
+    for value in values.split(','):
+        if value.endswith('Z'):
+            dates.append(parse_date(value))
+        elif 'T' in value:
+            dates.append(tz.localize(datetime.strptime(value, '%Y%m%dT%H%M%S')).astimezone(timezone.utc))
+        else:
+            dates.append(datetime.strptime(value, '%Y%m%d').replace(tzinfo=timezone.utc))
+    return dates
+
+
+def format_exdate(dates: Iterable[datetime], all_day: bool) -> str:
+    if all_day:
+        return f"{EXDATE};VALUE=DATE:{','.join(k.strftime('%Y%m%d') for k in dates)}"
+    return f"{EXDATE}:{','.join(format_date(k) for k in dates)}"
+
+
+def recurrence_to_repeat(recurrence: Optional[List[str]]) -> Tuple[Optional[str], List[datetime]]:
+    """
+    TickTick repeat rule and excluded dates of a Google Calendar recurrence.
+    Recurrences that TickTick cannot represent (several rules, RDATE or EXRULE) have no rule
+    """
+    if not recurrence:
+        return None, []
+    rules = [k for k in recurrence if k.startswith(RRULE)]
+    if len(rules) != 1 or any(k.startswith(('RDATE', 'EXRULE')) for k in recurrence):
+        return None, []
+    ex_dates = sorted(d for k in recurrence if k.startswith(EXDATE) for d in parse_exdate(k))
+    parts = rules[0][len(RRULE):].split(';')
+    if not any(k.startswith('INTERVAL=') for k in parts):
+        parts.insert(1, 'INTERVAL=1')
+    return RRULE + ';'.join(parts), ex_dates
+
+
+def repeat_to_recurrence(repeat: Optional[str], ex_dates: Iterable[datetime], all_day: bool) -> Optional[List[str]]:
+    """Google Calendar recurrence of a TickTick repeat rule (custom TickTick repeats are not translated)"""
+    if not repeat or not repeat.startswith(RRULE):
+        return None
+    recurrence = [repeat]
+    ex_dates = sorted(ex_dates)
+    if ex_dates:
+        recurrence.append(format_exdate(ex_dates, all_day))
+    return recurrence
+
+
+@dataclass(frozen=True)
+class Series:
+    """
+    Recurring event or task. Occurrences are expanded in the local time of the series, so that they keep
+    their time across daylight saving changes, and memoized by series and bounds
+    """
+    rule: str
+    # first occurrence, in local time (naive)
+    start: datetime
+    duration: timedelta
+    # None for all day series (expanded in utc)
+    time_zone: Optional[str] = None
+    # utc
+    ex_dates: Tuple[datetime, ...] = ()
+
+    @staticmethod
+    def create(rule: str, start: datetime, end: datetime, time_zone: Optional[str],
+               ex_dates: Iterable[datetime] = ()) -> 'Series':
+        """:param start: first occurrence (timezone aware)"""
+        import pytz
+        tz = pytz.timezone(time_zone) if time_zone else pytz.UTC
+        return Series(rule, start.astimezone(tz).replace(tzinfo=None), end - start, time_zone,
+                      tuple(sorted(set(ex_dates))))
+
+    @property
+    def finite(self) -> bool:
+        return 'COUNT=' in self.rule or 'UNTIL=' in self.rule
+
+    def to_utc(self, d: datetime) -> datetime:
+        import pytz
+        if self.time_zone is None:
+            return d.replace(tzinfo=timezone.utc)
+        return pytz.timezone(self.time_zone).localize(d).astimezone(timezone.utc)
+
+    def to_local(self, d: datetime) -> datetime:
+        import pytz
+        return d.astimezone(pytz.timezone(self.time_zone) if self.time_zone else pytz.UTC).replace(tzinfo=None)
+
+    def occurrences(self, after: datetime, before: datetime) -> Tuple[datetime, ...]:
+        """Starts (utc) of the occurrences that end after `after` and start before `before`"""
+        return _occurrences(self, after, before)
+
+    def next(self, after: datetime) -> Optional[datetime]:
+        """Start (utc) of the first occurrence ending after `after`, None if the series is over"""
+        return _next(self, after)
+
+    def last_end(self) -> Optional[datetime]:
+        """End (utc) of the last occurrence, None if the series never ends"""
+        return _last_end(self) if self.finite else None
+
+    def overlaps(self, start: datetime, end: Optional[datetime]) -> bool:
+        if end is None:
+            return self.next(start) is not None
+        return len(self.occurrences(start, end)) > 0
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _rule(series: Series):
+    """Rule of a series parsed once (UNTIL is converted to the local time of the series)"""
+    from dateutil.rrule import rrulestr
+
+    parts = []
+    for part in series.rule[len(RRULE):].split(';'):
+        key, _, value = part.partition('=')
+        if key == 'UNTIL' and value.endswith('Z'):
+            value = series.to_local(parse_date(value)).strftime('%Y%m%dT%H%M%S')
+        parts.append(f"{key}={value}")
+    # the rule keeps the occurrences already generated, so expanding it again is cheap
+    return rrulestr(';'.join(parts), dtstart=series.start, cache=True)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _occurrences(series: Series, after: datetime, before: datetime) -> Tuple[datetime, ...]:
+    local = _rule(series).between(series.to_local(after - series.duration), series.to_local(before), inc=True)
+    excluded = set(series.ex_dates)
+    return tuple(k for k in map(series.to_utc, local)
+                 if k not in excluded and k + series.duration > after and k < before)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _next(series: Series, after: datetime) -> Optional[datetime]:
+    rule = _rule(series)
+    excluded = set(series.ex_dates)
+    current = series.to_local(after - series.duration)
+    inclusive = True
+    while True:
+        current = rule.after(current, inc=inclusive)
+        if current is None:
+            return None
+        start = series.to_utc(current)
+        if start not in excluded and start + series.duration > after:
+            return start
+        inclusive = False
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _last_end(series: Series) -> Optional[datetime]:
+    last = _rule(series).before(datetime.max)
+    return series.to_utc(last) + series.duration if last is not None else None
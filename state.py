@@ -0,0 +1,176 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from os import path
+from typing import Dict, Set, Any, Iterable, Iterator, Tuple
+
+from helper import load_dict_from_file, save_dict_to_file, BiDict
+
+
+class StateStore(ABC):
+    """
+    Stores the synchronization state: the tasks synced for each kind of api, the TickTick to Google Calendar ids
+    and other values (e.g., sync tokens). Saved changes are only guaranteed to be stored after commit
+    """
+    # whether tasks can be read by id and in order of id without loading all of them (see stream.StoredTasks)
+    STREAMS = False
+
+    @abstractmethod
+    def load_tasks(self, kind: str) -> Dict[str, Dict]:
+        pass
+
+    def load_tasks_by_id(self, kind: str, ids: Iterable[str]) -> Dict[str, Dict]:
+        """Tasks of the kind with the given ids (those saved)"""
+        tasks = self.load_tasks(kind)
+        return {k: tasks[k] for k in ids if k in tasks}
+
+    def iter_tasks(self, kind: str) -> Iterator[Tuple[str, Dict]]:
+        """Ids and tasks of the kind, sorted by id"""
+        return iter(sorted(self.load_tasks(kind).items()))
+
+    def iter_task_ids(self, kind: str) -> Iterator[str]:
+        """Ids of the tasks of the kind, sorted"""
+        return iter(sorted(self.load_tasks(kind).keys()))
+
+    @abstractmethod
+    def save_tasks(self, kind: str, tasks: Dict[str, Dict], changed: Set[str]):
+        """
+        :param tasks: all the tasks of the kind (only the changed ones if STREAMS)
+        :param changed: ids of the tasks changed (or deleted if not in tasks) since they were loaded
+        """
+        pass
+
+    @abstractmethod
+    def load_bidict(self) -> BiDict:
+        pass
+
+    @abstractmethod
+    def save_bidict(self, bidict: BiDict):
+        """Saves the bidict, only its changed keys are guaranteed to be saved"""
+        pass
+
+    @abstractmethod
+    def load_value(self, key: str) -> Any:
+        pass
+
+    @abstractmethod
+    def save_value(self, key: str, value: Any):
+        pass
+
+    def commit(self):
+        pass
+
+    def migrate(self, source: 'StateStore', kinds: Iterable[str], keys: Iterable[str]):
+        """Copies all the state from another store"""
+        for kind in kinds:
+            tasks = source.load_tasks(kind)
+            self.save_tasks(kind, tasks, set(tasks.keys()))
+        bidict = source.load_bidict()
+        bidict.changed = set(bidict.keys())
+        self.save_bidict(bidict)
+        for key in keys:
+            value = source.load_value(key)
+            if value is not None:
+                self.save_value(key, value)
+        self.commit()
+
+
+class FileStateStore(StateStore):
+    """Keeps the state in pickle files (tasks and values) and a text file (bidict). Files are fully rewritten"""
+
+    def __init__(self, task_files: Dict[str, str], bidict_file: str, value_files: Dict[str, str]):
+        self.task_files = task_files
+        self.bidict_file = bidict_file
+        self.value_files = value_files
+
+    def load_tasks(self, kind: str) -> Dict[str, Dict]:
+        loaded = load_dict_from_file(self.task_files[kind])
+        return {} if loaded is None else loaded
+
+    def save_tasks(self, kind: str, tasks: Dict[str, Dict], changed: Set[str]):
+        save_dict_to_file(self.task_files[kind], tasks)
+
+    def load_bidict(self) -> BiDict:
+        return BiDict.load(self.bidict_file) if path.isfile(self.bidict_file) else BiDict()
+
+    def save_bidict(self, bidict: BiDict):
+        bidict.save(self.bidict_file)
+        bidict.changed.clear()
+
+    def load_value(self, key: str) -> Any:
+        return load_dict_from_file(self.value_files[key])
+
+    def save_value(self, key: str, value: Any):
+        save_dict_to_file(self.value_files[key], value)
+
+
+class SqliteStateStore(StateStore):
+    """
+    Keeps the state in a SQLite database. Only the changed rows are written, and all the changes
+    until commit are written in a single transaction
+    """
+    STREAMS = True
+    # ids looked up per query (SQLite limits the parameters of a query)
+    MAX_IDS = 500
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (kind TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL,
+                                          PRIMARY KEY (kind, id));
+        CREATE TABLE IF NOT EXISTS bidict (ticktick_id TEXT PRIMARY KEY, gcalendar_id TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS bidict_gcalendar_id ON bidict (gcalendar_id);
+        CREATE TABLE IF NOT EXISTS vals (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+
+    def __init__(self, db_file: str):
+        self.connection = sqlite3.connect(db_file)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def load_tasks(self, kind: str) -> Dict[str, Dict]:
+        rows = self.connection.execute("SELECT id, data FROM tasks WHERE kind = ?", (kind,))
+        return {k: json.loads(v) for k, v in rows}
+
+    def load_tasks_by_id(self, kind: str, ids: Iterable[str]) -> Dict[str, Dict]:
+        ids = list(ids)
+        tasks = {}
+        for i in range(0, len(ids), self.MAX_IDS):
+            chunk = ids[i:i + self.MAX_IDS]
+            rows = self.connection.execute(f"SELECT id, data FROM tasks WHERE kind = ? AND id IN "
+                                           f"({','.join('?' * len(chunk))})", (kind, *chunk))
+            tasks.update((k, json.loads(v)) for k, v in rows)
+        return tasks
+
+    def iter_tasks(self, kind: str) -> Iterator[Tuple[str, Dict]]:
+        # a cursor of its own, so that other queries can be run while iterating
+        rows = self.connection.cursor().execute("SELECT id, data FROM tasks WHERE kind = ? ORDER BY id", (kind,))
+        return ((k, json.loads(v)) for k, v in rows)
+
+    def iter_task_ids(self, kind: str) -> Iterator[str]:
+        rows = self.connection.cursor().execute("SELECT id FROM tasks WHERE kind = ? ORDER BY id", (kind,))
+        return (k for k, in rows)
+
+    def save_tasks(self, kind: str, tasks: Dict[str, Dict], changed: Set[str]):
+        self.connection.executemany("INSERT OR REPLACE INTO tasks (kind, id, data) VALUES (?, ?, ?)",
+                                    [(kind, k, json.dumps(dict(tasks[k]), default=str))
+                                     for k in changed if k in tasks])
+        self.connection.executemany("DELETE FROM tasks WHERE kind = ? AND id = ?",
+                                    [(kind, k) for k in changed if k not in tasks])
+
+    def load_bidict(self) -> BiDict:
+        return BiDict(self.connection.execute("SELECT ticktick_id, gcalendar_id FROM bidict"))
+
+    def save_bidict(self, bidict: BiDict):
+        self.connection.executemany("INSERT OR REPLACE INTO bidict (ticktick_id, gcalendar_id) VALUES (?, ?)",
+                                    [(k, bidict[k]) for k in bidict.changed if k in bidict])
+        self.connection.executemany("DELETE FROM bidict WHERE ticktick_id = ?",
+                                    [(k,) for k in bidict.changed if k not in bidict])
+        bidict.changed.clear()
+
+    def load_value(self, key: str) -> Any:
+        row = self.connection.execute("SELECT value FROM vals WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save_value(self, key: str, value: Any):
+        self.connection.execute("INSERT OR REPLACE INTO vals (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def commit(self):
+        self.connection.commit()
@@ -0,0 +1,157 @@
+"""
+Streaming diff for big accounts: the current tasks are read page by page and compared with the tasks saved in
+the state store, read by id, so only a page of tasks and the changes are kept in memory.
+The ids seen are spilled to disk in sorted runs that are merged with the (sorted) ids of the store to find
+the tasks deleted
+"""
+
+import heapq
+import os
+import tempfile
+from collections.abc import MutableMapping
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Type
+
+from state import StateStore
+
+
+class StoredTasks(MutableMapping):
+    """
+    Tasks of a kind saved in the store, read from it when needed (so not kept in memory) with the changes made
+    since kept in memory on top of them (a None change is a deleted task). Iterated in order of id
+    """
+
+    def __init__(self, store: StateStore, kind: str, task_class: Type[dict],
+                 changes: Dict[str, Optional[Dict]] = None):
+        """:param task_class: class of the tasks, with a from_snapshot class method (see Api.Task)"""
+        self.store = store
+        self.kind = kind
+        self.task_class = task_class
+        self.changes = dict(changes) if changes is not None else {}
+
+    def __getitem__(self, key: str):
+        if key in self.changes:
+            task = self.changes[key]
+        else:
+            snapshot = self.store.load_tasks_by_id(self.kind, [key]).get(key, None)
+            task = self.task_class.from_snapshot(snapshot) if snapshot is not None else None
+        if task is None:
+            raise KeyError(key)
+        return task
+
+    def __contains__(self, key) -> bool:
+        if key in self.changes:
+            return self.changes[key] is not None
+        return bool(self.store.load_tasks_by_id(self.kind, [key]))
+
+    def __setitem__(self, key: str, task: Dict):
+        self.changes[key] = task
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.changes[key] = None
+
+    def __iter__(self) -> Iterator[str]:
+        # the ids of the store and the changed ones, both sorted, without the deleted ones
+        for key, _ in groupby(heapq.merge(self.store.iter_task_ids(self.kind), sorted(self.changes.keys()))):
+            if self.changes.get(key, True) is not None:
+                yield key
+
+    def items(self) -> Iterator:
+        """Ids and tasks, reading the saved ones one at a time"""
+        changed = iter(sorted(self.changes.keys()))
+        pending = next(changed, None)
+        for key, snapshot in self.store.iter_tasks(self.kind):
+            while pending is not None and pending < key:
+                if self.changes[pending] is not None:
+                    yield pending, self.changes[pending]
+                pending = next(changed, None)
+            if pending == key:
+                pending = next(changed, None)
+                if self.changes[key] is not None:
+                    yield key, self.changes[key]
+                continue
+            yield key, self.task_class.from_snapshot(snapshot)
+        while pending is not None:
+            if self.changes[pending] is not None:
+                yield pending, self.changes[pending]
+            pending = next(changed, None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def write_run(directory: str, ids: List[str]) -> str:
+    """Writes sorted ids to a file of the directory, one per line"""
+    fd, file_name = tempfile.mkstemp(dir=directory, suffix='.run')
+    with os.fdopen(fd, 'w') as run:
+        for k in sorted(ids):
+            run.write(k + '\n')
+    return file_name
+
+
+def read_run(file_name: str) -> Iterator[str]:
+    with open(file_name, 'r') as run:
+        for line in run:
+            yield line[:-1]
+
+
+def missing_ids(expected: Iterator[str], seen: Iterator[str]) -> Iterator[str]:
+    """Ids of expected not in seen, both sorted"""
+    current = next(seen, None)
+    for key in expected:
+        while current is not None and current < key:
+            current = next(seen, None)
+        if current != key:
+            yield key
+
+
+def missing_keys(keys: Iterable[str], tasks: Mapping) -> Set[str]:
+    """
+    Keys not in tasks. For stored tasks, their ids are read in one sorted pass (see missing_ids) instead of
+    looking up each key in the store
+    """
+    if isinstance(tasks, StoredTasks):
+        return set(missing_ids(iter(sorted(keys)), iter(tasks)))
+    return {k for k in keys if k not in tasks}
+
+
+def diff_pages(pages: Iterable[Dict[str, Dict]], store: StateStore, kind: str, task_class: Type[dict],
+               keep: Callable[[Dict, bool], bool] = None, snapshot_properties: List[str] = None) \
+        -> Dict[str, Optional[Dict]]:
+    """
+    Changes of the current tasks, given page by page, since the tasks saved in the store
+    :param keep: whether a current task is synced, given whether it was saved (e.g., in the sync window)
+    :param snapshot_properties: properties of the saved tasks, those saved without some of them are saved again
+    :return: the added and updated tasks, and None for the saved tasks not in any page
+    """
+    changes = {}
+    with tempfile.TemporaryDirectory() as directory:
+        runs = []
+        for page in pages:
+            saved = store.load_tasks_by_id(kind, page.keys())
+            seen, stale = [], {}
+            for k, task in page.items():
+                snapshot = saved.get(k, None)
+                if keep is not None and not keep(task, snapshot is not None):
+                    continue
+                seen.append(k)
+                if snapshot is None:
+                    changes[k] = task
+                    continue
+                old = task_class.from_snapshot(snapshot)
+                if task.differs(old):
+                    changes[k] = task
+                elif snapshot_properties is not None and any(p in task and p not in snapshot
+                                                             for p in snapshot_properties):
+                    task.written = old.written
+                    stale[k] = task.snapshot(snapshot_properties)
+            if stale:
+                store.save_tasks(kind, stale, set(stale.keys()))
+            if seen:
+                runs.append(write_run(directory, seen))
+        seen = heapq.merge(*(read_run(k) for k in runs))
+        for k in missing_ids(store.iter_task_ids(kind), seen):
+            changes[k] = None
+    return changes
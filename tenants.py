@@ -0,0 +1,115 @@
+"""
+Multi-account runs: each tenant is a directory with its own account_info.py, tokens and state (data/).
+Tenants are synced in a process pool, sharing a limit of requests in flight per backend
+"""
+
+import multiprocessing
+import os
+import runpy
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Callable, Optional
+
+ACCOUNT_FILE = 'account_info.py'
+ACCOUNT_KEYS = ('GOOGLE', 'GOOGLE_INFO', 'TICKTICK', 'TICKTICK_INFO')
+
+# semaphores shared by the processes of the pool, by backend (set in each worker)
+_shared_limits: Dict[str, object] = {}
+
+
+@dataclass
+class Tenant:
+    name: str
+    # directory with the account information, where the tenant runs (relative paths are relative to it)
+    directory: str
+    account: Dict[str, Dict]
+
+
+@dataclass
+class TenantResult:
+    name: str
+    success: bool
+    elapsed: float
+    error: Optional[str] = None
+    # seconds spent in each phase of the sync
+    phases: Dict[str, float] = field(default_factory=dict)
+
+
+def load_account(file_name: str) -> Dict[str, Dict]:
+    """Account information (GOOGLE, GOOGLE_INFO, TICKTICK and TICKTICK_INFO) of an account_info.py file"""
+    config = runpy.run_path(file_name)
+    missing = [k for k in ACCOUNT_KEYS if k not in config]
+    if missing:
+        raise ValueError(f"{file_name} is missing {', '.join(missing)}")
+    return {k: config[k] for k in ACCOUNT_KEYS}
+
+
+def load_tenants(directory: str) -> List[Tenant]:
+    """Tenants of the subdirectories of directory that have an account_info.py, sorted by name"""
+    tenants = []
+    for name in sorted(os.listdir(directory)):
+        tenant_dir = os.path.abspath(os.path.join(directory, name))
+        account_file = os.path.join(tenant_dir, ACCOUNT_FILE)
+        if os.path.isfile(account_file):
+            tenants.append(Tenant(name, tenant_dir, load_account(account_file)))
+    return tenants
+
+
+def shared_limit(backend: str):
+    """Semaphore limiting the requests in flight to the backend across the pool, None if not limited"""
+    return _shared_limits.get(backend, None)
+
+
+def _init_worker(limits: Dict[str, object]):
+    _shared_limits.update(limits)
+
+
+def _run_tenant(fn: Callable[[Tenant], Dict[str, float]], tenant: Tenant) -> TenantResult:
+    """Runs fn in the directory of the tenant, catching its errors so that they are reported with the rest"""
+    start = time.perf_counter()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tenant.directory)
+        phases = fn(tenant)
+        return TenantResult(tenant.name, True, time.perf_counter() - start, phases=phases or {})
+    except Exception as e:
+        traceback.print_exc()
+        return TenantResult(tenant.name, False, time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+    finally:
+        os.chdir(cwd)
+
+
+def run_tenants(fn: Callable[[Tenant], Dict[str, float]], tenants: List[Tenant], processes: int,
+                max_in_flight: Dict[str, int] = None) -> List[TenantResult]:
+    """
+    Runs fn for each tenant in a pool of processes. A tenant failing or taking long does not stop the rest
+    :param fn: syncs a tenant and returns the seconds of each phase (must be picklable, i.e., module level)
+    :param max_in_flight: requests in flight allowed to each backend by all the processes together
+    :return: the results sorted by tenant name
+    """
+    limits = {k: multiprocessing.BoundedSemaphore(v) for k, v in (max_in_flight or {}).items() if v}
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, min(processes, len(tenants) or 1)), initializer=_init_worker,
+                             initargs=(limits,)) as executor:
+        futures = {executor.submit(_run_tenant, fn, k): k for k in tenants}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker died (e.g., killed), the rest of tenants are still run
+                result = TenantResult(futures[future].name, False, 0.0, error=f"{type(e).__name__}: {e}")
+            print(f"Tenant {result.name}: {'ok' if result.success else 'failed'} in {result.elapsed:.2f}s")
+            results.append(result)
+    return sorted(results, key=lambda k: k.name)
+
+
+def print_report(results: List[TenantResult]):
+    """Prints the time of each tenant (and of its slowest phases) and the errors"""
+    for result in results:
+        phases = ', '.join(f"{k} {v:.2f}s" for k, v in sorted(result.phases.items(), key=lambda k: -k[1])[:3])
+        status = 'ok' if result.success else f"FAILED ({result.error})"
+        print(f"  {result.name:<24}{result.elapsed:>8.2f}s  {status}{f'  [{phases}]' if phases else ''}")
+    failed = sum(not k.success for k in results)
+    print(f"{len(results) - failed} tenants synced, {failed} failed")
@@ -0,0 +1,69 @@
+"""
+The sync runs against the in-memory fakes of the apis (see fakes.py), with account_info_example as the account
+information, as in benchmark.py
+"""
+
+import sys
+from argparse import Namespace
+from datetime import datetime, timedelta
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+from fakes import ticktick_date  # noqa: E402
+from state import SqliteStateStore  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def script() -> dict:
+    """Globals of ticktick-gcalendar.py"""
+    return benchmark.load_script()
+
+
+@pytest.fixture
+def event():
+    """Factory of confirmed one hour events, days from now (utc)"""
+    def create(event_id: str, summary: str = None, days: int = 10) -> dict:
+        start = datetime.utcnow().replace(microsecond=0) + timedelta(days=days)
+        return {'id': event_id, 'summary': summary if summary is not None else event_id, 'status': 'confirmed',
+                'start': {'dateTime': start.isoformat() + 'Z', 'timeZone': 'UTC'},
+                'end': {'dateTime': (start + timedelta(hours=1)).isoformat() + 'Z', 'timeZone': 'UTC'}}
+    return create
+
+
+@pytest.fixture
+def task():
+    """Factory of TickTick tasks of one hour, days from now (utc)"""
+    def create(task_id: str, title: str = None, days: int = 10, project_id: str = 'work') -> dict:
+        start = datetime.utcnow().replace(microsecond=0) + timedelta(days=days)
+        return {'id': task_id, 'projectId': project_id, 'title': title if title is not None else task_id,
+                'isAllDay': False, 'status': 0, 'timeZone': 'UTC', 'startDate': ticktick_date(start),
+                'dueDate': ticktick_date(start + timedelta(hours=1))}
+    return create
+
+
+@pytest.fixture
+def args():
+    """Factory of the command line arguments of a sync, plain by default"""
+    def create(**kwargs) -> Namespace:
+        return Namespace(**{'incremental': False, 'batch': False, 'window_past': None, 'window_future': None,
+                            **kwargs})
+    return create
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteStateStore(str(tmp_path / 'state.sqlite'))
+    yield store
+    store.connection.close()
+
+
+@pytest.fixture
+def sync(script, store, args):
+    """Runs a sync of the fake accounts given, as main() does"""
+    def run(service, client, sync_args: Namespace = None, **kwargs):
+        return benchmark.run_sync_cycle(script, service, client, store, sync_args or args(), **kwargs)
+    return run
@@ -0,0 +1,30 @@
+from fakes import FakeCalendarService, FakeTickTickClient
+from ratelimit import RateLimiter, error_status
+
+
+def test_writes_are_sent_in_batches_of_max_size(sync, args, task):
+    service = FakeCalendarService({})
+    client = FakeTickTickClient(['work', 'from_google'], [task(f"task{k}", f"Task {k}") for k in range(120)])
+    sync(service, client, args(batch=True))
+
+    assert service.calls['batch'] == 3 and service.calls['events.insert'] == 120
+    assert len(service.calendars['from_ticktick']) == 120
+
+
+def test_errors_of_a_request_do_not_fail_the_rest_of_its_batch(script, event):
+    # the third request is throttled
+    service = FakeCalendarService({'cal1': [event('event1')]}, throttle=3)
+    sleeps = []
+    batch = script['GCalendarBatch'](service, RateLimiter('gcalendar', sleep=sleeps.append))
+    events = service.events()
+    done, errors = [], []
+    batch.add('events.insert', events.insert(calendarId='cal1', body=event('event2')), done.append, errors.append)
+    batch.add('events.delete', events.delete(calendarId='cal1', eventId='missing'), done.append, errors.append)
+    batch.add('events.delete', events.delete(calendarId='cal1', eventId='event1'), done.append, errors.append)
+    batch.execute()
+
+    assert [error_status(k) for k in errors] == [404]
+    assert len(done) == 2 and service.calls['throttled'] == 1
+    # the throttled request is sent again in a batch of its own, after waiting as long as the Retry-After says
+    assert service.calls['batch'] == 2 and sleeps == [0.0]
+    assert service.calendars['cal1']['event1']['status'] == 'cancelled'
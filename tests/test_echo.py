@@ -0,0 +1,36 @@
+from fakes import FakeCalendarService, FakeTickTickClient
+
+
+def test_user_change_back_to_a_write_of_the_sync_is_synced(sync, store, event):
+    # events of the calendar TickTick syncs to, so that the changes in TickTick are synced back to them
+    service = FakeCalendarService({'from_ticktick': [event('event1', "A")]})
+    client = FakeTickTickClient(['work', 'from_google'], normalize=True)
+    sync(service, client)
+    task_id = store.load_bidict().get_inverse('event1')[0]
+
+    service.changed('from_ticktick', {**service.calendars['from_ticktick']['event1'], 'summary': "B"})
+    sync(service, client)
+    assert client.tasks[task_id]['title'] == "B"
+
+    client.tasks[task_id]['title'] = "C"
+    sync(service, client)
+    assert service.calendars['from_ticktick']['event1']['summary'] == "C"
+
+    # the task is as the sync wrote it before, but it was changed since: it is not an echo of that write
+    client.tasks[task_id]['title'] = "B"
+    sync(service, client)
+    assert service.calendars['from_ticktick']['event1']['summary'] == "B"
+    sync(service, client)
+    assert service.calendars['from_ticktick']['event1']['summary'] == "B"
+    assert client.tasks[task_id]['title'] == "B"
+
+
+def test_echoes_of_the_writes_are_not_synced_back(sync, event):
+    service = FakeCalendarService({'from_ticktick': [event('event1', "A")]})
+    client = FakeTickTickClient(['work', 'from_google'], normalize=True)
+    sync(service, client)
+    sync(service, client)
+    writes = service.calls.copy(), client.calls.copy()
+    sync(service, client)
+    assert sum((service.calls - writes[0]).values()) == 3  # the lists of the calendars
+    assert dict(client.calls - writes[1]) == {'task.get_from_project': 2}
@@ -0,0 +1,39 @@
+import threading
+import time
+
+import pytest
+
+from engine import AsyncEngine, ThreadEngine
+
+
+@pytest.mark.parametrize('engine_class', [AsyncEngine, ThreadEngine])
+def test_writes_with_the_same_key_are_sent_and_answered_in_order(engine_class):
+    engine = engine_class(workers=8)
+    lock = threading.Lock()
+    sending, overlapped, answered = set(), [], []
+
+    def write(key: str, seq: int):
+        def send():
+            with lock:
+                if key in sending:
+                    overlapped.append(key)
+                sending.add(key)
+            # the later writes are faster, so they would be answered first if they were not kept in order
+            time.sleep(0.005 * (8 - seq))
+            with lock:
+                sending.discard(key)
+            if seq == 4:
+                raise ValueError("failed")
+            return seq
+        return send
+
+    for seq in range(8):
+        key = 'ab'[seq % 2]
+        engine.submit(key, write(key, seq), lambda result, key=key: answered.append((key, result)),
+                      lambda e, key=key: answered.append((key, str(e))))
+    engine.flush()
+    engine.close()
+
+    assert not overlapped
+    assert [k for key, k in answered if key == 'a'] == [0, 2, "failed", 6]
+    assert [k for key, k in answered if key == 'b'] == [1, 3, 5, 7]
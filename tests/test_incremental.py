@@ -0,0 +1,52 @@
+from fakes import FakeCalendarService, FakeTickTickClient
+
+SYNC_TOKENS = 'gcalendar_sync_tokens'
+
+
+def titles(client) -> list:
+    return sorted(k['title'] for k in client.tasks.values())
+
+
+def test_expired_sync_tokens_fall_back_to_a_full_fetch(sync, store, args, event):
+    service = FakeCalendarService({'cal1': [event('a')]})
+    client = FakeTickTickClient(['work', 'from_google'])
+    sync(service, client, args(incremental=True))
+    tokens = store.load_value(SYNC_TOKENS)
+    assert set(tokens) == {'cal1', 'cal2', 'from_ticktick'}
+
+    service.expire_sync_tokens()
+    service.changed('cal1', event('b'))
+    lists = service.calls['events.list']
+    sync(service, client, args(incremental=True))
+    # lists with the expired tokens, and then every calendar listed in full
+    assert service.calls['events.list'] - lists >= 1 + 3 and titles(client) == ['a', 'b']
+    assert all(int(v) > service.expired_version for v in store.load_value(SYNC_TOKENS).values())
+
+    # the tokens given by the full fetch are used from then on
+    service.changed('cal1', event('c'))
+    lists = service.calls['events.list']
+    sync(service, client, args(incremental=True))
+    assert service.calls['events.list'] - lists == 3 and titles(client) == ['a', 'b', 'c']
+
+
+def test_sync_tokens_are_held_back_until_the_changes_are_synced(sync, store, args, event):
+    service = FakeCalendarService({'cal1': [event('a')]})
+    client = FakeTickTickClient(['work', 'from_google'])
+    sync(service, client, args(incremental=True))
+    tokens = store.load_value(SYNC_TOKENS)
+
+    create = client.task.create
+
+    def failed(task):
+        raise client._session.fail(400, "Bad Request")
+
+    service.changed('cal1', event('b'))
+    client.task.create = failed
+    sync(service, client, args(incremental=True))
+    # the change of cal1 is fetched again by the next sync, the other calendars move on
+    saved = store.load_value(SYNC_TOKENS)
+    assert saved['cal1'] == tokens['cal1'] and saved['cal2'] != tokens['cal2']
+
+    client.task.create = create
+    sync(service, client, args(incremental=True))
+    assert titles(client) == ['a', 'b'] and store.load_value(SYNC_TOKENS)['cal1'] != tokens['cal1']
@@ -0,0 +1,68 @@
+import pytest
+
+import benchmark
+from fakes import FakeCalendarService, FakeTickTickClient, Killed, KillSwitch
+from journal import DELETE, INSERT, Journal
+
+
+@pytest.mark.parametrize('kind', ['gcalendar', 'ticktick'])
+def test_inserts_sent_without_answer_are_found(sync, store, event, task, tmp_path, kind):
+    # Google Calendar events are looked up by the id chosen before inserting them, TickTick tasks by their
+    # title, project and start
+    if kind == 'gcalendar':
+        service, client = FakeCalendarService({}), FakeTickTickClient(['work', 'from_google'], [task('a')])
+    else:
+        service, client = FakeCalendarService({'cal1': [event('a')]}), FakeTickTickClient(['work', 'from_google'])
+    journal_file = str(tmp_path / 'journal.log')
+    # killed once the insert is done, before its answer
+    service.kill = client.kill = KillSwitch(1)
+    with pytest.raises(Killed):
+        sync(service, client, journal=Journal(journal_file))
+    service.kill.writes = None
+
+    journal = Journal(journal_file)
+    [entry] = journal.replay()
+    assert entry['op'] == INSERT and entry['kind'] == kind
+    sync(service, client, journal=journal)
+
+    events = service.calendars['from_ticktick'] if kind == 'gcalendar' else service.calendars['cal1']
+    assert len(events) == 1 and len(client.tasks) == 1
+    assert service.calls['events.insert'] + client.calls['task.create'] == 1
+    assert store.load_bidict() == {next(iter(client.tasks)): next(iter(events))} and len(journal) == 0
+
+
+def test_deletes_done_but_not_saved_are_not_sent_again(script, store, event, args, tmp_path):
+    service = FakeCalendarService({'cal1': [event('a')]})
+    client = FakeTickTickClient(['work', 'from_google'])
+    benchmark.run_sync_cycle(script, service, client, store, args())
+    service.removed('cal1', 'a')
+
+    # killed after the delete was answered, before the state was saved
+    journal_file = str(tmp_path / 'journal.log')
+    unsaved = {**script, 'save_state': lambda *state: None}
+    benchmark.run_sync_cycle(unsaved, service, client, store, args(), journal=Journal(journal_file))
+    assert not client.tasks and client.calls['task.delete'] + client.calls['task.complete'] == 1
+
+    journal = Journal(journal_file)
+    [entry] = journal.replay()
+    assert entry['op'] == DELETE and entry['status'] == 'done'
+    benchmark.run_sync_cycle(script, service, client, store, args(), journal=journal)
+    assert client.calls['task.delete'] + client.calls['task.complete'] == 1
+    assert store.load_bidict() == {} and len(journal) == 0
+
+
+def test_checkpoints_keep_the_pending_writes(tmp_path):
+    journal_file = str(tmp_path / 'journal.log')
+    journal = Journal(journal_file)
+    done = journal.intend(INSERT, 'gcalendar', 'a', 'event-a')
+    failed = journal.intend(INSERT, 'gcalendar', 'b', 'event-b')
+    pending = journal.intend(DELETE, 'ticktick', 'c', 'task-c')
+    journal.done(done)
+    journal.failed(failed)
+    journal.checkpoint()
+    journal.close()
+
+    journal = Journal(journal_file)
+    assert [(k['seq'], k['status']) for k in journal.replay()] == [(pending, 'pending')]
+    # the sequence goes on after the entries kept
+    assert journal.intend(INSERT, 'gcalendar', 'd') == pending + 1
@@ -0,0 +1,29 @@
+import benchmark
+from fakes import FakeCalendarService, FakeTickTickClient
+from plan import Planner, make_plan
+
+
+def test_plan_of_full_tasks_and_snapshots(script, event):
+    task_class = script['GCalendarApi'].Task
+    old = {k: task_class(event(k, k)) for k in ('a', 'b', 'c')}
+    current = {k: task_class(event(k, k)) for k in ('a', 'd')}
+    current['b'] = task_class(event('b', 'changed'))
+    snapshots = {k: task_class.from_snapshot(v.snapshot(['id'])) for k, v in old.items()}
+
+    for saved in (old, snapshots):
+        plan = make_plan(current, saved)
+        assert plan.added == ['d'] and plan.deleted == ['c']
+        assert [(k.id, k.fields) for k in plan.updated] == [('b', ['summary'])]
+
+
+
+def test_round_trips_are_only_saved_by_real_writes(script, store, args, task):
+    client = FakeTickTickClient(['work', 'from_google'])
+    tick, _ = benchmark.open_apis(script, FakeCalendarService({}), client, store, args())
+    tick.planner = Planner()
+    tick.insert(script['TickTickApi'].Task(task('a')))
+    assert tick.round_trips_saved == 0 and len(tick.planner.operations) == 1
+
+    tick.planner = None
+    tick.insert(script['TickTickApi'].Task(task('b')))
+    assert tick.round_trips_saved == 1 and client.calls['get_by_id'] == 0
@@ -0,0 +1,68 @@
+import benchmark
+from fakes import FakeCalendarService, FakeNotifier, FakeTickTickClient
+from push import Push, Watcher
+
+
+class FlakyApi:
+    """Opens channels, failing the given number of times first"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.stopped = []
+
+    def watch(self, calendar_id, channel_id, address, token, ttl):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("transient")
+        return {'resourceId': f"resource-{channel_id}"}
+
+    def stop_watch(self, channel_id, resource_id):
+        self.stopped.append(channel_id)
+
+
+def test_failed_renewals_keep_the_channel_and_are_retried_with_backoff():
+    now = [0.0]
+    api = FlakyApi(0)
+    watcher = Watcher(api, 'https://example.com', ttl=1000, clock=lambda: now[0], retry_delay=10)
+    channel = watcher.watch('cal1')
+
+    api.failures = 2
+    now[0] = 900
+    assert watcher.renew() == 0
+    assert list(watcher.channels.values()) == [channel] and watcher.renew_in() == 10
+    now[0] = 910
+    assert watcher.renew() == 0
+    assert watcher.renew_in() == 20
+
+    now[0] = 930
+    assert watcher.renew() == 1
+    assert api.stopped == [channel.id]
+    assert [k.calendar_id for k in watcher.channels.values()] == ['cal1'] and watcher.renew_in() == 900
+
+
+def test_notifications_are_checked_and_debounced(script, store, args, event):
+    service = FakeCalendarService({'cal1': [event('a')]})
+    service.notifier = notifier = FakeNotifier()
+    _, gtasks = benchmark.open_apis(script, service, FakeTickTickClient(['work', 'from_google']), store,
+                                    args(incremental=True))
+    push = Push(gtasks, port=0, debounce=0.1)
+    push.start()
+    try:
+        # the first message of each channel is accepted, but only confirms it was opened
+        assert notifier.states['sync'] == 3 and notifier.statuses[200] == 3
+        assert push.wait(0.3) == []
+
+        for k in ('b', 'c', 'd'):
+            service.changed('cal1', event(k))
+        # the burst of notifications of cal1 is synced once
+        assert push.wait(5) == ['cal1'] and push.wait(0.3) == []
+        assert notifier.states['exists'] == 3
+
+        [channel] = [k for k in service.watches.values() if k['calendarId'] == 'cal2']
+        assert notifier.post(channel, token='forged') == 403
+        assert notifier.post({**channel, 'id': 'unknown'}) == 403
+        assert notifier.post(channel) == 200
+        assert push.wait(5) == ['cal2']
+        assert notifier.statuses[403] == 2
+    finally:
+        push.close()
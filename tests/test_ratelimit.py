@@ -0,0 +1,81 @@
+import pytest
+
+import benchmark
+from fakes import FakeCalendarService, FakeHttpError, FakeTickTickClient
+from journal import Journal
+from ratelimit import RateLimiter, error_status, is_retryable
+
+
+def test_throttled_ticktick_requests_are_retried(sync, event):
+    service = FakeCalendarService({'cal1': [event(f"event{k}", f"Event {k}") for k in range(3)]})
+    # every other request fails, alternating 429 and 503
+    client = FakeTickTickClient(['work', 'from_google'], throttle=2)
+    sleeps = []
+    limiters = {'ticktick': RateLimiter('ticktick', sleep=sleeps.append, rng=lambda: 0.5)}
+    sync(service, client, limiters=limiters)
+
+    # the create that failed with 503 may have been done, so it is left for the next sync instead of retried
+    assert client.calls['throttled'] == 3 and len(sleeps) == 2
+    assert sorted(k['title'] for k in client.tasks.values()) == ["Event 1", "Event 2"]
+    client.throttle.every = 0
+    sync(service, client, limiters=limiters)
+    assert sorted(k['title'] for k in client.tasks.values()) == ["Event 0", "Event 1", "Event 2"]
+
+
+def test_ticktick_errors_keep_their_status(script, store, args):
+    client = FakeTickTickClient(['work', 'from_google'])
+    tick, _ = benchmark.open_apis(script, FakeCalendarService({}), client, store, args())
+    calls = []
+
+    def not_found():
+        calls.append(1)
+        raise client._session.fail(404, "Not Found")
+
+    def failed():
+        raise RuntimeError("other")
+
+    with pytest.raises(script['TickTickError']) as error:
+        tick.call('task.update', not_found)
+    assert error_status(error.value) == 404 and not is_retryable(error.value) and len(calls) == 1
+    # errors without a response are raised as they are
+    with pytest.raises(RuntimeError, match="^other$"):
+        tick.call('task.update', failed)
+
+
+def test_only_throttled_creates_are_retried():
+    sleeps = []
+    limiter = RateLimiter('gcalendar', sleep=sleeps.append, rng=lambda: 0.5)
+
+    def failing(*statuses):
+        errors = [FakeHttpError(k, "error") for k in statuses]
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+        return request
+
+    assert limiter.call(failing(429, 503)) == 'done' and len(sleeps) == 2
+    assert limiter.call(failing(429), idempotent=False) == 'done' and len(sleeps) == 3
+    with pytest.raises(FakeHttpError) as error:
+        limiter.call(failing(503), idempotent=False)
+    assert error_status(error.value) == 503 and len(sleeps) == 3
+
+
+def test_creates_failing_after_being_done_are_not_duplicated(sync, event, tmp_path):
+    service = FakeCalendarService({'cal1': [event('event1')]})
+    client = FakeTickTickClient(['work', 'from_google'])
+    create = client.task.create
+
+    def create_and_fail(task):
+        create(task)
+        raise client._session.fail(503, "Service Unavailable")
+
+    client.task.create = create_and_fail
+    sync(service, client, journal=Journal(str(tmp_path / 'journal.log')))
+    assert len(client.tasks) == 1 and client.calls['task.create'] == 1
+
+    # the next run finds the task created instead of creating it again
+    client.task.create = create
+    sync(service, client, journal=Journal(str(tmp_path / 'journal.log')))
+    assert len(client.tasks) == 1 and client.calls['task.create'] == 1
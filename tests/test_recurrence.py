@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+from fakes import FakeCalendarService, FakeTickTickClient
+from recurrence import Series, recurrence_to_repeat, repeat_to_recurrence
+
+MADRID = pytz.timezone('Europe/Madrid')
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def madrid(*args) -> datetime:
+    return MADRID.localize(datetime(*args))
+
+
+def test_recurrences_are_translated_to_repeats_and_back():
+    rule, ex_dates = recurrence_to_repeat(['RRULE:FREQ=WEEKLY;BYDAY=MO',
+                                           'EXDATE;TZID=Europe/Madrid:20240108T100000,20240115T100000'])
+    assert rule == 'RRULE:FREQ=WEEKLY;INTERVAL=1;BYDAY=MO'
+    assert ex_dates == [utc(2024, 1, 8, 9), utc(2024, 1, 15, 9)]
+    assert repeat_to_recurrence(rule, ex_dates, False) == [rule, 'EXDATE:20240108T090000Z,20240115T090000Z']
+    assert repeat_to_recurrence(rule, [utc(2024, 1, 8)], True) == [rule, 'EXDATE;VALUE=DATE:20240108']
+
+    # several rules, and custom TickTick repeats, are not translated
+    assert recurrence_to_repeat(['RRULE:FREQ=DAILY', 'RRULE:FREQ=WEEKLY']) == (None, [])
+    assert recurrence_to_repeat(['RRULE:FREQ=DAILY', 'RDATE:20240110T100000Z']) == (None, [])
+    assert repeat_to_recurrence('ERULE:NAME=CUSTOM', [], False) is None
+
+
+def test_occurrences_keep_their_local_time_across_daylight_saving_changes():
+    series = Series.create('RRULE:FREQ=WEEKLY;INTERVAL=1', madrid(2024, 3, 25, 10), madrid(2024, 3, 25, 11),
+                           'Europe/Madrid', [madrid(2024, 4, 8, 10)])
+    # summer time started on the 31st of March
+    assert series.occurrences(utc(2024, 3, 20), utc(2024, 4, 16)) == \
+        (utc(2024, 3, 25, 9), utc(2024, 4, 1, 8), utc(2024, 4, 15, 8))
+    assert series.next(utc(2024, 4, 2)) == utc(2024, 4, 15, 8)
+    # an occurrence in progress is the next one
+    assert series.next(utc(2024, 4, 1, 8, 30)) == utc(2024, 4, 1, 8)
+
+    assert series.overlaps(utc(2024, 4, 1, 10), utc(2024, 4, 10)) is False
+    assert series.overlaps(utc(2024, 4, 1, 10), utc(2024, 4, 16))
+    assert series.overlaps(utc(2030, 1, 1), None) and series.last_end() is None
+
+
+def test_until_is_converted_to_the_local_time_of_the_series():
+    # UNTIL is in utc: the last occurrence (10:00 in Madrid, 08:00 utc) is before it
+    series = Series.create('RRULE:FREQ=DAILY;INTERVAL=1;UNTIL=20240703T081500Z', madrid(2024, 7, 1, 10),
+                           madrid(2024, 7, 1, 11), 'Europe/Madrid')
+    assert series.finite and series.last_end() == utc(2024, 7, 3, 9)
+    assert series.next(utc(2024, 7, 3, 9)) is None
+
+
+def test_repeating_tasks_start_at_the_next_occurrence_in_the_zone_of_the_event(sync):
+    def recurring(event_id: str, start: datetime) -> dict:
+        return {'id': event_id, 'summary': event_id, 'status': 'confirmed', 'recurrence': ['RRULE:FREQ=WEEKLY'],
+                'start': {'dateTime': start.isoformat(), 'timeZone': 'Europe/Madrid'},
+                'end': {'dateTime': (start + timedelta(hours=1)).isoformat(), 'timeZone': 'Europe/Madrid'}}
+
+    # whatever the date, the next occurrence of one of them is on the other side of a daylight saving change
+    service = FakeCalendarService({'cal1': [recurring('winter', madrid(2020, 1, 6, 10)),
+                                            recurring('summer', madrid(2020, 7, 6, 10))]})
+    client = FakeTickTickClient(['work', 'from_google'])
+    sync(service, client)
+
+    for task in client.tasks.values():
+        start = datetime.strptime(task['startDate'], '%Y-%m-%dT%H:%M:%S%z')
+        assert task['timeZone'] == 'Europe/Madrid' and start.astimezone(MADRID).hour == 10
@@ -0,0 +1,13 @@
+from stream import StoredTasks, missing_keys
+
+
+def test_missing_keys_of_stored_tasks_are_found_without_lookups(script, store, monkeypatch):
+    task_class = script['GCalendarApi'].Task
+    store.save_tasks('gcalendar', {k: {'id': k} for k in ('a', 'c', 'e')}, {'a', 'c', 'e'})
+    tasks = StoredTasks(store, 'gcalendar', task_class, {'b': task_class({'id': 'b'}), 'c': None})
+
+    def lookup(kind, ids):
+        raise AssertionError("looked up by id")
+    monkeypatch.setattr(store, 'load_tasks_by_id', lookup)
+    assert missing_keys(['e', 'a', 'b', 'c', 'd', 'd'], tasks) == {'c', 'd'}
+    assert missing_keys(['a', 'b'], {'a': task_class({'id': 'a'})}) == {'b'}
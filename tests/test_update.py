@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+
+from fakes import FakeCalendarService, FakeTickTickClient, ticktick_date
+
+
+def test_tasks_switched_between_all_day_and_timed_are_patched(sync):
+    day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=10)
+    timed = {'isAllDay': False, 'startDate': ticktick_date(day + timedelta(hours=9)),
+             'dueDate': ticktick_date(day + timedelta(hours=10))}
+    service = FakeCalendarService({})
+    client = FakeTickTickClient(['work', 'from_google'], [{'id': 'task1', 'projectId': 'work', 'title': "Task",
+                                                           'status': 0, 'timeZone': 'UTC', **timed}])
+    sync(service, client)
+    events = service.calendars['from_ticktick']
+
+    # the patch removes the dateTime of the event (Google merges the start and end patched with the saved ones)
+    client.tasks['task1'].update({'isAllDay': True, 'startDate': ticktick_date(day),
+                                  'dueDate': ticktick_date(day + timedelta(days=1))})
+    sync(service, client)
+    [event] = events.values()
+    assert event['start'] == {'date': day.date().isoformat()}
+
+    client.tasks['task1'].update(timed)
+    sync(service, client)
+    [event] = events.values()
+    assert event['start'] == {'dateTime': timed['startDate'].replace('+0000', 'Z'), 'timeZone': 'UTC'}
+    sync(service, client)
+    assert service.calls['events.patch'] == 2
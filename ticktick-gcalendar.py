@@ -1,26 +1,48 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
 import os
+import sys
+import threading
+import time
 from abc import abstractmethod, ABC
-from datetime import datetime, date, timedelta
+from collections import deque
+from datetime import datetime, date, timedelta, timezone
 from os import path
-from typing import Dict, List, Union, Tuple, Optional
+from typing import Dict, List, Union, Tuple, Optional, Iterator, Callable, Any, TypeVar
 
-import pytz
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-
-from account_info import GOOGLE, GOOGLE_INFO, TICKTICK, TICKTICK_INFO  # account information
-from helper import load_dict_from_file, save_dict_to_file, BiDict
-from ticktick_py.ticktick.api import TickTickClient  # Main Interface
-from ticktick_py.ticktick.oauth2 import OAuth2  # OAuth2 Manager
+try:
+    from account_info import GOOGLE, GOOGLE_INFO, TICKTICK, TICKTICK_INFO  # account information
+except ModuleNotFoundError as e:
+    if e.name != 'account_info':
+        raise e
+    # only multi-account runs (--tenants) do without it, reading the account information of each tenant
+    # from its directory (see main)
+    GOOGLE = GOOGLE_INFO = TICKTICK = TICKTICK_INFO = None
+from helper import BiDict, run_concurrently
+from journal import Journal, INSERT, DELETE, DONE, new_id
+from metrics import metrics
+from plan import make_plan, ChangePlan, Planner
+from ratelimit import RateLimiter
+from recurrence import Series, recurrence_to_repeat, repeat_to_recurrence, format_date, parse_date
+from state import StateStore, FileStateStore, SqliteStateStore
+from stream import StoredTasks, diff_pages, missing_keys
+
+# pytz, the google client and ticktick_py are imported where needed, so that commands that
+# do not use them (e.g., --remove_tick) start fast
 
 DEBUG = False
+BIDICT_PATH = 'data/bidict_ticktick_gcalendar.dict'
+JOURNAL_PATH = 'data/journal.log'
+# stable json used to fingerprint the content of tasks
+FINGERPRINT_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=str)
+
+T = TypeVar('T')
 
 
 def do_on_exception(e: Exception):
+    metrics.error(e)
     if DEBUG:
         raise e
     else:
@@ -28,10 +50,18 @@ def do_on_exception(e: Exception):
         print(e)
 
 
+def get_timezone_name(d: datetime, preferred: str = None) -> str:
+    from timezones import get_timezone_name as resolve
+    with metrics.time('timezone'):
+        return resolve(d, preferred)
+
+
 def gcalendar_get_datetime(event_time: Dict) -> Tuple[datetime, bool]:
-    if 'dateTime' in event_time:
+    import pytz
+    # the other key may be None (see GCalendarApi.build_event)
+    if event_time.get('dateTime', None) is not None:
         return datetime.fromisoformat(event_time['dateTime']), False
-    elif 'date' in event_time:
+    elif event_time.get('date', None) is not None:
         return datetime.strptime(event_time['date'], '%Y-%m-%d').replace(tzinfo=pytz.UTC), True
     else:
         raise Exception('event date does not contain date nor dateTime')
@@ -44,7 +74,13 @@ def date_to_gcalendar(d: Union[date, datetime]):
         return d.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
+def ticktick_parse_date(value: Optional[str]) -> Optional[datetime]:
+    """Parses a TickTick date (e.g., "2019-11-13T03:00:00+0000"), None if missing"""
+    return datetime.strptime(value.replace('.000', ''), '%Y-%m-%dT%H:%M:%S%z') if value else None
+
+
 def ticktick_get_datetime(event_time: Dict, start: bool) -> Tuple[datetime, bool]:
+    import pytz
     key = 'startDate' if start else 'dueDate'
     if 'startDate' in event_time:
         return pytz.timezone(event_time['timeZone']).localize(datetime.fromisoformat(event_time[key][:-5])), \
@@ -53,28 +89,189 @@ def ticktick_get_datetime(event_time: Dict, start: bool) -> Tuple[datetime, bool
         raise Exception(f"event date does not contain {key}")
 
 
-def get_timezone_name(d: datetime):
-    return {tz.zone for tz in map(pytz.timezone, pytz.all_timezones_set) if
-            d.astimezone(tz).utcoffset() == d.utcoffset()}.pop()
+def ticktick_format_date(d: datetime) -> str:
+    return d.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+def gcalendar_get_series(event: Dict) -> Optional[Series]:
+    """Series of a recurring event (its exceptions included), None if not recurring or not supported"""
+    rule, ex_dates = recurrence_to_repeat(event.get('recurrence', None))
+    if rule is None or 'start' not in event:
+        return None
+    try:
+        start, all_day = gcalendar_get_datetime(event['start'])
+        end = gcalendar_get_datetime(event['end'])[0] if 'end' in event else start
+        ex_dates += [parse_date(k) for k in event.get(GCalendarApi.EXCEPTIONS, None) or []]
+        return Series.create(rule, start, end, None if all_day else event['start'].get('timeZone', None) or 'UTC',
+                             ex_dates)
+    except Exception:
+        return None
+
+
+def ticktick_get_series(task: Dict) -> Optional[Series]:
+    """Series of a repeating task, None if not repeating or not supported (e.g., custom repeats)"""
+    repeat = task.get('repeatFlag', None)
+    if not repeat or not repeat.startswith('RRULE:'):
+        return None
+    try:
+        start, end = TickTickApi.get_dates(task)
+        if start is None:
+            return None
+        ex_dates = [ticktick_parse_date(k) for k in task.get('exDate', None) or []]
+        time_zone = None if task.get('isAllDay', False) else task.get('timeZone', None) or 'UTC'
+        return Series.create(repeat, start, end, time_zone, ex_dates)
+    except Exception:
+        return None
+
+
+class SyncWindow:
+    """
+    Dates synced, from past before now to future after now (no limit if None).
+    Tasks outside of the window are neither fetched nor synced unless they were synced before
+    """
+
+    def __init__(self, past: timedelta, future: timedelta = None):
+        self.past = past
+        self.future = future
+        self.start = self.end = None
+        self.move()
+
+    def move(self, now: datetime = None):
+        """Moves the window to now (e.g., before each sync of the daemon)"""
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self.start = now - self.past
+        self.end = now + self.future if self.future is not None else None
+
+    def ended(self, end: Optional[datetime]) -> bool:
+        return end is not None and end < self.start
+
+    def contains(self, start: Optional[datetime], end: Optional[datetime]) -> bool:
+        """Whether a task from start to end overlaps the window (tasks without dates do not)"""
+        if start is None or end is None:
+            return False
+        return end >= self.start and (self.end is None or start < self.end)
 
 
 class Api(ABC):
     class Task(dict):
-        def __init__(self, task: Dict, properties: List[str] = None):
-            super().__init__(task)
-            self.properties = properties
-            self._simplified = None
+        # keys of the fingerprints in the saved snapshots
+        FINGERPRINT_KEY = '_hash'
+        FIELDS_KEY = '_fields'
+        WRITTEN_KEY = '_written'
+        # hex digits of the hash of each property in the field fingerprints
+        FIELD_FINGERPRINT_SIZE = 4
+        # properties only compared when set (empty is the same as missing, as some responses omit them)
+        OPTIONAL_PROPERTIES = set()
+        # properties compared, set by each api
+        properties: List[str] = []
+        # the state of the task is kept as class defaults until set, so that building a task only copies it
+        # (a few times faster than setting each attribute in __init__, which adds up for whole accounts)
+        _simplified = None
+        _fingerprint = None
+        _field_fingerprints = None
+        # content fingerprint of what the sync last wrote to the task (see Api.wrote)
+        written: Optional[str] = None
+        # whether the task was built from a snapshot, so that only its fingerprints are known
+        partial = False
 
         def __setitem__(self, key, value):
             super().__setitem__(key, value)
             self._simplified = None
+            self._fingerprint = None
+            self._field_fingerprints = None
 
         @property
         def simplified(self) -> dict:
             if self._simplified is None:
-                self._simplified = {k: self.get(k, None) for k in self.properties}
+                get = self.get
+                simplified = {k: get(k, None) for k in self.properties}
+                for k in self.OPTIONAL_PROPERTIES:
+                    if k in simplified and not simplified[k]:
+                        del simplified[k]
+                self._simplified = simplified
             return self._simplified
 
+        @property
+        def fingerprint(self) -> str:
+            """
+            Stable hash of the simplified task, hashing its repr (about twice as fast as its json), i.e., the
+            properties in their order and their nested values in the order the api gives them
+            """
+            if self._fingerprint is None:
+                self._fingerprint = hashlib.blake2b(repr(self.simplified).encode(), digest_size=16).hexdigest()
+            return self._fingerprint
+
+        @property
+        def field_fingerprints(self) -> str:
+            """
+            Short hash of each property in the order of the properties, used to know which properties changed
+            (empty if unknown). Only computed for the tasks that changed, the rest keep the ones of their snapshot
+            """
+            if self._field_fingerprints is None:
+                size = self.FIELD_FINGERPRINT_SIZE // 2
+                self._field_fingerprints = ''.join(
+                    hashlib.blake2b(repr(self.get(k, None)).encode(), digest_size=size).hexdigest()
+                    for k in self.properties)
+            return self._field_fingerprints
+
+        def changed_fields(self, old: 'Api.Task') -> Optional[List[str]]:
+            """Properties that differ from the old task, None if unknown (e.g., saved with other properties)"""
+            fields, old_fields = self.field_fingerprints, old.field_fingerprints
+            if not fields or len(fields) != len(old_fields):
+                return None
+            size = self.FIELD_FINGERPRINT_SIZE
+            return [k for i, k in enumerate(self.properties)
+                    if fields[i * size:(i + 1) * size] != old_fields[i * size:(i + 1) * size]]
+
+        def differs(self, old: 'Api.Task') -> bool:
+            """
+            Whether the task changed since the old one. Full tasks are compared directly, only hashing them
+            when the old one is a snapshot
+            """
+            if self.partial or old.partial:
+                return self.fingerprint != old.fingerprint
+            return self.simplified != old.simplified
+
+        @staticmethod
+        def normalize(key: str, value: Any) -> Any:
+            """Value of a property as compared by content_fingerprint (e.g., dates in any format as the same instant)"""
+            return value.strip() if isinstance(value, str) else value
+
+        @property
+        def content_fingerprint(self) -> str:
+            """
+            Hash of the content of the task, ignoring what the api changes when storing it (e.g., the format of
+            the dates, or empty properties it adds)
+            """
+            content = {k: self.normalize(k, v) for k, v in self.simplified.items() if v}
+            return hashlib.blake2b(FINGERPRINT_ENCODER.encode(content).encode(), digest_size=16).hexdigest()
+
+        def snapshot(self, properties: List[str]) -> Dict:
+            """Compact version of the task with only the given properties and the fingerprints"""
+            snapshot = {k: self[k] for k in properties if k in self}
+            snapshot[self.FINGERPRINT_KEY] = self.fingerprint
+            snapshot[self.FIELDS_KEY] = self.field_fingerprints
+            if self.written is not None:
+                snapshot[self.WRITTEN_KEY] = self.written
+            return snapshot
+
+        @classmethod
+        def from_snapshot(cls, snapshot: Dict) -> 'Api.Task':
+            """Builds the task from a snapshot (or a full task)"""
+            task = cls(snapshot)
+            fingerprint = task.pop(cls.FINGERPRINT_KEY, None)
+            field_fingerprints = task.pop(cls.FIELDS_KEY, None)
+            written = task.pop(cls.WRITTEN_KEY, None)
+            if written is not None:
+                task.written = written
+            if fingerprint is not None:
+                task.partial = True
+                task._fingerprint = fingerprint
+                # unknown if the snapshot has no field fingerprints
+                task._field_fingerprints = field_fingerprints or ''
+            return task
+
         @property
         @abstractmethod
         def title(self) -> str:
@@ -87,37 +284,182 @@ class Api(ABC):
         def __eq__(self, other):
             if not isinstance(other, self.__class__):
                 return False
-            return self.simplified == other.simplified if self.get_update_compare() else hash(self) == hash(other)
+            return self.fingerprint == other.fingerprint
+
+    # name of the tasks in the state store
+    KIND = None
+    # properties synced
+    PROPERTIES: List[str] = []
+    # properties sent together when updating if any of them changed, since the api reads them together
+    UPDATED_TOGETHER: List[set] = []
+    # properties saved for the old tasks (besides their fingerprint), those needed to delete them
+    SNAPSHOT_PROPERTIES = ['id']
+    # endpoints that are not idempotent, only retried if throttled (see RateLimiter.should_retry)
+    CREATE_ENDPOINTS = set()
+
+    def __init__(self, store: StateStore = None, limiter: RateLimiter = None, window: SyncWindow = None,
+                 stream: bool = False):
+        """
+        :param limiter: budget of the requests to the api (by default, no rate limit)
+        :param window: if given, only the tasks in the window are synced
+        :param stream: if set, the current tasks are diffed page by page against the saved ones, which are read
+            from the store when needed instead of being loaded (see stream.diff_pages)
+        """
+        self.store = store if store is not None else open_state_store()
+        if stream and not self.store.STREAMS:
+            raise ValueError(f"{type(self.store).__name__} cannot be streamed, use a SQLite state store")
+        self.limiter = limiter if limiter is not None else RateLimiter(self.KIND)
+        self.window = window
+        self.stream = stream
+        self.old_tasks = None
+        # ids of the old tasks changed since last saved
+        self.changed_ids = set()
+        # if set, writes are recorded in the planner instead of being sent
+        self.planner: Optional[Planner] = None
+        # if set, writes are sent concurrently by the engine (see engine.py) when flushed
+        self.engine = None
+
+    def call(self, endpoint: str, fn: Callable[[], T]) -> T:
+        """Sends a request within the budget of the api, retrying it if throttled (each attempt is measured)"""
+        def attempt():
+            with metrics.call(self.KIND, endpoint):
+                return fn()
+        return self.limiter.call(attempt, idempotent=endpoint not in self.CREATE_ENDPOINTS)
+
+    def submit(self, key: Optional[str], fn: Callable[[], T], on_done: Callable[[T], Any],
+               on_error: Callable[[Exception], None] = None, name: str = 'write'):
+        """
+        Sends a write now and calls on_done with its result or, if there is an engine, hands it to the engine
+        (writes with the same key, e.g., task id, are kept in order)
+        :param on_error: called if the write fails (if None, the error is raised when sent now)
+        :param name: kind of write, the engine reports the latency of each
+        :return: result of on_done if the write is sent now, None otherwise
+        """
+        if self.engine is None:
+            if on_error is None:
+                return on_done(fn())
+            try:
+                return on_done(fn())
+            except Exception as e:
+                on_error(e)
+                return None
+        self.engine.submit(key, fn, on_done, on_error if on_error is not None else do_on_exception,
+                           f"{self.KIND} {name}")
 
-        @staticmethod
-        @abstractmethod
-        def set_update_compare(compare: bool):
-            pass
+    def flush(self):
+        """Sends the pending writes"""
+        if self.engine is not None:
+            self.engine.flush()
 
-        @staticmethod
-        @abstractmethod
-        def get_update_compare() -> bool:
-            pass
+    def get_changes(self) -> Optional[Dict[str, Optional[Task]]]:
+        """
+        Tasks changed since the last sync, if known (None for deleted tasks).
+        If None is returned, the diff is computed against all the current tasks
+        """
+        return None
 
-    def __init__(self):
-        self.old_tasks = None
+    @abstractmethod
+    def get_client(self):
         pass
 
+    @staticmethod
     @abstractmethod
-    def get_client(self):
+    def get_dates(task: Dict) -> Tuple[Optional[datetime], Optional[datetime]]:
+        """Start and end of a task (or old task), None if unknown"""
+        pass
+
+    @staticmethod
+    def get_series(task: Dict) -> Optional[Series]:
+        """Series of a recurring task (or old task), None if not recurring"""
+        return None
+
+    def in_window(self, task: Dict) -> bool:
+        if self.window is None:
+            return True
+        series = self.get_series(task)
+        if series is not None:
+            return series.overlaps(self.window.start, self.window.end)
+        return self.window.contains(*self.get_dates(task))
+
+    def ended(self, task: Dict) -> bool:
+        """Whether the task (or all its occurrences) ended before the window"""
+        series = self.get_series(task)
+        if series is not None:
+            return self.window.ended(series.last_end())
+        return self.window.ended(self.get_dates(task)[1])
+
+    @staticmethod
+    def wrote(task: Task):
+        """
+        Records the content of a task written by the sync, kept with the task until it changes
+        (any other change of the task is not an echo anymore)
+        """
+        task.written = task.content_fingerprint
+
+    def is_echo(self, task: Task) -> bool:
+        """Whether the task has the content last written by the sync, i.e., it only changed because of that write"""
+        old = self.get_old_tasks().get(task['id'], None)
+        return old is not None and old.written is not None and old.written == task.content_fingerprint
+
+    def changed_properties(self, task: Dict) -> Optional[List[str]]:
+        """
+        Properties of a task to update that differ from the current task (compared as in content_fingerprint),
+        None if the current task is unknown
+        """
+        current = self.get_tasks().get(task['id'], None)
+        if current is None:
+            return None
+        normalize = self.Task.normalize
+        changed = {k for k in self.PROPERTIES if k != 'id' and k in task
+                   and (normalize(k, task[k]) or None) != (normalize(k, current.get(k, None)) or None)}
+        for together in self.UPDATED_TOGETHER:
+            if changed & together:
+                changed |= {k for k in together if k in task}
+        return [k for k in self.PROPERTIES if k in changed]
+
+    @abstractmethod
+    def find_inserted(self, entry: Dict, synced: Callable[[str], bool]) -> Optional[Task]:
+        """
+        Task written by a journaled insert whose answer was not received, None if not written
+        :param synced: whether a task id is already synced (so it cannot be the one inserted)
+        """
         pass
 
+    @abstractmethod
+    def is_deleted(self, task_id: str) -> bool:
+        pass
+
+    def prune_old_tasks(self):
+        """Forgets the old tasks that ended before the window, they are not fetched anymore"""
+        if self.window is None:
+            return
+        old = self.get_old_tasks()
+        pruned = [k for k, v in old.items() if self.ended(v)]
+        for k in pruned:
+            del old[k]
+            self.changed_ids.add(k)
+        metrics.items(self.KIND, 'pruned', len(pruned))
+
+    def filter_window(self, tasks: Dict[str, Task]) -> Dict[str, Task]:
+        """Keeps the tasks in the window and those synced before (so that moving them out of it is synced)"""
+        if self.window is None:
+            return tasks
+        old = self.get_old_tasks()
+        return {k: v for k, v in tasks.items() if k in old or self.in_window(v)}
+
     @abstractmethod
     def get_tasks(self) -> Dict[str, Task]:
         """ Get task and get old task must return the same type"""
         pass
 
-    def get_old_tasks(self, file_name: str = None) -> Dict[str, Task]:
+    def get_old_tasks(self) -> Dict[str, Task]:
         """ Get task and get old task must return the same type"""
         if self.old_tasks is None:
-            self.old_tasks = load_dict_from_file(file_name)
-        if self.old_tasks is None:
-            self.old_tasks = {}
+            task_class = self.__class__.Task
+            if self.stream:
+                self.old_tasks = StoredTasks(self.store, self.KIND, task_class)
+            else:
+                self.old_tasks = {k: task_class.from_snapshot(v) for k, v in self.store.load_tasks(self.KIND).items()}
         return self.old_tasks
 
     def change_tasks(self, task: Optional[Task], delete: bool = False, delete_id: str = None):
@@ -126,11 +468,22 @@ class Api(ABC):
             self.get_tasks().pop(task_id, None)
             self.get_old_tasks().pop(task_id, None)
         else:
-            self.get_tasks()[task['id']] = task
-            self.get_old_tasks()[task['id']] = task
-
-    def save_old_tasks(self, file_name: str):
-        save_dict_to_file(file_name, self.get_old_tasks())
+            task_id = task['id']
+            self.get_tasks()[task_id] = task
+            self.get_old_tasks()[task_id] = task
+        self.changed_ids.add(task_id)
+
+    def save_old_tasks(self):
+        old = self.get_old_tasks()
+        if self.stream:
+            snapshots = {k: old[k].snapshot(self.SNAPSHOT_PROPERTIES) for k in self.changed_ids if k in old}
+        else:
+            snapshots = {k: v.snapshot(self.SNAPSHOT_PROPERTIES) for k, v in old.items()}
+        self.store.save_tasks(self.KIND, snapshots, self.changed_ids)
+        self.changed_ids = set()
+        if self.stream:
+            # the changes are saved, the next sync reads them from the store
+            self.old_tasks = None
 
 
 class GCalendarApi(Api):
@@ -140,23 +493,39 @@ class GCalendarApi(Api):
         "description",
         "start",
         "end",
+        "recurrence",
     ]
+    # (local) property of recurring events with the original start of their modified or cancelled instances
+    EXCEPTIONS = 'exceptions'
+    # fields of the events (status is needed to detect deleted events, the rest to detect recurring instances)
+    EVENT_FIELDS = f"{','.join(PROPERTIES)},status,recurringEventId,originalStartTime"
+    LIST_FIELDS = f"nextPageToken,nextSyncToken,items({EVENT_FIELDS})"
+    PAGE_SIZE = 2500
+    KIND = 'gcalendar'
+    # the dates are needed to prune the events that ended before the sync window
+    SNAPSHOT_PROPERTIES = ['id', 'summary', 'start', 'end', 'recurrence', EXCEPTIONS]
+    SYNC_TOKENS = 'gcalendar_sync_tokens'
+    # exceptions of the recurring events, kept for incremental fetches
+    SERIES_EXCEPTIONS = 'gcalendar_exceptions'
+    # the start and end must be both dates or both times
+    UPDATED_TOGETHER = [{'start', 'end'}]
+    # a retried insert whose first attempt was done fails as the id exists
+    CREATE_ENDPOINTS = {'events.insert'}
 
     class Task(Api.Task):
-        UPDATE_COMPARE = True
-
-        @staticmethod
-        def set_update_compare(compare: bool):
-            GCalendarApi.Task.UPDATE_COMPARE = compare
+        OPTIONAL_PROPERTIES = {'recurrence', 'exceptions'}
 
         @staticmethod
-        def get_update_compare() -> bool:
-            return GCalendarApi.Task.UPDATE_COMPARE
-
-        def __init__(self, task: Dict, properties: List[str] = None):
-            if properties is None:
-                properties = GCalendarApi.PROPERTIES
-            super().__init__(task, properties)
+        def normalize(key: str, value: Any) -> Any:
+            if key in ('start', 'end') and isinstance(value, dict):
+                try:
+                    d, all_day = gcalendar_get_datetime(value)
+                except Exception:
+                    return value
+                # the offset of the dateTime may change, the instant does not
+                return {'date' if all_day else 'dateTime': d.date().isoformat() if all_day
+                        else d.astimezone(timezone.utc).isoformat(), 'timeZone': value.get('timeZone', None)}
+            return Api.Task.normalize(key, value)
 
         @property
         def title(self) -> str:
@@ -165,11 +534,48 @@ class GCalendarApi(Api):
         def __hash__(self):
             return hash(self['id'])
 
-    def __init__(self, renew: bool = False, credentials=GOOGLE, info: Dict = GOOGLE_INFO):
-        super(GCalendarApi, self).__init__()
+    Task.properties = PROPERTIES + [EXCEPTIONS]
+
+    def __init__(self, renew: bool = False, credentials=GOOGLE, info: Dict = GOOGLE_INFO, incremental: bool = False,
+                 batch: bool = False, workers: int = 1, store: StateStore = None, service=None,
+                 limiter: RateLimiter = None, window: SyncWindow = None, stream: bool = False):
+        """
+        :param service: calendar service to use instead of connecting with the credentials
+        :param window: if given, only the events in the window are fetched and synced
+        :param stream: if set, the events are diffed page by page (see Api), incremental is then ignored
+        """
+        super(GCalendarApi, self).__init__(store, limiter, window, stream)
         self.calendar_ids = info['calendar_ids']
         self.default_calendar_id = info['default_project_id']
-        self.old_filename = info['old_filename']
+        self.incremental = incremental
+        self.workers = workers
+        # http clients of each thread
+        self.local = threading.local()
+        self.creds = None
+        if service is None:
+            with metrics.time('google_login'):
+                service = self.connect(renew, credentials)
+        self.service = service
+        # if batching, writes are executed in batches (see flush)
+        self.batch = GCalendarBatch(self.service, self.limiter) if batch else None
+
+        # sync tokens per calendar, only committed if all its changes were synced
+        self.sync_tokens = (self.store.load_value(self.SYNC_TOKENS) or {}) if incremental else {}
+        self.next_sync_tokens = {}
+        # original starts of the modified or cancelled instances of each recurring event
+        self.exceptions: Dict[str, List[str]] = (self.store.load_value(self.SERIES_EXCEPTIONS) or {}) \
+            if incremental else {}
+        self.changes = None
+        self.calendar_changes = {}
+        self.events = {}
+        self.refresh()
+
+    def connect(self, renew: bool, credentials: Dict):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build
+
         creds = None
         if path.exists(credentials['TOKEN_FILENAME']):
             creds = Credentials.from_authorized_user_file(credentials['TOKEN_FILENAME'], credentials['SCOPES'])
@@ -188,33 +594,312 @@ class GCalendarApi(Api):
             with open(credentials['TOKEN_FILENAME'], 'w') as token:
                 token.write(creds.to_json())
 
-        self.service = build('calendar', 'v3', credentials=creds)
+        self.creds = creds
+        # uses the discovery document bundled with the client instead of downloading it
+        return build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
 
-        self.events = {}
-        for calendarId in self.calendar_ids:
-            events_result = self.service.events().list(calendarId=calendarId, singleEvents=False).execute()
-            self.events.update({k['id']: self.Task(k) for k in events_result.get('items', [])})
+    def refresh(self, calendar_ids: List[str] = None):
+        """
+        Fetches the current events (only the changes since the last fetch if incremental)
+        :param calendar_ids: if incremental, only the changes of these calendars are fetched (e.g., those notified)
+        """
+        if self.incremental:
+            self.commit_sync_tokens()
+        self.next_sync_tokens = {}
+        self.changes = None
+        self.calendar_changes = {}
+        with metrics.time('google_fetch'):
+            if self.window is not None:
+                self.window.move()
+                self.prune_old_tasks()
+            if self.stream:
+                self.changes = diff_pages(self.fetch_pages(), self.store, self.KIND, self.Task,
+                                          keep=lambda task, saved: saved or self.in_window(task),
+                                          snapshot_properties=self.SNAPSHOT_PROPERTIES)
+                self.events = StoredTasks(self.store, self.KIND, self.Task, self.changes)
+                old = self.get_old_tasks()
+                self.forget_moved([k for k, v in self.changes.items() if v is None and k in old])
+            else:
+                if self.incremental:
+                    self.events = self.fetch_incremental(calendar_ids)
+                if self.changes is None:
+                    self.events = self.fetch_full()
+                    self.forget_moved()
+        metrics.items(self.KIND, 'fetched', len(self.events) if self.changes is None else len(self.changes))
+
+    def iter_events(self, calendar_id: str, http=None, **kwargs) -> Iterator[Dict[str, Task]]:
+        """
+        Lazily lists the events of a calendar, yielding the events of each page as they arrive.
+        Only the fields used by the sync are requested.
+        Once finished, the sync token for the next incremental fetch is saved in next_sync_tokens
+        :param http: http client used for the requests (httplib2 is not thread safe)
+        """
+        page_token = None
+        while True:
+            request = self.service.events().list(calendarId=calendar_id, singleEvents=False, pageToken=page_token,
+                                                 maxResults=self.PAGE_SIZE, fields=self.LIST_FIELDS, **kwargs)
+            events_result = self.call('events.list', lambda: request.execute(http=http))
+            yield {k['id']: self.Task(k) for k in events_result.get('items', [])}
+            page_token = events_result.get('nextPageToken', None)
+            if page_token is None:
+                self.next_sync_tokens[calendar_id] = events_result.get('nextSyncToken', None)
+                return
+
+    def fetch_calendar(self, calendar_id: str, **kwargs) -> Dict[str, Task]:
+        events = {}
+        for page in self.iter_events(calendar_id, http=self.http(), **kwargs):
+            events.update(page)
+        return events
+
+    def in_window(self, task: Dict) -> bool:
+        if self.window is None or not self.incremental:
+            return super().in_window(task)
+        # sync tokens only return the events changed, so those entering the window later would be missed:
+        # the future bound is not used when incremental
+        series = self.get_series(task)
+        if series is not None:
+            return series.overlaps(self.window.start, None)
+        start, end = self.get_dates(task)
+        return start is not None and not self.window.ended(end)
+
+    def window_params(self) -> Dict[str, str]:
+        """Time bounds of a full fetch (sync tokens cannot be used with time bounds, see in_window)"""
+        if self.window is None:
+            return {}
+        params = {'timeMin': self.window.start.isoformat()}
+        if self.window.end is not None and not self.incremental:
+            params['timeMax'] = self.window.end.isoformat()
+        return params
+
+    def fetch_full(self) -> Dict[str, Task]:
+        events = {}
+        params = self.window_params()
+        fetched = run_concurrently(lambda k: self.fetch_calendar(k, **params), self.calendar_ids, self.workers,
+                                   'Google calendars')
+        self.exceptions = {}
+        for calendarId, calendar_events in zip(self.calendar_ids, fetched):
+            for k, v in list(calendar_events.items()):
+                if v.get('recurringEventId', None) is not None:
+                    self.add_exception(v)
+                # only the cancelled instances of recurring events are listed
+                if v.get('status', None) == 'cancelled':
+                    del calendar_events[k]
+            calendar_events = self.filter_window(calendar_events)
+            self.calendar_changes[calendarId] = calendar_events
+            events.update(calendar_events)
+        for k, v in events.items():
+            self.set_exceptions(v)
+        return events
+
+    def fetch_pages(self) -> Iterator[Dict[str, Task]]:
+        """
+        Lazily fetches the events of each calendar page by page, one calendar after the other.
+        The recurring events are yielded last, once all their exceptions are known
+        """
+        params = self.window_params()
+        self.exceptions = {}
+        series = {}
+        for calendar_id in self.calendar_ids:
+            for page in self.iter_events(calendar_id, http=self.http(), **params):
+                for k, v in list(page.items()):
+                    if v.get('recurringEventId', None) is not None:
+                        self.add_exception(v)
+                    # only the cancelled instances of recurring events are listed
+                    if v.get('status', None) == 'cancelled':
+                        del page[k]
+                    elif v.get('recurrence', None):
+                        series[k] = page.pop(k)
+                yield page
+        for v in series.values():
+            self.set_exceptions(v)
+        yield series
+
+    def add_exception(self, instance: Dict) -> str:
+        """Adds a modified or cancelled instance to the exceptions of its recurring event"""
+        series_id = instance['recurringEventId']
+        original_start = format_date(gcalendar_get_datetime(instance['originalStartTime'])[0])
+        exceptions = self.exceptions.setdefault(series_id, [])
+        if original_start not in exceptions:
+            exceptions.append(original_start)
+            exceptions.sort()
+        return series_id
+
+    def set_exceptions(self, event: Task):
+        if event.get('recurrence', None) and self.exceptions.get(event['id'], None):
+            event[self.EXCEPTIONS] = list(self.exceptions[event['id']])
+
+    def forget_moved(self, missing: List[str] = None):
+        """
+        Old events missing from a fetch within a window were either deleted or moved out of the window.
+        Those moved out (or of unknown date) are forgotten instead of synced as deleted
+        :param missing: ids of the old events missing, if already known
+        """
+        if self.window is None:
+            return
+        old = self.get_old_tasks()
+        if missing is None:
+            missing = [k for k in old if k not in self.events]
+        forgotten = [k for k in missing if self.get_dates(old[k])[1] is None or self.exists(k)]
+        for k in forgotten:
+            del old[k]
+            self.changed_ids.add(k)
+        metrics.items(self.KIND, 'pruned', len(forgotten))
+
+    def exists(self, event_id: str) -> bool:
+        """Whether an event exists (not deleted) in any of the calendars"""
+        from ratelimit import error_status
+
+        for calendar_id in self.calendar_ids:
+            request = self.service.events().get(calendarId=calendar_id, eventId=event_id, fields='id,status')
+            try:
+                event = self.call('events.get', request.execute)
+            except Exception as e:
+                if error_status(e) in (404, 410):
+                    continue
+                raise e
+            return event.get('status', None) != 'cancelled'
+        return False
+
+    def fetch_incremental(self, calendar_ids: List[str] = None) -> Optional[Dict[str, Task]]:
+        """
+        Fetches only the events changed since the last saved sync tokens.
+        If any calendar has no valid token, nothing is returned and a full fetch is needed
+        :param calendar_ids: calendars fetched, all by default
+        """
+        if calendar_ids is None:
+            calendar_ids = self.calendar_ids
+        if any(self.sync_tokens.get(k, None) is None for k in self.calendar_ids):
+            return None
+        try:
+            fetched = run_concurrently(lambda k: self.fetch_calendar(k, syncToken=self.sync_tokens[k]),
+                                       calendar_ids, self.workers, 'Google calendars')
+        except Exception as e:
+            # googleapiclient HttpError, token expired: full resync needed
+            if getattr(getattr(e, 'resp', None), 'status', None) == 410:
+                print("Sync token expired: full resync")
+                self.next_sync_tokens = {}
+                return None
+            raise e
+
+        changes = {}
+        old = self.get_old_tasks()
+        for calendarId, calendar_events in zip(calendar_ids, fetched):
+            # recurring events with new exceptions are synced again
+            series_changed = set()
+            for k, v in list(calendar_events.items()):
+                if v.get('recurringEventId', None) is not None and 'originalStartTime' in v:
+                    series_changed.add(self.add_exception(v))
+                    # cancelled instances are only synced if they were modified (synced on their own) before
+                    if v.get('status', None) == 'cancelled' and k not in old:
+                        del calendar_events[k]
+            for series_id in series_changed:
+                if series_id not in calendar_events and series_id in old:
+                    calendar_events[series_id] = self.get_event(calendarId, series_id)
+
+            # changes of events out of the window are only synced if they were synced before
+            self.calendar_changes[calendarId] = {k: None if v.get('status', None) == 'cancelled' else v
+                                                 for k, v in calendar_events.items()
+                                                 if k in old or v.get('status', None) == 'cancelled'
+                                                 or self.in_window(v)}
+            changes.update(self.calendar_changes[calendarId])
+
+        for k, v in changes.items():
+            if v is None:
+                self.exceptions.pop(k, None)
+            else:
+                self.set_exceptions(v)
+
+        self.changes = changes
+        events = dict(self.get_old_tasks())
+        for k, v in changes.items():
+            if v is None:
+                events.pop(k, None)
+            else:
+                events[k] = v
+        return events
+
+    def find_inserted(self, entry: Dict, synced: Callable[[str], bool]) -> Optional[Task]:
+        from ratelimit import error_status
+
+        event_id = entry.get('target', None)
+        if event_id is None:
+            return None
+        if event_id in self.get_tasks():
+            return self.get_tasks()[event_id]
+        try:
+            event = self.get_event(self.default_calendar_id, event_id)
+        except Exception as e:
+            if error_status(e) in (404, 410):
+                return None
+            raise e
+        return event if event.get('status', None) != 'cancelled' else None
+
+    def is_deleted(self, task_id: str) -> bool:
+        return not self.exists(task_id)
+
+    def watch(self, calendar_id: str, channel_id: str, address: str, token: str, ttl: float) -> Dict:
+        """Opens a channel notifying the changes of the events of a calendar to address (see push)"""
+        body = {'id': channel_id, 'type': 'web_hook', 'address': address, 'token': token,
+                'params': {'ttl': str(int(ttl))}}
+        request = self.service.events().watch(calendarId=calendar_id, body=body)
+        return self.call('events.watch', request.execute)
+
+    def stop_watch(self, channel_id: str, resource_id: str):
+        request = self.service.channels().stop(body={'id': channel_id, 'resourceId': resource_id})
+        self.call('channels.stop', request.execute)
+
+    def get_event(self, calendar_id: str, event_id: str) -> Task:
+        request = self.service.events().get(calendarId=calendar_id, eventId=event_id, fields=self.EVENT_FIELDS)
+        return self.Task(self.call('events.get', request.execute))
 
     def get_client(self):
         return self.service.events()
 
+    @staticmethod
+    def get_series(task: Dict) -> Optional[Series]:
+        return gcalendar_get_series(task)
+
+    @staticmethod
+    def get_dates(task: Dict) -> Tuple[Optional[datetime], Optional[datetime]]:
+        try:
+            start = gcalendar_get_datetime(task['start'])[0] if 'start' in task else None
+            end = gcalendar_get_datetime(task['end'])[0] if 'end' in task else None
+        except Exception:
+            return None, None
+        return start or end, end or start
+
     def get_tasks(self) -> Dict[str, Task]:
         return self.events
 
-    def get_old_tasks(self, file_name: str = None) -> Dict[str, Task]:
-        if file_name is None:
-            file_name = self.old_filename
-        return super().get_old_tasks(file_name)
-
-    def save_old_tasks(self, file_name: str = None):
-        if file_name is None:
-            file_name = self.old_filename
-        super().save_old_tasks(file_name)
+    def get_changes(self) -> Optional[Dict[str, Optional[Task]]]:
+        return self.changes
+
+    def save_old_tasks(self):
+        super().save_old_tasks()
+        if self.incremental:
+            self.commit_sync_tokens()
+            self.store.save_value(self.SYNC_TOKENS, self.sync_tokens)
+            self.store.save_value(self.SERIES_EXCEPTIONS, self.exceptions)
+
+    def commit_sync_tokens(self):
+        """Advances the token of each calendar only if all its changes were synced, otherwise they are lost"""
+        old_tasks = self.get_old_tasks()
+        # failed deletions cannot be traced back to their calendar
+        if any(k not in self.events for k in old_tasks):
+            return
+        for calendar_id, token in self.next_sync_tokens.items():
+            # failed syncs are removed from the current events
+            pending = [k for k, v in self.calendar_changes.get(calendar_id, {}).items()
+                       if (k in old_tasks if v is None else k not in self.events)]
+            if not pending:
+                self.sync_tokens[calendar_id] = token
 
     def build_event(self, summary: str, start: Union[date, datetime], end: Union[date, datetime],
-                    description: str = "", event=None):
+                    description: str = "", event=None, time_zone: str = None, recurrence: List[str] = None):
         """
         start and end use date for allday and datetime otherwise
+        time_zone is used as the event timezone if it matches start and end
+        recurrence (RRULE and EXDATE lines) makes it a recurring event, or a single one if the event was recurring
         :return type same asn event type
         """
         if event is None:
@@ -222,37 +907,186 @@ class GCalendarApi(Api):
         # summary, description, end.date, end.dateTime, end.timeZone, recurrence
         event['summary'] = summary
         event['description'] = description
-        event['start'] = {}
-        event['end'] = {}
+        # patches merge start and end with the saved ones, so the keys of the other kind of date are removed
+        # (set to None) when switching between all day and timed
         if start.__class__ == date:
-            event['start']['date'] = date_to_gcalendar(start)
-            event['end']['date'] = date_to_gcalendar(end)
+            event['start'] = {'date': date_to_gcalendar(start), 'dateTime': None, 'timeZone': None}
+            event['end'] = {'date': date_to_gcalendar(end), 'dateTime': None, 'timeZone': None}
         else:
-            event['start']['dateTime'] = date_to_gcalendar(start)
-            event['start']['timeZone'] = get_timezone_name(start)
-            event['end']['dateTime'] = date_to_gcalendar(end)
-            event['end']['timeZone'] = get_timezone_name(end)
+            event['start'] = {'date': None, 'dateTime': date_to_gcalendar(start),
+                              'timeZone': get_timezone_name(start, time_zone)}
+            event['end'] = {'date': None, 'dateTime': date_to_gcalendar(end),
+                            'timeZone': get_timezone_name(end, time_zone)}
+        if recurrence is not None or event.get('recurrence', None):
+            # None removes the recurrence when patching
+            event['recurrence'] = recurrence
         return event
 
-    def update(self, task: Dict, calendar_id: str = None):
+    def execute(self, endpoint: str, request, on_done: Callable[[Dict], Any],
+                on_error: Callable[[Exception], None] = None, key: str = None):
+        """
+        Executes the request and calls on_done with the response.
+        If batching (or there is an engine), the request is added to the batch (or the engine) instead and
+        on_error is called if it fails
+        :param endpoint: name of the request for the metrics (e.g., events.insert)
+        :param key: id of the event written, so that the engine keeps the writes of an event in order
+        :return: result of on_done if the request is executed now, None otherwise
+        """
+        if self.batch is None or self.engine is not None:
+            return self.submit(key, lambda: self.call(endpoint, lambda: request.execute(http=self.http())),
+                               on_done, on_error, endpoint)
+        self.batch.add(endpoint, request, on_done, on_error if on_error is not None else do_on_exception)
+
+    def flush(self):
+        """Executes the pending batched requests"""
+        if self.batch is not None:
+            self.batch.execute()
+        super().flush()
+
+    def http(self):
+        """
+        Http client of the current thread (httplib2 is not thread safe), kept to reuse its connections.
+        None for the default client of the service
+        """
+        if self.creds is None or (self.workers <= 1 and self.engine is None):
+            return None
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            http = self.local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return http
+
+    def update(self, task: Dict, calendar_id: str = None, on_done: Callable[[Task], None] = None,
+               on_error: Callable[[Exception], None] = None):
         if calendar_id is None:
             calendar_id = self.default_calendar_id
-        task = self.get_client().update(calendarId=calendar_id, eventId=task['id'], body=task).execute()
-        self.change_tasks(task if isinstance(task, GCalendarApi.Task) else GCalendarApi.Task(task))
 
-    def insert(self, event: Dict, calendar_id: str = None) -> Task:
+        def done(response):
+            updated = GCalendarApi.Task(response)
+            if task.get(self.EXCEPTIONS, None):
+                updated[self.EXCEPTIONS] = task[self.EXCEPTIONS]
+            self.wrote(updated)
+            self.change_tasks(updated)
+            if on_done is not None:
+                on_done(updated)
+
+        # only the changed properties are patched, so that the rest are not overwritten with stale values
+        fields = self.changed_properties(task)
+        if fields is not None and not fields:
+            metrics.items(self.KIND, 'unchanged')
+            return done(task)
+        body = {k: task[k] for k in (fields if fields is not None else self.PROPERTIES) if k in task and k != 'id'}
+        if self.planner is not None:
+            return done(self.planner.record(self.KIND, 'update', task['id'], body))
+        self.execute('events.patch', self.get_client().patch(calendarId=calendar_id, eventId=task['id'], body=body),
+                     done, on_error, key=task['id'])
+
+    def insert(self, event: Dict, calendar_id: str = None, on_done: Callable[[Task], None] = None,
+               on_error: Callable[[Exception], None] = None) -> Optional[Task]:
+        """:return: the added event, or None if batching (use on_done instead)"""
         if calendar_id is None:
             calendar_id = self.default_calendar_id
-        added = self.Task(self.get_client().insert(calendarId=calendar_id, body=event).execute())
-        self.change_tasks(added)
-        return added
 
-    def delete(self, event_id: str, calendar_id: str = None):
-        """If event is given, then the event_id is taken from there"""
-        if  calendar_id is None:
+        def done(response):
+            added = self.Task(response)
+            self.wrote(added)
+            self.change_tasks(added)
+            if on_done is not None:
+                on_done(added)
+            return added
+
+        if self.planner is not None:
+            return done(self.planner.record(self.KIND, 'insert', body=event))
+        return self.execute('events.insert', self.get_client().insert(calendarId=calendar_id, body=event), done,
+                            on_error, key=event.get('id', None))
+
+    def delete(self, event_id: str, calendar_id: str = None, on_done: Callable[[], None] = None,
+               on_error: Callable[[Exception], None] = None):
+        if calendar_id is None:
             calendar_id = self.default_calendar_id
-        self.get_client().delete(calendarId=calendar_id, eventId=event_id).execute()
-        self.change_tasks(None, delete=True, delete_id=event_id)
+
+        def done(_):
+            self.change_tasks(None, delete=True, delete_id=event_id)
+            if on_done is not None:
+                on_done()
+
+        if self.planner is not None:
+            return done(self.planner.record(self.KIND, 'delete', event_id))
+        self.execute('events.delete', self.get_client().delete(calendarId=calendar_id, eventId=event_id), done,
+                     on_error, key=event_id)
+
+
+class GCalendarBatch:
+    """
+    Groups Google Calendar requests in batch requests of up to MAX_SIZE requests.
+    Throttled requests of a batch are sent again in a later batch, after backing off
+    """
+    MAX_SIZE = 50
+
+    def __init__(self, service, limiter: RateLimiter):
+        self.service = service
+        self.limiter = limiter
+        self.batch = None
+        self.size = 0
+        # whether the batch can be sent again after any temporary error (it has no inserts)
+        self.idempotent = True
+        # (endpoint, request, on_done, on_error, retries made, error) of the throttled requests
+        self.retries = []
+
+    def add(self, endpoint: str, request, on_done: Callable[[Dict], Any], on_error: Callable[[Exception], None],
+            attempt: int = 0):
+        def callback(request_id, response, exception):
+            metrics.count(GCalendarApi.KIND, endpoint, exception)
+            if exception is not None:
+                if self.limiter.should_retry(exception, attempt, endpoint not in GCalendarApi.CREATE_ENDPOINTS):
+                    self.retries.append((endpoint, request, on_done, on_error, attempt, exception))
+                else:
+                    on_error(exception)
+                return
+            try:
+                on_done(response)
+            except Exception as e:
+                on_error(e)
+
+        if self.batch is None:
+            self.batch = self.service.new_batch_http_request()
+        self.batch.add(request, callback=callback)
+        self.idempotent = self.idempotent and endpoint not in GCalendarApi.CREATE_ENDPOINTS
+        self.size += 1
+        if self.size >= self.MAX_SIZE:
+            self.execute()
+
+    def execute(self):
+        while self.batch is not None:
+            batch = self.batch
+            size = self.size
+            idempotent = self.idempotent
+            self.batch = None
+            self.size = 0
+            self.idempotent = True
+
+            def send():
+                with metrics.call(GCalendarApi.KIND, 'batch'):
+                    batch.execute()
+            # each request of the batch counts towards the quota
+            self.limiter.call(send, cost=size, idempotent=idempotent)
+
+            if self.retries:
+                retries = self.retries
+                self.retries = []
+                self.limiter.sleep(max(self.limiter.backoff(k[4], k[5]) for k in retries))
+                for endpoint, request, on_done, on_error, attempt, _ in retries:
+                    self.add(endpoint, request, on_done, on_error, attempt + 1)
+
+
+class TickTickError(RuntimeError):
+    """Error answered by TickTick, with the response that ticktick_py does not keep (see TickTickApi.call)"""
+
+    def __init__(self, error: Exception, response):
+        super().__init__(f"{error} ({response.status_code} {response.reason})")
+        # as in requests.HTTPError, so that the rate limiter reads its status and Retry-After
+        self.response = response
 
 
 class TickTickApi(Api):
@@ -263,27 +1097,40 @@ class TickTickApi(Api):
         "content",
         "desc",
         "dueDate",  # Task due date time in "yyyy-MM-dd'T'HH:mm:ssZ" Example : "2019-11-13T03:00:00+0000"
-        "repeat",  # Recurring rules of task Example : "RRULE:FREQ=DAILY;INTERVAL=1"
         "startDate",  # Start date time in "yyyy-MM-dd'T'HH:mm:ssZ" Example : "2019-11-13T03:00:00+0000"
         "status",  # Task completion status Value : Normal: 0, Completed: 1
         "timeZone",
+        "repeatFlag",  # Recurring rules of task Example : "RRULE:FREQ=DAILY;INTERVAL=1"
+        "exDate",  # Excluded occurrences of a recurring task Example : ["2019-11-14T03:00:00.000+0000"]
     ]
+    KIND = 'ticktick'
+    # properties identifying a task inserted by an interrupted run (TickTick chooses the ids)
+    MATCH_PROPERTIES = ['title', 'projectId', 'startDate']
+    # a retried create whose first attempt was done creates the task twice
+    CREATE_ENDPOINTS = {'task.create'}
+    # the dates are needed to prune the tasks that ended before the sync window
+    # (the project is needed to update and complete the tasks when they are read from the saved state, see stream)
+    SNAPSHOT_PROPERTIES = ['id', 'title', 'projectId', 'startDate', 'dueDate', 'isAllDay', 'timeZone', 'repeatFlag',
+                           'exDate']
+    # the dates are read in the time zone of the task (or as days if all day), and the excluded dates with the rule
+    UPDATED_TOGETHER = [{'startDate', 'dueDate', 'isAllDay', 'timeZone'}, {'repeatFlag', 'exDate'}]
+    # properties sent in every update, to identify the task
+    KEY_PROPERTIES = ['id', 'projectId']
 
     class Task(Api.Task):
-        UPDATE_COMPARE = True
+        OPTIONAL_PROPERTIES = {'repeatFlag', 'exDate'}
 
         @staticmethod
-        def set_update_compare(compare: bool):
-            TickTickApi.Task.UPDATE_COMPARE = compare
-
-        @staticmethod
-        def get_update_compare() -> bool:
-            return TickTickApi.Task.UPDATE_COMPARE
-
-        def __init__(self, task: Dict, properties: List[str] = None):
-            if properties is None:
-                properties = TickTickApi.PROPERTIES
-            super().__init__(task, properties)
+        def normalize(key: str, value: Any) -> Any:
+            # TickTick stores the dates sent as "2019-11-13T03:00:00+0000" as "2019-11-13T03:00:00.000+0000"
+            try:
+                if key in ('startDate', 'dueDate'):
+                    return ticktick_format_date(ticktick_parse_date(value) if isinstance(value, str) else value)
+                if key == 'exDate':
+                    return sorted(ticktick_format_date(ticktick_parse_date(k)) for k in value)
+            except (TypeError, ValueError, AttributeError):
+                return value
+            return Api.Task.normalize(key, value)
 
         @property
         def title(self) -> str:
@@ -292,45 +1139,147 @@ class TickTickApi(Api):
         def __hash__(self):
             return hash(self['id'])
 
-    def __init__(self, renew: bool = False, credentials=TICKTICK, info=TICKTICK_INFO):
-        super(TickTickApi, self).__init__()
+    Task.properties = PROPERTIES
+
+    def __init__(self, renew: bool = False, credentials=TICKTICK, info=TICKTICK_INFO, workers: int = 1,
+                 store: StateStore = None, client=None, limiter: RateLimiter = None, window: SyncWindow = None,
+                 stream: bool = False):
+        """
+        :param client: TickTick client to use instead of logging in with the credentials
+        :param window: if given, only the tasks in the window are synced (TickTick has no date filters,
+            so all the tasks are downloaded and filtered)
+        :param stream: if set, the tasks are diffed project by project (see Api)
+        """
+        super(TickTickApi, self).__init__(store, limiter, window, stream)
+        if client is None:
+            with metrics.time('ticktick_login'):
+                client = self.connect(renew, credentials)
+        self.client = client
+        # last response of the client in each thread, since ticktick_py raises bare RuntimeErrors
+        self.responses = threading.local()
+        session = getattr(client, '_session', None)
+        if session is not None:
+            session.hooks['response'].append(self.record_response)
+        self.default_project_id = info['default_project_id']
+        self.excluded_projects = info['EXCLUDED_PROJECTS']
+        self.workers = workers
+        # number of reads avoided by using the create/update responses
+        self.round_trips_saved = 0
+        self.tasks = {}
+        self.changes = None
+        self.fetch()
+
+    @staticmethod
+    def connect(renew: bool, credentials: Dict):
+        from ticktick_py.ticktick.api import TickTickClient  # Main Interface
+        from ticktick_py.ticktick.oauth2 import OAuth2  # OAuth2 Manager
+
         if not (renew or path.isfile(credentials['TOKEN_FILENAME'])):
             raise Exception("Renew for ticktick needed: run with renew true")
 
         auth_client = OAuth2(client_id=credentials['CLIENT_ID'],
                              client_secret=credentials['CLIENT_SECRET'],
                              redirect_uri=credentials['REDIRECT_URI'])
-        self.client = TickTickClient(credentials['USERNAME'], credentials['PWD'], auth_client)
-        self.old_filename = info['old_filename']
-        self.default_project_id = info['default_project_id']
+        return TickTickClient(credentials['USERNAME'], credentials['PWD'], auth_client)
+
+    def record_response(self, response, *args, **kwargs):
+        self.responses.last = response
+
+    def call(self, endpoint: str, fn: Callable[[], T]) -> T:
+        """
+        Sends a request as Api.call, raising the errors of ticktick_py (a RuntimeError for any status) as
+        TickTickError, with their response, so that throttled and temporary errors are retried
+        """
+        def request():
+            self.responses.last = None
+            try:
+                return fn()
+            except RuntimeError as e:
+                response = getattr(self.responses, 'last', None)
+                if response is None or response.ok:
+                    raise e
+                raise TickTickError(e, response) from e
+        return super().call(endpoint, request)
+
+    def fetch(self):
         #  change this to include all tasks and exclude tasks from projects if want to include inbox
         self.tasks = {}
-        for project in self.client.state['projects']:
-            if project['id'] not in info['EXCLUDED_PROJECTS']:
-                self.tasks.update({k['id']: self.Task(k) for k in self.client.task.get_from_project(project['id'])})
-        # for project in self.client.state['projects']:
-        #     if project['id'] not in info['EXCLUDED_PROJECTS']:
-        #         tasks.extend(self.client.task.get_from_project(project['id']))
-        # self.tasks = {k['id']: self.Task(k) for k in tasks}
+        project_ids = [k['id'] for k in self.client.state['projects'] if k['id'] not in self.excluded_projects]
+
+        def get_from_project(project_id: str) -> List[Dict]:
+            return self.call('task.get_from_project', lambda: self.client.task.get_from_project(project_id))
+
+        with metrics.time('ticktick_fetch'):
+            if self.window is not None:
+                self.window.move()
+                self.prune_old_tasks()
+            if self.stream:
+                # the projects are fetched one at a time, so only one is kept in memory
+                pages = ({k['id']: self.Task(k) for k in get_from_project(project_id)} for project_id in project_ids)
+                self.changes = diff_pages(pages, self.store, self.KIND, self.Task,
+                                          keep=lambda task, saved: saved or self.in_window(task),
+                                          snapshot_properties=self.SNAPSHOT_PROPERTIES)
+                self.tasks = StoredTasks(self.store, self.KIND, self.Task, self.changes)
+            else:
+                for project_tasks in run_concurrently(get_from_project, project_ids, self.workers,
+                                                      'TickTick projects'):
+                    self.tasks.update({k['id']: self.Task(k) for k in project_tasks})
+                self.tasks = self.filter_window(self.tasks)
+        metrics.items(self.KIND, 'fetched', len(self.tasks) if self.changes is None else len(self.changes))
+
+    def refresh(self):
+        """Fetches the current tasks reusing the logged in client"""
+        self.call('sync', self.client.sync)
+        self.fetch()
 
     def get_client(self):
         return self.client
 
+    @staticmethod
+    def get_dates(task: Dict) -> Tuple[Optional[datetime], Optional[datetime]]:
+        try:
+            start = ticktick_parse_date(task.get('startDate', None))
+            end = ticktick_parse_date(task.get('dueDate', None))
+        except ValueError:
+            return None, None
+        return start or end, end or start
+
+    @staticmethod
+    def get_series(task: Dict) -> Optional[Series]:
+        return ticktick_get_series(task)
+
+    def find_inserted(self, entry: Dict, synced: Callable[[str], bool]) -> Optional[Task]:
+        tasks = self.get_tasks()
+        if entry.get('target', None) is not None:
+            return tasks.get(entry['target'], None)
+        match = entry.get('match', None) or {}
+
+        def same(value, expected) -> bool:
+            if value == expected:
+                return True
+            try:
+                return ticktick_parse_date(value) == ticktick_parse_date(expected)
+            except (TypeError, ValueError, AttributeError):
+                return False
+
+        for task_id, task in tasks.items():
+            if not synced(task_id) and all(same(task.get(k, None), v) for k, v in match.items()):
+                return task
+        return None
+
+    def is_deleted(self, task_id: str) -> bool:
+        # completed tasks are not fetched
+        return task_id not in self.get_tasks()
+
     def get_tasks(self) -> Dict[str, Task]:
         return self.tasks
 
-    def get_old_tasks(self, file_name: str = None) -> Dict[str, Task]:
-        if file_name is None:
-            file_name = self.old_filename
-        return super().get_old_tasks(file_name)
-
-    def save_old_tasks(self, file_name: str = None):
-        if file_name is None:
-            file_name = self.old_filename
-        super().save_old_tasks(file_name)
+    def get_changes(self) -> Optional[Dict[str, Optional[Task]]]:
+        return self.changes
 
     def build_task(self, title: str, content: str, start: datetime, end: datetime, all_day: bool, time_zone: str,
-                   task=None, project_id: str = None):
+                   task=None, project_id: str = None, repeat: str = None, ex_dates: List[datetime] = None):
+        """repeat (RRULE) and ex_dates make it a recurring task, or a single one if the task was recurring"""
         if task is None:
             if project_id is None:
                 project_id = self.default_project_id
@@ -351,60 +1300,203 @@ class TickTickApi(Api):
             task['dueDate'] = end
             task['startDate'] = start
             task['timeZone'] = time_zone
+        if repeat or task.get('repeatFlag', None):
+            task['repeatFlag'] = repeat or ""
+            task['exDate'] = [ticktick_format_date(k) for k in ex_dates or []]
         return task
 
-    def update(self, task: Task):
-        self.get_client().task.update(task)
-        task = self.get_client().get_by_id(task['id'], search='tasks')
-        self.change_tasks(TickTickApi.Task(task))
+    def merge_response(self, task: Dict, response, sent: Dict = None) -> Task:
+        """
+        Builds the task from the create/update response and the task written.
+        The task is only read again if the response is missing any of the sent properties
+        :param sent: properties sent, if not the whole task
+        """
+        if sent is None:
+            sent = task
+        if isinstance(response, dict) and 'id' in response and all(k in response for k in self.PROPERTIES if k in sent):
+            # the responses of a plan are made up, no read is saved
+            if self.planner is None:
+                self.round_trips_saved += 1
+            merged = dict(task)
+            merged.update(response)
+            return TickTickApi.Task(merged)
+        task_id = response['id'] if isinstance(response, dict) and 'id' in response else task['id']
+        return TickTickApi.Task(self.call('get_by_id', lambda: self.get_client().get_by_id(task_id, search='tasks')))
+
+    def write(self, endpoint: str, operation: str, task: Dict, fn: Callable[[], Any],
+              on_done: Callable[[Any], Any], on_error: Callable[[Exception], None] = None, sent: Dict = None):
+        """
+        Sends a write (or records it if planning), see Api.submit.
+        The responses of inserts and updates are merged with the task written (see merge_response)
+        :param sent: properties sent by fn, if not the whole task
+        """
+        merge = operation in ('insert', 'update')
+        if self.planner is not None:
+            body = dict(sent if sent is not None else task) if merge else None
+            response = self.planner.record(self.KIND, operation, task.get('id', None), body)
+            return on_done(self.merge_response(task, response, sent) if merge else response)
+
+        def send():
+            response = self.call(endpoint, fn)
+            # reading the task again, if needed, is also done by the engine thread if there is one
+            return self.merge_response(task, response, sent) if merge else response
+
+        return self.submit(task.get('id', None), send, on_done, on_error, endpoint)
+
+    def update(self, task: Task, on_done: Callable[[Task], None] = None, on_error: Callable[[Exception], None] = None):
+        def done(updated: TickTickApi.Task):
+            self.wrote(updated)
+            self.change_tasks(updated)
+            if on_done is not None:
+                on_done(updated)
+            return updated
+
+        # only the changed properties are sent, so that the rest are not overwritten with stale values
+        fields = self.changed_properties(task)
+        if fields is None:
+            payload = task
+        elif not fields:
+            metrics.items(self.KIND, 'unchanged')
+            return done(TickTickApi.Task(task))
+        else:
+            payload = {k: task[k] for k in self.KEY_PROPERTIES + fields if k in task}
+        return self.write('task.update', 'update', task, lambda: self.get_client().task.update(payload), done,
+                          on_error, payload)
+
+    def insert(self, task: Task, on_done: Callable[[Task], None] = None,
+               on_error: Callable[[Exception], None] = None) -> Optional[Task]:
+        """:return: the added task, or None if there is an engine (use on_done instead)"""
+        def done(added: TickTickApi.Task):
+            self.wrote(added)
+            self.change_tasks(added)
+            if on_done is not None:
+                on_done(added)
+            return added
+
+        return self.write('task.create', 'insert', task, lambda: self.get_client().task.create(task), done, on_error)
 
-    def insert(self, task: Task) -> Task:
-        task_id = self.get_client().task.create(task)['id']
-        added = TickTickApi.Task(self.get_client().get_by_id(task_id, search='tasks'))
-        self.change_tasks(added)
-        return added
+    def delete(self, task: Task, on_done: Callable[[], None] = None, on_error: Callable[[Exception], None] = None):
+        def done(_):
+            self.change_tasks(task, delete=True)
+            if on_done is not None:
+                on_done()
 
-    def delete(self, task: Task):
-        self.get_client().task.delete(task)
-        self.change_tasks(task, delete=True)
+        self.write('task.delete', 'delete', task, lambda: self.get_client().task.delete(task), done, on_error)
 
-    def complete(self, task: Task):
-        self.get_client().task.complete(task)
-        self.change_tasks(task, delete=True)
+    def complete(self, task: Task, on_done: Callable[[], None] = None, on_error: Callable[[Exception], None] = None):
+        def done(_):
+            self.change_tasks(task, delete=True)
+            if on_done is not None:
+                on_done()
+
+        self.write('task.complete', 'complete', task, lambda: self.get_client().task.complete(task), done, on_error)
 
 
 class Diff(ABC):
-    def __init__(self, api: Api):
-        old = set(api.get_old_tasks().values())
-        tasks = set(api.get_tasks().values())
-        api.__class__.Task.set_update_compare(False)
-        self.added = tasks - old
-        self.deleted = old - tasks
-        api.__class__.Task.set_update_compare(True)
-        self.updated = tasks - old - self.added
+    def __init__(self, api: Api, plan: ChangePlan = None, journal: Journal = None):
+        """
+        :param plan: if given, only the changes in the plan that still apply are synced
+        :param journal: if given, the inserts and deletes are journaled before being sent
+        """
+        self.journal = journal
+        tasks = api.get_tasks()
+        old = api.get_old_tasks()
+        if plan is None:
+            self.plan = make_plan(tasks, old, api.get_changes())
+        else:
+            self.plan = ChangePlan(added=[k for k in plan.added if k in tasks],
+                                   updated=[k for k in plan.updated if k.id in tasks],
+                                   deleted=[k for k in plan.deleted if k in old])
+        # updates that only reflect a write of the sync (e.g., dates normalized by the api) are not synced back
+        echoes = {k.id for k in self.plan.updated if api.is_echo(tasks[k.id])}
+        for k in echoes:
+            # still the state of the write
+            tasks[k].written = old[k].written
+            api.change_tasks(tasks[k])
+        self.plan.updated = [k for k in self.plan.updated if k.id not in echoes]
+        self.suppressed = len(echoes)
+        metrics.items(api.KIND, 'suppressed', self.suppressed)
+        self.added = deque(tasks[k] for k in self.plan.added)
+        self.updated = deque(tasks[k.id] for k in self.plan.updated)
+        self.deleted = deque(old[k] for k in self.plan.deleted)
+
+    def __len__(self):
+        return len(self.plan)
+
+    def intend(self, op: str, kind: str, source: Api.Task, target: str = None, match: Dict = None) -> Optional[int]:
+        if self.journal is None:
+            return None
+        return self.journal.intend(op, kind, source['id'], target, match, source.fingerprint)
+
+    def done(self, seq: Optional[int], target: str = None):
+        if seq is not None:
+            self.journal.done(seq, target)
+
+    def failed(self, seq: Optional[int], e: Exception):
+        """
+        Only writes the api refused (4xx) are known not to be written. After server errors they may have been,
+        so they are kept pending and looked up by the next run (see resume)
+        """
+        from ratelimit import error_status
+
+        status = error_status(e)
+        if seq is not None and status is not None and status < 500:
+            self.journal.failed(seq)
+
+    def on_error(self, task: Api.Task, seq: int = None) -> Callable[[Exception], None]:
+        """Error handler for the writes: the task will be retried in the next sync"""
+        def f(e: Exception):
+            self.failed(seq, e)
+            self.api.get_tasks().pop(task['id'], None)
+            do_on_exception(e)
+        return f
+
+    def resumed(self, is_synced: Callable[[Dict], bool]):
+        """Added tasks already synced (inserted by an interrupted run, see resume) are updated instead"""
+        resumed = [k for k in self.added if is_synced(k)]
+        if resumed:
+            self.updated.extend(resumed)
+            self.added = deque(k for k in self.added if not is_synced(k))
+
+
+def ticktick_get_recurrence(task: Dict) -> Optional[List[str]]:
+    """Google Calendar recurrence of a repeating task (None if not repeating)"""
+    ex_dates = []
+    for value in task.get('exDate', None) or []:
+        try:
+            ex_dates.append(ticktick_parse_date(value))
+        except ValueError:
+            pass
+    return repeat_to_recurrence(task.get('repeatFlag', None), ex_dates, task.get('isAllDay', False))
 
 
 class TickTickDiff(Diff):
-    def __init__(self, api: TickTickApi):
-        super().__init__(api)
+    def __init__(self, api: TickTickApi, plan: ChangePlan = None, journal: Journal = None):
+        super().__init__(api, plan, journal)
         self.api = api
 
     def sync_gcalendar(self, gcalendar_api: GCalendarApi, bidict_tick_gcalendar: BiDict[str, str]):
         gcal_tasks = gcalendar_api.get_tasks()
+        self.resumed(lambda k: bidict_tick_gcalendar.get(k['id'], None) in gcal_tasks)
         # Update
         while self.updated:
-            task = self.updated.pop()
+            task = self.updated.popleft()
             print(f"Update {self.__class__}: {task.title}")
             try:
                 id_gcal = bidict_tick_gcalendar.get(task['id'], None)
                 if id_gcal is None:
-                    self.added.add(task)
+                    self.added.append(task)
                     continue
                 task_gcal = gcal_tasks[id_gcal]
                 if 'startDate' not in task or 'dueDate' not in task:
-                    gcalendar_api.delete(id_gcal)
-                    self.api.change_tasks(task)
-                    del bidict_tick_gcalendar[task['id']]
+                    seq = self.intend(DELETE, GCalendarApi.KIND, task, id_gcal)
+
+                    def unscheduled(task=task, seq=seq):
+                        self.done(seq)
+                        self.api.change_tasks(task)
+                        del bidict_tick_gcalendar[task['id']]
+
+                    gcalendar_api.delete(id_gcal, on_done=unscheduled, on_error=self.on_error(task, seq))
                     continue
                 start, all_day = ticktick_get_datetime(task, True)
                 end, all_day = ticktick_get_datetime(task, False)
@@ -412,22 +1504,25 @@ class TickTickDiff(Diff):
                 #     start += timedelta(days=1)
                 #     end += timedelta(days=1)
 
+                # built on a copy, so that the update is diffed against the current one
                 task_gcal = gcalendar_api.build_event(
                     summary=task['title'],
                     start=start.date() if all_day else start,
                     end=end.date() if all_day else end,
                     description=task.get('content', None),
-                    event=task_gcal
+                    event=dict(task_gcal),
+                    time_zone=task.get('timeZone', None),
+                    recurrence=ticktick_get_recurrence(task)
                 )
-                gcalendar_api.update(task_gcal)
-                self.api.change_tasks(task)
+                gcalendar_api.update(task_gcal, on_done=lambda _, task=task: self.api.change_tasks(task),
+                                     on_error=self.on_error(task))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
         # Insert
         while self.added:
-            task = self.added.pop()
+            task = self.added.popleft()
             print(f"Add {self.__class__}: {task.title}")
             try:
                 if 'startDate' not in task or 'dueDate' not in task:
@@ -439,67 +1534,115 @@ class TickTickDiff(Diff):
                 #     start += timedelta(days=1)
                 #     end += timedelta(days=1)
 
-                added_id = gcalendar_api.insert(gcalendar_api.build_event(
+                event = gcalendar_api.build_event(
                     summary=task['title'],
                     start=start.date() if all_day else start,
                     end=end.date() if all_day else end,
-                    description=task.get('content', None)
-                ))['id']
-                self.api.change_tasks(task)
-                bidict_tick_gcalendar[task['id']] = added_id
+                    description=task.get('content', None),
+                    time_zone=task.get('timeZone', None),
+                    recurrence=ticktick_get_recurrence(task)
+                )
+                if self.journal is not None:
+                    # the id is chosen before inserting, so that an interrupted insert can be found
+                    event['id'] = new_id()
+                seq = self.intend(INSERT, GCalendarApi.KIND, task, event.get('id', None))
+
+                def inserted(added, task=task, seq=seq):
+                    self.done(seq, added['id'])
+                    self.api.change_tasks(task)
+                    bidict_tick_gcalendar[task['id']] = added['id']
+
+                gcalendar_api.insert(event, on_done=inserted, on_error=self.on_error(task, seq))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
         # Delete
         while self.deleted:
-            task = self.deleted.pop()
+            task = self.deleted.popleft()
             print(f"Delete {self.__class__}: {task.title}")
             try:
                 if 'startDate' not in task or 'dueDate' not in task:
                     self.api.change_tasks(task, delete=True)
                     continue
                 gcal_id = bidict_tick_gcalendar[task['id']]
+                seq = self.intend(DELETE, GCalendarApi.KIND, task, gcal_id)
+
+                def deleted(task=task, seq=seq):
+                    self.done(seq)
+                    self.api.change_tasks(task, delete=True)
+                    del bidict_tick_gcalendar[task['id']]
 
-                gcalendar_api.delete(gcal_id)
-                self.api.change_tasks(task, delete=True)
-                del bidict_tick_gcalendar[task['id']]
+                gcalendar_api.delete(gcal_id, on_done=deleted, on_error=self.on_error(task, seq))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
+        gcalendar_api.flush()
+
 
 class GCalendarDiff(Diff):
-    def __init__(self, api: GCalendarApi):
-        super().__init__(api)
+    def __init__(self, api: GCalendarApi, plan: ChangePlan = None, journal: Journal = None):
+        super().__init__(api, plan, journal)
         self.api = api
 
+    def get_next(self, task: GCalendarApi.Task, now: datetime) \
+            -> Tuple[datetime, datetime, bool, Optional[Series]]:
+        """Start, end and whether it is all day of the event, or of its next occurrence if recurring, and its series"""
+        start, all_day = gcalendar_get_datetime(task['start'])
+        end, _ = gcalendar_get_datetime(task['end'])
+        series = self.api.get_series(task)
+        if series is not None:
+            next_start = series.next(now)
+            if next_start is not None:
+                import pytz
+                # in the zone of the event (the offset of the first occurrence may differ after a DST change)
+                time_zone = task['start'].get('timeZone', None)
+                start = next_start.astimezone(pytz.timezone(time_zone) if time_zone else start.tzinfo)
+                end = start + series.duration
+        return start, end, all_day, series
+
+    @staticmethod
+    def expired(start: datetime, series: Optional[Series], now: datetime) -> bool:
+        """Whether the event (or all the occurrences of a recurring event) already started"""
+        if series is not None:
+            return series.next(now) is None
+        return start < now
+
     def sync_ticktick(self, ticktick_api: TickTickApi, bidict_tick_gcalendar: BiDict[str, str]):
+        import pytz
+
         now = datetime.utcnow().replace(tzinfo=pytz.UTC)
         tick = ticktick_api.get_client().task
         tick_tasks = ticktick_api.get_tasks()
+        self.resumed(lambda k: any(t in tick_tasks for t in bidict_tick_gcalendar.inverse.get(k['id'], [])))
 
         # Updated
         while self.updated:
-            task = self.updated.pop()
+            task = self.updated.popleft()
             print(f"Update {self.__class__}: {task.title}")
             try:
                 id_tick = bidict_tick_gcalendar.inverse.get(task['id'], None)
                 if id_tick is None:
-                    self.added.add(task)
+                    self.added.append(task)
                     continue
                 task_tick = tick_tasks[id_tick[0]]
-                start, all_day = gcalendar_get_datetime(task['start'])
-                end, _ = gcalendar_get_datetime(task['end'])
-                time_zone = get_timezone_name(start)
+                start, end, all_day, series = self.get_next(task, now)
+                time_zone = get_timezone_name(start, task['start'].get('timeZone', None))
                 tick_date = tick.dates(start=start, due=end, tz=time_zone)
                 if all_day:     # fix for time in ticktick
                     end -= timedelta(days=1)
-                if start < now:  # if after, then delete
-                    tick.delete(task_tick)
-                    self.api.change_tasks(task)
-                    del bidict_tick_gcalendar[task_tick['id']]
+                if self.expired(start, series, now):  # if after, then delete
+                    seq = self.intend(DELETE, TickTickApi.KIND, task, task_tick['id'])
+
+                    def expired(task=task, task_tick=task_tick, seq=seq):
+                        self.done(seq)
+                        self.api.change_tasks(task)
+                        del bidict_tick_gcalendar[task_tick['id']]
+
+                    ticktick_api.delete(task_tick, on_done=expired, on_error=self.on_error(task, seq))
                     continue
+                # built on a copy, so that the update is diffed against the current one
                 task_tick = ticktick_api.build_task(
                     title=task.get('summary', ""),
                     all_day=all_day,
@@ -507,114 +1650,481 @@ class GCalendarDiff(Diff):
                     end=tick_date['dueDate'],
                     start=tick_date['startDate'],
                     time_zone=time_zone,
-                    task=task_tick
+                    task=dict(task_tick),
+                    repeat=series.rule if series is not None else None,
+                    ex_dates=series.ex_dates if series is not None else None
                 )
 
-                ticktick_api.update(task_tick)
-                self.api.change_tasks(task)
+                ticktick_api.update(task_tick, on_done=lambda _, task=task: self.api.change_tasks(task),
+                                    on_error=self.on_error(task))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
         # Insert
         while self.added:
-            task = self.added.pop()
+            task = self.added.popleft()
             print(f"Add {self.__class__}: {task.title}")
             try:
-                start, all_day = gcalendar_get_datetime(task['start'])
-                end, _ = gcalendar_get_datetime(task['end'])
-                time_zone = get_timezone_name(start)
+                start, end, all_day, series = self.get_next(task, now)
+                time_zone = get_timezone_name(start, task['start'].get('timeZone', None))
                 if all_day:     # fix for time in ticktick
                     end -= timedelta(days=1)
-                if start < now:
+                if self.expired(start, series, now):
                     self.api.change_tasks(task)
                     continue
 
-                added_id = ticktick_api.insert(ticktick_api.build_task(
+                task_tick = ticktick_api.build_task(
                     title=task.get('summary', ""),
                     content=task.get('description', ""),
                     all_day=all_day,
                     start=start,
                     end=end,
-                    time_zone=time_zone
-                ))['id']
-                self.api.change_tasks(task)
-                bidict_tick_gcalendar[added_id] = task['id']
+                    time_zone=time_zone,
+                    repeat=series.rule if series is not None else None,
+                    ex_dates=series.ex_dates if series is not None else None
+                )
+                # TickTick chooses the ids, so an interrupted insert is found by its properties
+                seq = self.intend(INSERT, TickTickApi.KIND, task,
+                                  match={k: task_tick.get(k, None) for k in TickTickApi.MATCH_PROPERTIES})
+
+                def inserted(added, task=task, seq=seq):
+                    self.done(seq, added['id'])
+                    self.api.change_tasks(task)
+                    bidict_tick_gcalendar[added['id']] = task['id']
+
+                ticktick_api.insert(task_tick, on_done=inserted, on_error=self.on_error(task, seq))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
         # Delete
         while self.deleted:
-            task = self.deleted.pop()
+            task = self.deleted.popleft()
             print(f"Delete {self.__class__}: {task.title}")
             try:
                 task_tick_id = bidict_tick_gcalendar.get_inverse(task['id'])[0]
 
                 task_tick = tick_tasks[task_tick_id]
-                ticktick_api.complete(task_tick)
-                self.api.change_tasks(task, delete=True)
-                del bidict_tick_gcalendar[task_tick_id]
+                seq = self.intend(DELETE, TickTickApi.KIND, task, task_tick_id)
+
+                def completed(task=task, task_tick_id=task_tick_id, seq=seq):
+                    self.done(seq)
+                    self.api.change_tasks(task, delete=True)
+                    del bidict_tick_gcalendar[task_tick_id]
+
+                ticktick_api.complete(task_tick, on_done=completed, on_error=self.on_error(task, seq))
             except Exception as e:
                 self.api.get_tasks().pop(task['id'], None)
                 do_on_exception(e)
 
-
-def main(args):
+        ticktick_api.flush()
+
+
+def open_state_store(db_file: str = None, google_info: Dict = None, ticktick_info: Dict = None) -> StateStore:
+    """
+    Opens the state saved in files or, if db_file is given, in a SQLite database.
+    A new database is filled with the state saved in files
+    """
+    google_info = google_info or GOOGLE_INFO
+    ticktick_info = ticktick_info or TICKTICK_INFO
+    files = FileStateStore(
+        task_files={GCalendarApi.KIND: google_info['old_filename'], TickTickApi.KIND: ticktick_info['old_filename']},
+        bidict_file=BIDICT_PATH,
+        value_files={GCalendarApi.SYNC_TOKENS: google_info.get('sync_tokens_filename',
+                                                               f"{google_info['old_filename']}.tokens"),
+                     GCalendarApi.SERIES_EXCEPTIONS: f"{google_info['old_filename']}.exceptions"},
+    )
+    if db_file is None:
+        return files
+    new = not path.isfile(db_file)
+    store = SqliteStateStore(db_file)
+    if new:
+        print(f"Migrating saved state to {db_file}")
+        store.migrate(files, kinds=[GCalendarApi.KIND, TickTickApi.KIND],
+                      keys=[GCalendarApi.SYNC_TOKENS, GCalendarApi.SERIES_EXCEPTIONS])
+    return store
+
+
+def main(args, account: Dict[str, Dict] = None, shared_limits: Dict[str, object] = None):
+    """
+    :param account: account information (GOOGLE, GOOGLE_INFO, TICKTICK, TICKTICK_INFO), account_info.py if None
+    :param shared_limits: semaphores limiting the requests in flight to each api by all the processes of a
+        multi-account run (see tenants.shared_limit)
+    """
+    shared_limits = shared_limits or {}
+    if account is None:
+        if GOOGLE_INFO is None:
+            sys.exit("account_info.py not found: set it up from account_info_example.py (or use --tenants)")
+        account = {'GOOGLE': GOOGLE, 'GOOGLE_INFO': GOOGLE_INFO, 'TICKTICK': TICKTICK, 'TICKTICK_INFO': TICKTICK_INFO}
     if not path.exists("data"):
         os.makedirs("data")
+    store = open_state_store(args.state_db, account['GOOGLE_INFO'], account['TICKTICK_INFO'])
 
-    tick = TickTickApi(renew=args.renew)
-    gtasks = GCalendarApi(renew=args.renew)
-    if args.renew:
+    # local maintenance commands do not need the clients
+    if args.remove_tick is not None or args.remove_gcal is not None:
+        remove_synced(store, args.remove_tick, args.remove_gcal)
         return
-    bidict_path = 'data/bidict_ticktick_gcalendar.dict'
 
-    if args.tick_print:
+    window = None
+    if args.window_past is not None or args.window_future is not None:
+        window = SyncWindow(past=timedelta(days=args.window_past if args.window_past is not None else 1),
+                            future=timedelta(days=args.window_future) if args.window_future is not None else None)
+
+    tick = TickTickApi(renew=args.renew, credentials=account['TICKTICK'], info=account['TICKTICK_INFO'],
+                       workers=args.workers, store=store,
+                       limiter=RateLimiter(TickTickApi.KIND, rate=args.ticktick_rate, max_in_flight=args.max_in_flight,
+                                           shared=shared_limits.get(TickTickApi.KIND, None)),
+                       window=window, stream=args.stream)
+    if args.tick_print and not args.renew:
         print(tick.get_client().state['projects'])
         return
+    gtasks = GCalendarApi(renew=args.renew, credentials=account['GOOGLE'], info=account['GOOGLE_INFO'],
+                          incremental=args.incremental or args.push is not None, batch=args.batch,
+                          workers=args.workers, store=store,
+                          limiter=RateLimiter(GCalendarApi.KIND, rate=args.google_rate,
+                                              max_in_flight=args.max_in_flight,
+                                              shared=shared_limits.get(GCalendarApi.KIND, None)),
+                          window=window, stream=args.stream)
+    if args.renew:
+        return
 
-    if path.isfile(bidict_path):
-            bidict_ticktick_gcalendar = BiDict.load(bidict_path)
-    else:
-        bidict_ticktick_gcalendar = BiDict()
+    bidict_ticktick_gcalendar = store.load_bidict()
 
-    if args.remove_tick is not None:
-        del tick.get_old_tasks()[args.remove_tick]
-        gcal_id = bidict_ticktick_gcalendar.pop(args.remove_tick, None)
-        if gcal_id is not None:
-            del gtasks.get_old_tasks()[gcal_id]
-        print(f"Deleted id {args.remove_tick}")
-        bidict_ticktick_gcalendar.save(bidict_path)
-        gtasks.save_old_tasks()
-        tick.save_old_tasks()
-        return
-    elif args.remove_gcal is not None:
-        del gtasks.get_old_tasks()[args.remove_gcal]
-        tick_id = bidict_ticktick_gcalendar.inverse.get(args.remove_gcal, None)
-        if tick_id is not None:
-            del bidict_ticktick_gcalendar[tick_id]
-            del tick.get_old_tasks()[tick_id]
-        print(f"Deleted id {args.remove_gcal}")
-        bidict_ticktick_gcalendar.save(bidict_path)
-        gtasks.save_old_tasks()
-        tick.save_old_tasks()
-        return
-    elif args.delete_all_gcal:
+    if args.delete_all_gcal:
         for event_id in list(gtasks.get_tasks().keys()):
             gtasks.delete(event_id)
+        gtasks.flush()
         print("You can now delete the data folder")
         return
 
+    if args.plan is not None:
+        # writes are only recorded and the state is not saved
+        tick.planner = gtasks.planner = Planner()
+        plans = sync(tick, gtasks, bidict_ticktick_gcalendar)
+        output = json.dumps({
+            'plans': {k: v.to_dict() for k, v in plans.items()},
+            'operations': tick.planner.operations,
+        }, indent=2, default=str)
+        if args.plan == '-':
+            print(output)
+        else:
+            with open(args.plan, 'w') as plan_file:
+                plan_file.write(output)
+            print(f"Plan with {len(tick.planner.operations)} operations saved to {args.plan}")
+        return
+
+    journal = Journal(JOURNAL_PATH)
+    if args.engine is not None or args.async_engine:
+        from engine import ENGINES
+
+        # both apis share the engine, each limited to max_in_flight requests by its rate limiter
+        tick.engine = gtasks.engine = ENGINES[args.engine or 'async'](workers=2 * args.max_in_flight)
+    if args.push is not None:
+        run_push(args, tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+        return
+    if args.daemon:
+        run_daemon(args, tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+        return
+
+    plans = None
+    if args.apply is not None:
+        with open(args.apply, 'r') as plan_file:
+            plans = {k: ChangePlan.from_dict(v) for k, v in json.load(plan_file)['plans'].items()}
+
+    success = False
     try:
-        GCalendarDiff(gtasks).sync_ticktick(tick, bidict_ticktick_gcalendar)
-        TickTickDiff(tick).sync_gcalendar(gtasks, bidict_ticktick_gcalendar)
+        sync(tick, gtasks, bidict_ticktick_gcalendar, plans, journal)
+        success = True
     except Exception as e:
         raise e
     finally:
-        bidict_ticktick_gcalendar.save(bidict_path)
+        save_state(tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+        export_metrics(args, success)
+
+
+def sync_tenant(args, tenant) -> Dict[str, float]:
+    """Syncs a tenants.Tenant (run in its directory by a worker of the pool), :return: the seconds of each phase"""
+    from tenants import shared_limit
+
+    metrics.reset()
+    main(args, tenant.account, {k: shared_limit(k) for k in (TickTickApi.KIND, GCalendarApi.KIND)})
+    return {k.split('=', 1)[1]: v['sum'] for k, v in metrics.to_dict().get('phase_duration_seconds', {}).items()}
+
+
+def main_tenants(args) -> bool:
+    """
+    Syncs every tenant of the tenants directory in a pool of processes.
+    The request rates are split between the processes and the requests in flight are limited across all of them
+    :return: whether all the tenants were synced
+    """
+    import copy
+    import functools
+    from tenants import load_tenants, run_tenants, print_report
+
+    tenants = load_tenants(args.tenants)
+    processes = max(1, min(args.processes, len(tenants)))
+    tenant_args = copy.copy(args)
+    if args.google_rate:
+        tenant_args.google_rate = args.google_rate / processes
+    if args.ticktick_rate:
+        tenant_args.ticktick_rate = args.ticktick_rate / processes
+    print(f"Syncing {len(tenants)} tenants with {processes} processes")
+    results = run_tenants(functools.partial(sync_tenant, tenant_args), tenants, processes, max_in_flight={
+        GCalendarApi.KIND: args.global_max_in_flight,
+        TickTickApi.KIND: args.global_max_in_flight,
+    })
+    print_report(results)
+    return all(k.success for k in results)
+
+
+def remove_synced(store: StateStore, tick_id: str = None, gcal_id: str = None):
+    """Removes a task from the saved state (by TickTick or Google Calendar id) so that it is synced again"""
+    bidict_ticktick_gcalendar = store.load_bidict()
+    tick_old = store.load_tasks(TickTickApi.KIND)
+    gcal_old = store.load_tasks(GCalendarApi.KIND)
+    if tick_id is not None:
+        del tick_old[tick_id]
+        gcal_id = bidict_ticktick_gcalendar.pop(tick_id, None)
+        if gcal_id is not None:
+            del gcal_old[gcal_id]
+        print(f"Deleted id {tick_id}")
+    else:
+        del gcal_old[gcal_id]
+        tick_ids = bidict_ticktick_gcalendar.inverse.get(gcal_id, None)
+        if tick_ids:
+            tick_id = tick_ids[0]
+            del tick_old[tick_id]
+            del bidict_ticktick_gcalendar[tick_id]
+        print(f"Deleted id {gcal_id}")
+    store.save_bidict(bidict_ticktick_gcalendar)
+    store.save_tasks(GCalendarApi.KIND, gcal_old, {gcal_id} if gcal_id is not None else set())
+    store.save_tasks(TickTickApi.KIND, tick_old, {tick_id} if tick_id is not None else set())
+    # the removed events would not be fetched again by an incremental sync
+    store.save_value(GCalendarApi.SYNC_TOKENS, {})
+    store.commit()
+
+
+def sync(tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict,
+         plans: Dict[str, ChangePlan] = None, journal: Journal = None) -> Dict[str, ChangePlan]:
+    """
+    :param plans: if given, only the changes in these plans (by api kind) are synced
+    :param journal: if given, the writes are journaled and those of an interrupted run are resumed first
+    :return: plans synced by api kind
+    """
+    if plans is None:
+        plans = {}
+    if journal is not None:
+        with metrics.time('resume'):
+            resume(journal, tick, gtasks, bidict_ticktick_gcalendar)
+    prune_synced(tick, gtasks, bidict_ticktick_gcalendar)
+
+    with metrics.time('google_plan') as planned:
+        gcalendar_diff = GCalendarDiff(gtasks, plans.get(GCalendarApi.KIND, None), journal)
+    count_plan(GCalendarApi.KIND, gcalendar_diff.plan)
+    with metrics.time('google_to_ticktick') as synced:
+        gcalendar_diff.sync_ticktick(tick, bidict_ticktick_gcalendar)
+    print(f"Google Calendar: {len(gcalendar_diff)} changes, plan {planned.elapsed:.2f}s, sync {synced.elapsed:.2f}s")
+
+    with metrics.time('ticktick_plan') as planned:
+        ticktick_diff = TickTickDiff(tick, plans.get(TickTickApi.KIND, None), journal)
+    count_plan(TickTickApi.KIND, ticktick_diff.plan)
+    with metrics.time('ticktick_to_google') as synced:
+        ticktick_diff.sync_gcalendar(gtasks, bidict_ticktick_gcalendar)
+    print(f"TickTick: {len(ticktick_diff)} changes, plan {planned.elapsed:.2f}s, sync {synced.elapsed:.2f}s")
+    print(f"TickTick round trips saved: {tick.round_trips_saved}")
+    suppressed = gcalendar_diff.suppressed + ticktick_diff.suppressed
+    print(f"Redundant writes suppressed (own writes not synced back): {suppressed}")
+    if tick.engine is not None:
+        print("Writes sent by the engine:")
+        tick.engine.report()
+    return {GCalendarApi.KIND: gcalendar_diff.plan, TickTickApi.KIND: ticktick_diff.plan}
+
+
+def sync_notified(tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict,
+                  calendar_ids: List[str], journal: Journal = None) -> ChangePlan:
+    """
+    Syncs to TickTick only the changes of some Google Calendar calendars (e.g., those notified, see run_push),
+    fetched incrementally
+    :return: plan synced
+    """
+    gtasks.refresh(calendar_ids)
+    with metrics.time('google_plan') as planned:
+        gcalendar_diff = GCalendarDiff(gtasks, journal=journal)
+    count_plan(GCalendarApi.KIND, gcalendar_diff.plan)
+    with metrics.time('google_to_ticktick') as synced:
+        gcalendar_diff.sync_ticktick(tick, bidict_ticktick_gcalendar)
+    print(f"Google Calendar ({', '.join(calendar_ids)}): {len(gcalendar_diff)} changes, "
+          f"plan {planned.elapsed:.2f}s, sync {synced.elapsed:.2f}s")
+    return gcalendar_diff.plan
+
+
+def resume(journal: Journal, tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict):
+    """
+    Applies to the state the writes journaled by an interrupted run, so that the tasks it inserted are updated
+    instead of inserted again and the ones it deleted are not deleted again.
+    Writes without an answer are looked up in the api written
+    """
+    apis = {GCalendarApi.KIND: gtasks, TickTickApi.KIND: tick}
+    resumed = 0
+    for entry in journal.replay():
+        api = apis[entry['kind']]
+        other = tick if api is gtasks else gtasks
+        if entry['op'] == INSERT:
+            if api is gtasks:
+                task = api.find_inserted(entry, lambda k: k in bidict_ticktick_gcalendar.inverse)
+            else:
+                task = api.find_inserted(entry, lambda k: k in bidict_ticktick_gcalendar)
+            written = task is not None
+            if written:
+                api.change_tasks(task)
+                if api is gtasks:
+                    bidict_ticktick_gcalendar[entry['source']] = task['id']
+                else:
+                    bidict_ticktick_gcalendar[task['id']] = entry['source']
+                # if the source did not change since, it is synced (otherwise it is updated by the sync)
+                source = other.get_tasks().get(entry['source'], None)
+                if source is not None and source.fingerprint == entry.get('fingerprint', None):
+                    other.change_tasks(source)
+        else:
+            written = entry['status'] == DONE or api.is_deleted(entry['target'])
+            if written:
+                api.change_tasks(None, delete=True, delete_id=entry['target'])
+                tick_id = entry['source'] if api is gtasks else entry['target']
+                bidict_ticktick_gcalendar.pop(tick_id, None)
+                source = other.get_tasks().get(entry['source'], None)
+                if source is not None:
+                    other.change_tasks(source)
+                else:
+                    other.change_tasks(None, delete=True, delete_id=entry['source'])
+        journal.resolve(entry['seq'], written)
+        resumed += written
+    if resumed:
+        print(f"Resumed {resumed} writes of an interrupted sync")
+    metrics.items('journal', 'resumed', resumed)
+
+
+def prune_synced(tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict):
+    """Forgets the ids synced whose tasks were pruned from both apis (see SyncWindow)"""
+    if tick.window is None and gtasks.window is None:
+        return
+    synced = list(bidict_ticktick_gcalendar.items())
+    # a pass over the ids of each api, instead of looking up each id (a query per id if --stream)
+    tick_pruned = missing_keys((k for k, _ in synced), tick.get_old_tasks())
+    gcal_pruned = missing_keys((v for _, v in synced), gtasks.get_old_tasks())
+    for tick_id, gcal_id in synced:
+        if tick_id in tick_pruned and gcal_id in gcal_pruned:
+            del bidict_ticktick_gcalendar[tick_id]
+
+
+def count_plan(kind: str, plan: ChangePlan):
+    metrics.items(kind, 'added', len(plan.added))
+    metrics.items(kind, 'updated', len(plan.updated))
+    metrics.items(kind, 'deleted', len(plan.deleted))
+
+
+def save_state(tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict, store: StateStore,
+               journal: Journal = None):
+    with metrics.time('save'):
+        store.save_bidict(bidict_ticktick_gcalendar)
         gtasks.save_old_tasks()
         tick.save_old_tasks()
+        store.commit()
+        # the journaled writes are now part of the saved state
+        if journal is not None:
+            journal.checkpoint()
+
+
+def export_metrics(args, success: bool):
+    """Writes the metrics files requested in the arguments"""
+    metrics.finish(success)
+    metrics.export(args.metrics, args.metrics_json)
+
+
+def run_daemon(args, tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict, store: StateStore,
+               journal: Journal = None):
+    """
+    Syncs periodically keeping the clients and the state in memory.
+    The interval is reset to min_interval when changes are found and grows up to max_interval while idle.
+    After errors, it backs off exponentially. The state is only saved when something changed
+    """
+    interval = args.min_interval
+    errors = 0
+    fetched = True  # the first cycle uses the tasks fetched on start
+    while True:
+        changed = False
+        try:
+            if not fetched:
+                tick.refresh()
+                gtasks.refresh()
+            fetched = False
+            changed = True  # if the sync fails, part of the changes may have been synced
+            changed = sum(len(k) for k in sync(tick, gtasks, bidict_ticktick_gcalendar, journal=journal).values()) > 0
+            errors = 0
+            interval = args.min_interval if changed else min(interval * 1.5, args.max_interval)
+        except KeyboardInterrupt:
+            save_state(tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+            export_metrics(args, False)
+            return
+        except Exception as e:
+            errors += 1
+            interval = min(args.min_interval * 2 ** errors, args.max_interval)
+            do_on_exception(e)
+        if changed:
+            save_state(tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+        export_metrics(args, errors == 0)
+        print(f"Next sync in {interval:.0f}s")
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            return
+
+
+def run_push(args, tick: TickTickApi, gtasks: GCalendarApi, bidict_ticktick_gcalendar: BiDict, store: StateStore,
+             journal: Journal = None):
+    """
+    Keeps running and syncs the changes of each Google Calendar calendar when its watch channel notifies them
+    (see push), instead of polling. TickTick cannot notify its changes, so everything is synced every max_interval.
+    A failed sync of a calendar is retried by the next full sync
+    """
+    from push import Push
+
+    host, port = args.listen.rsplit(':', 1)
+    push = Push(gtasks, args.push, host=host, port=int(port), debounce=args.debounce, ttl=args.channel_ttl)
+    push.start()
+    print(f"Receiving the notifications of {len(push.watcher.channels)} calendars on {push.receiver.url}")
+    fetched = True  # the first full sync uses the tasks fetched on start
+    next_sync = time.monotonic()
+    try:
+        while True:
+            calendar_ids = push.wait(max(0.0, next_sync - time.monotonic()))
+            full = time.monotonic() >= next_sync
+            if not (full or calendar_ids):
+                continue
+            changed = True  # if the sync fails, part of the changes may have been synced
+            success = False
+            try:
+                if full:
+                    # the calendars notified are synced too
+                    if not fetched:
+                        tick.refresh()
+                        gtasks.refresh()
+                    fetched = False
+                    next_sync = time.monotonic() + args.max_interval
+                    changed = sum(len(k) for k in sync(tick, gtasks, bidict_ticktick_gcalendar,
+                                                       journal=journal).values()) > 0
+                else:
+                    changed = len(sync_notified(tick, gtasks, bidict_ticktick_gcalendar, calendar_ids, journal)) > 0
+                success = True
+            except Exception as e:
+                do_on_exception(e)
+            if changed:
+                save_state(tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+            export_metrics(args, success)
+    except KeyboardInterrupt:
+        save_state(tick, gtasks, bidict_ticktick_gcalendar, store, journal)
+    finally:
+        push.close()
 
 
 if __name__ == "__main__":
@@ -627,6 +2137,60 @@ if __name__ == "__main__":
     parser.add_argument('-rg', '--remove_gcal', type=str, default=None, help="Used to delete a GCalendar event by id")
     parser.add_argument('-dg', '--delete_all_gcal', action='store_true',
                         help="WARNING: deletes all syncronized events. Useful to reset.")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Only fetch Google Calendar changes since last sync (uses saved sync tokens)")
+    parser.add_argument('-b', '--batch', action='store_true', help="Send Google Calendar changes in batch requests")
+    parser.add_argument('-a', '--async', dest='async_engine', action='store_true',
+                        help="Send the writes concurrently (up to --max_in_flight per api) instead of one at a time")
+    # the names of engine.ENGINES, not imported unless used
+    parser.add_argument('--engine', type=str, choices=['async', 'threads'], default=None,
+                        help="Send the writes concurrently from an asyncio loop or a pool of threads (-a is async)")
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help="Maximum number of calendars/projects fetched concurrently")
+    parser.add_argument('--google_rate', type=float, default=10,
+                        help="Maximum Google Calendar requests per second "
+                             "(throttled requests are retried with backoff)")
+    parser.add_argument('--ticktick_rate', type=float, default=None, help="Maximum TickTick requests per second")
+    parser.add_argument('--max_in_flight', type=int, default=8, help="Maximum requests in flight to each api")
+    parser.add_argument('--window_past', type=float, default=None,
+                        help="Only sync tasks ending after this many days ago (1 if only --window_future is given)")
+    parser.add_argument('--window_future', type=float, default=None,
+                        help="Only sync tasks starting before this many days from now")
+    parser.add_argument('-s', '--state_db', type=str, default=None,
+                        help="Save the sync state in this SQLite database instead of files (migrates the files)")
+    parser.add_argument('--stream', action='store_true',
+                        help="Diff the tasks page by page against the state database, with bounded memory (needs -s)")
+    parser.add_argument('--plan', type=str, nargs='?', const='-', default=None,
+                        help="Only show the changes a sync would do, as json (saved to the given file, if any)")
+    parser.add_argument('--apply', type=str, default=None, help="Sync only the changes of a plan saved with --plan")
+    parser.add_argument('-d', '--daemon', action='store_true', help="Keep running and sync periodically")
+    parser.add_argument('--push', type=str, default=None,
+                        help="Sync the Google Calendar changes when notified to this https url (forwarded to --listen)"
+                             " instead of polling, implies -i")
+    parser.add_argument('--listen', type=str, default='127.0.0.1:8080',
+                        help="Address (host:port) of the receiver of the notifications (--push)")
+    parser.add_argument('--debounce', type=float, default=5,
+                        help="Seconds without notifications of a calendar before syncing it (--push)")
+    parser.add_argument('--channel_ttl', type=float, default=7 * 24 * 3600,
+                        help="Seconds the watch channels are requested for, renewed before expiring (--push)")
+    parser.add_argument('--min_interval', type=float, default=60, help="Minimum seconds between syncs in daemon mode")
+    parser.add_argument('--max_interval', type=float, default=900,
+                        help="Maximum seconds between syncs in daemon mode (between full syncs with --push)")
+    parser.add_argument('--metrics', type=str, default=None,
+                        help="Write the run metrics to this Prometheus textfile collector file (e.g., sync.prom)")
+    parser.add_argument('--metrics_json', type=str, default=None, help="Write a json summary of the run metrics")
+    parser.add_argument('--tenants', type=str, default=None,
+                        help="Sync every account of this directory (one subdirectory with an account_info.py each)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help="Processes syncing tenants at the same time (--tenants)")
+    parser.add_argument('--global_max_in_flight', type=int, default=None,
+                        help="Maximum requests in flight to each api by all the tenants together (--tenants)")
 
     arguments = parser.parse_args()
+    if arguments.stream and arguments.state_db is None:
+        parser.error("--stream needs a state database (-s)")
+    if arguments.stream and (arguments.incremental or arguments.push is not None):
+        parser.error("--stream cannot be used with -i or --push")
+    if arguments.tenants is not None:
+        sys.exit(0 if main_tenants(arguments) else 1)
     main(arguments)
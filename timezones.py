@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+
+
+class TimezoneResolver:
+    """
+    Resolves the name of a timezone matching the utc offset of a datetime.
+    Uses an offset to zones index built once and memoizes the zone found for each (utc offset, dst)
+    """
+
+    def __init__(self, zones: List[str] = None):
+        if zones is None:
+            # common names first so that the chosen zone is a readable one
+            common = set(pytz.common_timezones)
+            zones = sorted(pytz.all_timezones_set, key=lambda k: (k not in common, k))
+        self.zones = zones
+        self._index = None
+        self._cache: Dict[Tuple[timedelta, Optional[timedelta]], str] = {}
+
+    @property
+    def index(self) -> Dict[timedelta, List[str]]:
+        """Zones by each utc offset they have ever used (keeps the order of the zones)"""
+        if self._index is None:
+            self._index = {}
+            for name in self.zones:
+                tz = pytz.timezone(name)
+                if hasattr(tz, '_transition_info'):
+                    offsets = {k[0] for k in tz._transition_info}
+                else:
+                    offsets = {tz.utcoffset(None)}
+                for offset in offsets:
+                    self._index.setdefault(offset, []).append(name)
+        return self._index
+
+    @staticmethod
+    def matches(name: str, d: datetime) -> bool:
+        local = d.astimezone(pytz.timezone(name))
+        if local.utcoffset() != d.utcoffset():
+            return False
+        return d.dst() is None or local.dst() == d.dst()
+
+    def resolve(self, d: datetime, preferred: str = None) -> str:
+        """
+        :param d: timezone aware datetime
+        :param preferred: zone name to return if it matches (e.g., the zone of the source event)
+        """
+        if preferred:
+            try:
+                if self.matches(preferred, d):
+                    return preferred
+            except pytz.UnknownTimeZoneError:
+                pass
+
+        key = (d.utcoffset(), d.dst())
+        name = self._cache.get(key, None)
+        # the same offset may belong to a different zone on another date
+        if name is not None and self.matches(name, d):
+            return name
+
+        for name in self.index.get(d.utcoffset(), []):
+            if self.matches(name, d):
+                self._cache[key] = name
+                return name
+        raise Exception(f"no timezone found for {d.isoformat()}")
+
+
+resolver = TimezoneResolver()
+
+
+def get_timezone_name(d: datetime, preferred: str = None) -> str:
+    return resolver.resolve(d, preferred)